@@ -0,0 +1,86 @@
+"""
+ASGI views of the endpoints which have an async implementation.
+
+The views are plain ASGI applications, they do not go through DRF nor the
+django middleware. There is no authentication, permission check, content
+negotiation or `MetricsMiddleware` instrumentation on these paths, so only
+endpoints open to anyone, like the external books, are served here.
+"""
+from django.http import QueryDict
+from rest_framework.status import HTTP_200_OK, HTTP_404_NOT_FOUND
+
+from api.renderers import ORJSONRenderer
+from api.services import BooksService
+
+
+async def send_json_response(send, data, status, head=False):
+    """
+    Sends the data rendered as json through the ASGI `send` callable, only
+    the headers when answering a `head` request.
+    """
+    content = ORJSONRenderer().render(data)
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(content)).encode('ascii')),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': b'' if head else content})
+
+
+class AsyncBooksList(object):
+    """
+    Get the books data from external api without blocking the worker.
+
+    ASGI counterpart of `api.views.BooksList`; while the upstream is being
+    waited for, the event loop serves the other requests.
+    """
+    book_service = BooksService()
+
+    async def __call__(self, scope, receive, send):
+        if scope['method'] not in ('GET', 'HEAD'):
+            await send_json_response(send, {'detail': 'Method not allowed.'}, 405)
+            return
+        query_params = QueryDict(scope.get('query_string', b''))
+        response_data = await self.book_service.aget_books(name=query_params.get('name'))
+        await send_json_response(send, response_data, HTTP_200_OK, head=scope['method'] == 'HEAD')
+
+
+class AsyncRouter(object):
+    """
+    ASGI application dispatching the requests on their exact path.
+
+    `routes` maps the paths to ASGI applications, or is a callable returning
+    the mapping so that it can be built after django has been set up.
+    """
+
+    def __init__(self, routes):
+        self._routes = routes
+
+    @property
+    def routes(self):
+        if callable(self._routes):
+            self._routes = self._routes()
+        return self._routes
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        route = self.routes.get(scope['path'])
+        if route is None:
+            await send_json_response(send, {'detail': 'Not found.'}, HTTP_404_NOT_FOUND)
+            return
+        await route(scope, receive, send)
+
+    @staticmethod
+    async def lifespan(receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
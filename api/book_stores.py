@@ -1,62 +1,377 @@
-import requests
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from urllib.parse import parse_qs, urlparse
+
 from django.conf import settings
+from django.db import connections
 from django.utils.module_loading import import_string
-from requests import ConnectionError
+from requests import RequestException
 
 from api.api_utils import get_response_status_info
+from api.caches import get_book_store_cache, normalize_query
+from api.coalescing import get_single_flight
+from api.http_client import get_async_client, get_circuit_breaker, get_session, get_timeout, httpx
+from api.instrumentation import record_time
+from api.mirror import get_mirrored_books
 from api.serializers import IceAndFireSerializer
 
 
+DEFAULT_BOOK_STORE_DEADLINE = 5
+
+# Threads of the fan out pool of each store.
+FAN_OUT_WORKERS = 8
+
+_fan_out_executors = {}
+_fan_out_executors_lock = threading.Lock()
+
+
+def get_store_configs():
+    """
+    Returns the (backend, deadline) pairs of the active stores.
+
+    `settings.ACTIVE_BOOK_STORES` lists the backends as dotted paths or as
+    dicts with a `BACKEND` and an optional `DEADLINE` in seconds. It falls
+    back to the single `settings.ACTIVE_BOOK_STORE`.
+    """
+    default_deadline = getattr(settings, 'BOOK_STORE_DEADLINE', DEFAULT_BOOK_STORE_DEADLINE)
+    stores = getattr(settings, 'ACTIVE_BOOK_STORES', None) or [settings.ACTIVE_BOOK_STORE]
+    configs = []
+    for store in stores:
+        if isinstance(store, dict):
+            configs.append((store['BACKEND'], store.get('DEADLINE', default_deadline)))
+        else:
+            configs.append((store, default_deadline))
+    return configs
+
+
+def get_fan_out_executor(backend):
+    """
+    Returns the fan out pool of the store backend. A fetch missing its
+    deadline keeps its thread until it returns, with a pool per store a
+    slow store only holds up its own fetches.
+    """
+    with _fan_out_executors_lock:
+        executor = _fan_out_executors.get(backend)
+        if executor is None:
+            executor = _fan_out_executors[backend] = ThreadPoolExecutor(max_workers=FAN_OUT_WORKERS)
+        return executor
+
+
+def get_books_in_thread(store, name):
+    """
+    Fetch the books of the store on a pool thread. The database connections
+    of the thread, opened by the local stores, are closed after as there is
+    no request cycle to close them.
+    """
+    try:
+        return store.get_books(name)
+    finally:
+        connections.close_all()
+
+
+def normalize_isbn(isbn):
+    """Normalizes the isbn so that the same book from different stores matches."""
+    return ''.join(character for character in (isbn or '') if character.isalnum()).upper()
+
+
 class BookStore(object):
     """
     Books store class which encapsulate all store specific information with itself.
+
+    With more than one active store the queries fan out to all the stores
+    concurrently. The books are merged in the order of the stores and
+    de-duplicated by isbn. Stores failing or missing their deadline are
+    reported in the `stores` metadata of a `partial` response.
+
+    Concurrent fetches of the same normalized query, from threads or asyncio
+    tasks, share a single call to the stores.
     """
 
     def __init__(self, *args, **kwargs):
         """
-        Initialize the store from the active store settings.
+        Initialize the stores from the active store settings.
         """
-        store_class = import_string(settings.ACTIVE_BOOK_STORE)
-        self.store = store_class(*args, **kwargs)
+        store_configs = get_store_configs()
+        self.stores = [
+            (import_string(backend)(*args, **kwargs), deadline)
+            for backend, deadline in store_configs
+        ]
+        self.store = self.stores[0][0]
+        self.backends = tuple(backend for backend, __ in store_configs)
+        self.remote = any(store.remote for store, __ in self.stores)
+
+    def get_flight_key(self, name):
+        """Identifies the fetches of the query which can share a call to the stores."""
+        return self.backends, normalize_query(name)
 
     def get_books(self, name):
-        """Fetch the books from the active store."""
-        return self.store.get_books(name)
+        """Fetch the books from the active stores, through the cache if enabled."""
+        cache = get_book_store_cache() if self.remote else None
+        if cache is None:
+            return self.fetch_books(name)
+        return cache.get_or_fetch(name, self.fetch_books)
+
+    async def aget_books(self, name):
+        """Fetch the books from the active stores without blocking the event loop."""
+        cache = get_book_store_cache() if self.remote else None
+        if cache is None:
+            return await self.afetch_books(name)
+        return await cache.aget_or_fetch(name, self.afetch_books, self.fetch_books)
+
+    @record_time('upstream')
+    def fetch_books(self, name):
+        """Fetch the books from the stores, joining an identical fetch in flight if any."""
+        single_flight = get_single_flight()
+        if single_flight is None:
+            return self.fetch_from_stores(name)
+        return single_flight.call(self.get_flight_key(name), self.fetch_from_stores, name)
+
+    @record_time('upstream')
+    async def afetch_books(self, name):
+        """Async counterpart of `fetch_books`."""
+        single_flight = get_single_flight()
+        if single_flight is None:
+            return await self.afetch_from_stores(name)
+        return await single_flight.acall(self.get_flight_key(name), self.afetch_from_stores, name)
+
+    def fetch_from_stores(self, name):
+        """Fetch the books from every active store, each within its deadline."""
+        if len(self.stores) == 1:
+            return self.store.get_books(name)
+
+        futures = [
+            get_fan_out_executor(backend).submit(get_books_in_thread, store, name)
+            for backend, (store, __) in zip(self.backends, self.stores)
+        ]
+        started_at = time.time()
+        results = []
+        for future, (store, deadline) in zip(futures, self.stores):
+            try:
+                results.append(future.result(timeout=max(deadline - (time.time() - started_at), 0)))
+            except Exception as ex:
+                results.append(ex)
+        return self.merge_responses(results)
+
+    async def afetch_from_stores(self, name):
+        """Async counterpart of `fetch_from_stores`."""
+        if len(self.stores) == 1:
+            return await self.store.aget_books(name)
+
+        results = await asyncio.gather(*[
+            asyncio.wait_for(store.aget_books(name), deadline) for store, deadline in self.stores
+        ], return_exceptions=True)
+        return self.merge_responses(results)
+
+    def merge_responses(self, results):
+        """
+        Merges the responses of the stores, given in the order of the stores.
+        A result is either the response of the store or the exception raised
+        while waiting for it.
+        """
+        books, seen_isbns, stores_info = [], set(), []
+        for (store, __), result in zip(self.stores, results):
+            store_info = {'store': store.__class__.__name__}
+            if isinstance(result, (FutureTimeoutError, asyncio.TimeoutError)):
+                store_info.update(status='timeout', message='The store did not respond in time.')
+            elif isinstance(result, Exception):
+                store_info.update(status='error', message='{error}'.format(error=result))
+            elif result.get('status') != 'success':
+                store_info.update(status='error', message=result.get('message'))
+            else:
+                store_info.update(status='success', count=len(result['data']))
+                for book in result['data']:
+                    isbn = normalize_isbn(book.get('isbn'))
+                    if isbn and isbn in seen_isbns:
+                        continue
+                    seen_isbns.add(isbn)
+                    books.append(book)
+            stores_info.append(store_info)
+
+        succeeded = [info for info in stores_info if info['status'] == 'success']
+        response_data = get_response_status_info(200 if succeeded else 500)
+        response_data.update({
+            'data': books,
+            'partial': len(succeeded) != len(stores_info),
+            'stores': stores_info,
+        })
+        return response_data
 
 
 class BookStoreBase(object):
     """Base class for all stores to have common attributes and functions."""
-    pass
+    # Responses of remote stores are cached, local stores are queried directly.
+    remote = True
+
+    @property
+    def session(self):
+        """The keep-alive session shared by the stores of this process."""
+        return get_session()
+
+    @property
+    def circuit_breaker(self):
+        """The circuit breaker of the store upstream."""
+        return get_circuit_breaker(self.__class__.__name__)
+
+    def http_get(self, url, **kwargs):
+        """
+        Makes a GET request with the pooled session and the configured timeouts.
+
+        Connection errors, timeouts and server errors count as failures of
+        the upstream, and CircuitOpenError is raised without making the
+        request while the upstream keeps failing. Client errors are raised
+        but do not count, the upstream answered.
+        """
+        circuit_breaker = self.circuit_breaker
+        circuit_breaker.before_request()
+        kwargs.setdefault('timeout', get_timeout())
+        try:
+            response = self.session.get(url, **kwargs)
+        except RequestException:
+            circuit_breaker.record_failure()
+            raise
+        self.record_response(response.status_code)
+        response.raise_for_status()
+        return response
+
+    def record_response(self, status_code):
+        """Records the response of the upstream on its circuit breaker."""
+        if status_code >= 500:
+            self.circuit_breaker.record_failure()
+        else:
+            self.circuit_breaker.record_success()
+
+    @property
+    def async_client(self):
+        """The keep-alive httpx client shared by the stores on the running event loop."""
+        return get_async_client(asyncio.get_event_loop())
+
+    async def ahttp_get(self, url, **kwargs):
+        """
+        Async counterpart of `http_get` using the httpx client. httpx errors
+        are raised as RequestException so that the stores handle the errors
+        of both code paths alike. A cancelled request, e.g. on a deadline or
+        a disconnect, is not a failure, but a cancelled trial request opens
+        the circuit again so that it is not left half-open for good.
+        """
+        circuit_breaker = self.circuit_breaker
+        circuit_breaker.before_request()
+        try:
+            response = await self.async_client.get(url, **kwargs)
+        except httpx.HTTPError as ex:
+            circuit_breaker.record_failure()
+            raise RequestException(ex)
+        except asyncio.CancelledError:
+            circuit_breaker.record_cancel()
+            raise
+        self.record_response(response.status_code)
+        try:
+            response.raise_for_status()
+        except httpx.HTTPError as ex:
+            raise RequestException(ex)
+        return response
+
+    async def aget_books(self, name=None):
+        """
+        Fetch the books without blocking the event loop. Stores without native
+        async io fetch the books on the default executor of the loop.
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, get_books_in_thread, self, name)
 
 
 class IceAndFireStore(BookStoreBase):
+    """
+    Store for the books of the Ice and Fire api.
+
+    The api paginates the books and advertises the pages with `Link` headers.
+    The first page tells the number of pages and the remaining pages, up to
+    `max_pages`, are fetched concurrently by `max_workers` threads. The
+    responses of more pages than that are flagged as `truncated`.
+    """
     url = 'https://www.anapioficeandfire.com/api/books'
     serializer = IceAndFireSerializer
+    page_size = 50
+    max_pages = 20
+    max_workers = 4
 
-    def parse_query_params(self, name):
-        """Helper method which parses the query string and construct api url."""
-        if not name:
-            return self.url
-        return '{0}?name={1}'.format(self.url, name)
+    def __init__(self, page_size=None, max_pages=None, max_workers=None):
+        options = getattr(settings, 'ICE_AND_FIRE_STORE', {})
+        self.page_size = page_size or options.get('PAGE_SIZE', self.page_size)
+        self.max_pages = max_pages or options.get('MAX_PAGES', self.max_pages)
+        self.max_workers = max_workers or options.get('MAX_WORKERS', self.max_workers)
+
+    def get_page_params(self, page, name=None):
+        """Returns the query params for fetching a page of the books named `name`."""
+        params = {'page': page, 'pageSize': self.page_size}
+        if name:
+            params['name'] = name
+        return params
+
+    @staticmethod
+    def get_last_page(response):
+        """Returns the number of the last page from the `Link` header of the response."""
+        last_link = response.links.get('last')
+        if not last_link:
+            return 1
+        page = parse_qs(urlparse(last_link['url']).query).get('page')
+        return int(page[0]) if page else 1
+
+    def fetch_pages(self, name=None):
+        """Fetches the first page and then the remaining pages concurrently, in order."""
+        first_page = self.http_get(self.url, params=self.get_page_params(1, name))
+        last_page = min(self.get_last_page(first_page), self.max_pages)
+        if last_page <= 1:
+            return [first_page]
+
+        def fetch_page(page):
+            return self.http_get(self.url, params=self.get_page_params(page, name))
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, last_page - 1)) as executor:
+            return [first_page] + list(executor.map(fetch_page, range(2, last_page + 1)))
 
     def get_books(self, name=None):
         """Fetch the books information using the api url."""
-        api_url = self.parse_query_params(name)
         try:
-            response = requests.get(api_url)
-            return self.transform_success_response(response)
-        except ConnectionError as ex:
+            responses = self.fetch_pages(name)
+        except RequestException as ex:
             return self.return_error_response(ex)
+        return self.transform_success_response(responses)
 
-    def transform_success_response(self, response):
-        """Transforms the response into required format."""
-        response_data = response.json()
+    async def afetch_pages(self, name=None):
+        """Async counterpart of `fetch_pages` fetching `max_workers` pages at a time."""
+        first_page = await self.ahttp_get(self.url, params=self.get_page_params(1, name))
+        last_page = min(self.get_last_page(first_page), self.max_pages)
+        semaphore = asyncio.Semaphore(self.max_workers)
+
+        async def fetch_page(page):
+            async with semaphore:
+                return await self.ahttp_get(self.url, params=self.get_page_params(page, name))
+
+        pages = await asyncio.gather(*[fetch_page(page) for page in range(2, last_page + 1)])
+        return [first_page] + list(pages)
+
+    async def aget_books(self, name=None):
+        """Fetch the books information with the httpx client, if installed."""
+        if httpx is None:
+            return await super(IceAndFireStore, self).aget_books(name)
+        try:
+            responses = await self.afetch_pages(name)
+        except RequestException as ex:
+            return self.return_error_response(ex)
+        return self.transform_success_response(responses)
+
+    def transform_success_response(self, responses):
+        """Transforms the responses of the pages into required format."""
         serialized_data = []
-        for book_data in response_data:
-            serializer = self.serializer(book_data)
-            serialized_data.append(serializer.data)
+        for response in responses:
+            serialized_data.extend(self.serializer.transform_many(response.json()))
         data = {'data': serialized_data}
-        return self.add_response_status_info(data, response.status_code)
+        if self.get_last_page(responses[0]) > len(responses):
+            data['truncated'] = True
+        return self.add_response_status_info(data, responses[0].status_code)
 
     def add_response_status_info(self, data, response_status_code):
         """
@@ -73,5 +388,19 @@ class IceAndFireStore(BookStoreBase):
     def return_error_response(self, ex):
         """Returns error response."""
         response_status = get_response_status_info(status_code=500)
-        response_status['message'] = '{error}'.format(error=ex.message)
+        response_status['message'] = '{error}'.format(error=ex)
         return response_status
+
+
+class LocalMirrorStore(BookStoreBase):
+    """
+    Store answering from the local mirror of the external catalog, kept up
+    to date by the `sync_external_books` command or the mirror scheduler.
+    """
+    remote = False
+
+    def get_books(self, name=None):
+        """Fetch the books named `name`, or all the books, from the mirror."""
+        response_data = get_response_status_info(200)
+        response_data['data'] = get_mirrored_books(name)
+        return response_data
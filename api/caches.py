@@ -0,0 +1,310 @@
+import asyncio
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+
+DEFAULT_BOOK_STORE_CACHE = {
+    'ENABLED': True,
+    'CACHE_ALIAS': 'default',
+    'TIMEOUT': 300,
+    'STALE_TIMEOUT': 600,
+    'MAX_ENTRIES': 1000,
+}
+
+DEFAULT_BOOK_REPRESENTATION_CACHE = {
+    'ENABLED': None,
+    'CACHE_ALIAS': 'default',
+    'TIMEOUT': 300,
+}
+
+_book_store_cache = None
+_book_store_cache_lock = threading.Lock()
+_book_representation_cache = None
+
+
+def is_process_local(cache):
+    """Whether each process keeps a cache of its own, which it can not invalidate in the others."""
+    return isinstance(cache, (LocMemCache, DummyCache))
+
+
+def normalize_query(name):
+    """Normalizes the books query so that equivalent queries share a cache entry."""
+    return ' '.join((name or '').split())
+
+
+def is_cacheable(data):
+    """Only complete, successful store responses are cached."""
+    return isinstance(data, dict) and data.get('status') == 'success' and not data.get('partial')
+
+
+class BookStoreCache(object):
+    """
+    Cache of book store responses on top of django's cache framework.
+
+    An entry is fresh for `timeout` seconds, after which it is served stale
+    for up to `stale_timeout` more seconds while it is refreshed in the
+    background. The process keeps an LRU index of the keys it has written
+    and deletes the least recently used ones beyond `max_entries`.
+    """
+    key_prefix = 'book-store'
+
+    def __init__(self, cache_alias='default', timeout=300, stale_timeout=600, max_entries=1000):
+        self.cache_alias = cache_alias
+        self.timeout = timeout
+        self.stale_timeout = stale_timeout
+        self.max_entries = max_entries
+        self.stats = self.get_empty_stats()
+        self._keys = OrderedDict()
+        self._refreshing = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @classmethod
+    def from_settings(cls):
+        """Returns the cache configured by `settings.BOOK_STORE_CACHE` or None if disabled."""
+        options = dict(DEFAULT_BOOK_STORE_CACHE, **getattr(settings, 'BOOK_STORE_CACHE', {}))
+        if not options['ENABLED']:
+            return None
+        return cls(
+            cache_alias=options['CACHE_ALIAS'],
+            timeout=options['TIMEOUT'],
+            stale_timeout=options['STALE_TIMEOUT'],
+            max_entries=options['MAX_ENTRIES'],
+        )
+
+    @staticmethod
+    def get_empty_stats():
+        return {'hits': 0, 'stale_hits': 0, 'misses': 0, 'evictions': 0, 'refreshes': 0}
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def make_key(self, name):
+        digest = hashlib.md5(normalize_query(name).encode('utf-8')).hexdigest()
+        return '{0}:{1}'.format(self.key_prefix, digest)
+
+    def get_cached(self, key, name, fetch):
+        """
+        Returns the cached response or None on a miss. Stale entries are
+        returned while they are refreshed in the background with `fetch(name)`.
+        """
+        entry = self.cache.get(key)
+        if entry is None:
+            self.increment('misses')
+            return None
+
+        self.touch(key)
+        if entry['fresh_until'] > time.time():
+            self.increment('hits')
+        else:
+            self.increment('stale_hits')
+            self.schedule_refresh(key, name, fetch)
+        return entry['data']
+
+    def get_or_fetch(self, name, fetch):
+        """
+        Returns the cached response for the books query, calling
+        `fetch(name)` on a miss.
+        """
+        key = self.make_key(name)
+        data = self.get_cached(key, name, fetch)
+        if data is None:
+            data = fetch(name)
+            self.set(key, data)
+        return data
+
+    async def aget_or_fetch(self, name, afetch, fetch):
+        """
+        Async counterpart of `get_or_fetch` awaiting `afetch(name)` on a miss.
+        Stale entries are refreshed in the background with `fetch(name)`.
+        The calls to django's cache block, they run on the default executor
+        of the loop.
+        """
+        loop = asyncio.get_event_loop()
+        key = self.make_key(name)
+        data = await loop.run_in_executor(None, self.get_cached, key, name, fetch)
+        if data is None:
+            data = await afetch(name)
+            await loop.run_in_executor(None, self.set, key, data)
+        return data
+
+    def set(self, key, data):
+        """Stores the response unless it is an error response."""
+        if not is_cacheable(data):
+            return
+        entry = {'data': data, 'fresh_until': time.time() + self.timeout}
+        self.cache.set(key, entry, self.timeout + self.stale_timeout)
+        self.touch(key)
+
+    def touch(self, key):
+        """Marks the key as most recently used and evicts the least recently used keys."""
+        with self._lock:
+            self._keys.pop(key, None)
+            self._keys[key] = True
+            evicted = []
+            while len(self._keys) > self.max_entries:
+                evicted.append(self._keys.popitem(last=False)[0])
+            self.stats['evictions'] += len(evicted)
+        if evicted:
+            self.cache.delete_many(evicted)
+
+    def schedule_refresh(self, key, name, fetch):
+        """Refreshes the stale entry in the background unless already refreshing."""
+        with self._lock:
+            if key in self._refreshing:
+                return
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=2)
+            self._refreshing[key] = self._executor.submit(self.refresh, key, name, fetch)
+
+    def refresh(self, key, name, fetch):
+        try:
+            self.set(key, fetch(name))
+            self.increment('refreshes')
+        finally:
+            with self._lock:
+                self._refreshing.pop(key, None)
+
+    def wait_for_refreshes(self, timeout=None):
+        """Blocks until the background refreshes in progress are done."""
+        with self._lock:
+            futures = list(self._refreshing.values())
+        wait(futures, timeout=timeout)
+
+    def increment(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def clear(self):
+        """Deletes the entries written by this process and resets the stats."""
+        self.wait_for_refreshes()
+        with self._lock:
+            keys = list(self._keys)
+            self._keys.clear()
+            self.stats = self.get_empty_stats()
+        self.cache.delete_many(keys)
+
+
+def get_book_store_cache():
+    """Returns the process wide book store cache, or None when caching is disabled."""
+    global _book_store_cache
+    with _book_store_cache_lock:
+        if _book_store_cache is None:
+            _book_store_cache = BookStoreCache.from_settings() or False
+        return _book_store_cache or None
+
+
+class RepresentationCache(object):
+    """
+    Cache of the serialized representations of model instances by id and
+    generation.
+
+    The entries of an instance are deleted when it changes, right away and
+    once the transaction commits. When something rendered with many
+    instances changes, e.g. a renamed publisher, the generation is bumped
+    instead, retiring all the entries at once. A representation serialized
+    from rows read before a concurrent write may be cached after the write
+    deleted its entry, which is why the entries expire after `timeout`.
+    """
+
+    def __init__(self, key_prefix, cache_alias='default', timeout=300):
+        self.key_prefix = key_prefix
+        self.cache_alias = cache_alias
+        self.timeout = timeout
+        self.generation_key = '{0}:generation'.format(key_prefix)
+
+    @classmethod
+    def from_settings(cls, key_prefix, setting_name, defaults):
+        """
+        Returns the cache configured by the setting or None if disabled.
+        `ENABLED` None enables it only on a cache shared by the processes,
+        the invalidations do not reach the caches of the other processes.
+        """
+        options = dict(defaults, **getattr(settings, setting_name, {}))
+        enabled = options['ENABLED']
+        if enabled is None:
+            enabled = not is_process_local(caches[options['CACHE_ALIAS']])
+        if not enabled:
+            return None
+        return cls(key_prefix, cache_alias=options['CACHE_ALIAS'], timeout=options['TIMEOUT'])
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def get_generation(self):
+        # Starting from the time rather than 1 keeps a generation key evicted
+        # from the cache from bringing back the entries of a past generation.
+        self.cache.add(self.generation_key, int(time.time() * 1000), None)
+        return self.cache.get(self.generation_key)
+
+    def make_key(self, generation, pk):
+        return '{0}:{1}:{2}'.format(self.key_prefix, generation, pk)
+
+    def get_many(self, pks, fetch, serialize):
+        """
+        Returns the representations of the instances with the primary keys in
+        the same order, fetching the missing instances with `fetch(pks)` and
+        rendering them with `serialize(instances)`.
+        """
+        generation = self.get_generation()
+        keys = {pk: self.make_key(generation, pk) for pk in pks}
+        cached = self.cache.get_many(list(keys.values()))
+        representations = {pk: cached[key] for pk, key in keys.items() if key in cached}
+
+        missing_pks = [pk for pk in keys if pk not in representations]
+        if missing_pks:
+            instances = list(fetch(missing_pks))
+            fresh = {instance.pk: data for instance, data in zip(instances, serialize(instances))}
+            self.cache.set_many({keys[pk]: data for pk, data in fresh.items()}, self.timeout)
+            representations.update(fresh)
+        return [representations[pk] for pk in pks if pk in representations]
+
+    def invalidate(self, pks):
+        """Deletes the entries of the instances with the primary keys."""
+        generation = self.get_generation()
+        keys = [self.make_key(generation, pk) for pk in pks]
+        if keys:
+            self.cache.delete_many(keys)
+            transaction.on_commit(lambda: self.cache.delete_many(keys))
+
+    def invalidate_all(self):
+        """Retires all the entries by bumping the generation."""
+        try:
+            self.cache.incr(self.generation_key)
+        except ValueError:
+            # The generation key was evicted, a new one from the time can not
+            # match the generation of the entries written before.
+            self.cache.set(self.generation_key, int(time.time() * 1000), None)
+
+
+def get_book_representation_cache():
+    """Returns the process wide cache of book representations, or None when disabled."""
+    global _book_representation_cache
+    with _book_store_cache_lock:
+        if _book_representation_cache is None:
+            _book_representation_cache = RepresentationCache.from_settings(
+                'book-representation', 'BOOK_REPRESENTATION_CACHE', DEFAULT_BOOK_REPRESENTATION_CACHE
+            ) or False
+        return _book_representation_cache or None
+
+
+@receiver(setting_changed)
+def reset_book_store_cache(setting, **kwargs):
+    """Rebuilds the caches when their settings are overridden, e.g. in tests."""
+    global _book_store_cache, _book_representation_cache
+    if setting in ('BOOK_STORE_CACHE', 'BOOK_REPRESENTATION_CACHE', 'CACHES'):
+        with _book_store_cache_lock:
+            _book_store_cache = None
+            _book_representation_cache = None
@@ -0,0 +1,117 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from rest_framework.exceptions import APIException
+
+from api.conditional import get_change_counter
+from api.models import Book, BookChange, ChangeCounter
+
+DEFAULT_BOOK_CHANGES = {
+    'COMPACT_AFTER': 24 * 60 * 60,
+    'RETENTION': 30 * 24 * 60 * 60,
+}
+
+# Change counter holding the id of the last entry deleted by a truncation,
+# the cursors before it can not be served anymore.
+BOOK_CHANGES_HORIZON = 'book_changes_horizon'
+
+
+class ChangesCompacted(APIException):
+    status_code = 410
+    default_detail = 'The changes since the cursor were compacted, list the books again and sync from a new cursor.'
+    default_code = 'changes_compacted'
+
+
+def get_book_changes_options():
+    return dict(DEFAULT_BOOK_CHANGES, **getattr(settings, 'BOOK_CHANGES', {}))
+
+
+def record_book_changes(changes):
+    """
+    Appends entries for the (book_id, action) pairs to the change log, in
+    the transaction of the change. The books change counter must be bumped
+    first in the transaction: the update locks the counter row until the
+    commit, so the ids of the entries are allocated in commit order and a
+    client reading the log never skips an entry committed after a later one.
+    """
+    changed_at = timezone.now()
+    BookChange.objects.bulk_create(
+        [BookChange(book_id=book_id, action=action, changed_at=changed_at) for book_id, action in changes],
+        batch_size=500,
+    )
+
+
+def get_current_cursor():
+    """Returns the cursor of the last entry of the change log."""
+    last_id = BookChange.objects.aggregate(last_id=Max('id'))['last_id']
+    return max(last_id or 0, get_change_counter(BOOK_CHANGES_HORIZON)[0])
+
+
+def get_book_changes(since, limit):
+    """
+    Returns the entries after the cursor `since` in order, `limit` at most,
+    and whether there are more. Raises ChangesCompacted if entries after
+    the cursor were truncated.
+    """
+    changes = list(BookChange.objects.filter(id__gt=since).order_by('id')[:limit + 1])
+    # Read after the entries, a truncation committed in between is noticed.
+    if since < get_change_counter(BOOK_CHANGES_HORIZON)[0]:
+        raise ChangesCompacted()
+    return changes[:limit], len(changes) > limit
+
+
+def collapse_book_changes(changes, existing_book_ids):
+    """
+    Collapses the entries of the same book into its last one and returns
+    (entry, action) pairs in the order of the entries. The action is the
+    outcome for the client: `deleted` if the book is gone by now, `created`
+    if its first entry created it, `updated` otherwise.
+    """
+    first_actions, last_changes = {}, {}
+    for change in changes:
+        first_actions.setdefault(change.book_id, change.action)
+        last_changes[change.book_id] = change
+
+    collapsed = []
+    for change in sorted(last_changes.values(), key=lambda change: change.id):
+        if change.book_id not in existing_book_ids:
+            action = BookChange.DELETED
+        elif first_actions[change.book_id] == BookChange.CREATED:
+            action = BookChange.CREATED
+        else:
+            action = BookChange.UPDATED
+        collapsed.append((change, action))
+    return collapsed
+
+
+def compact_book_changes(compact_before, truncate_before=None):
+    """
+    Compacts the change log and returns the number of compacted and of
+    truncated entries.
+
+    The entries older than `compact_before` superseded by a later entry of
+    the same book are deleted, but for the creations of the existing books.
+    This loses nothing: the feed serves the current state of the books,
+    which the later entry brings to any client behind it, and the kept
+    creation still tells the clients behind it that the book is new. The
+    entries older than `truncate_before` are all deleted and the horizon of
+    the feed moves past them, the clients with an older cursor have to list
+    the books again.
+    """
+    with transaction.atomic():
+        latest_ids = BookChange.objects.values('book_id').annotate(latest_id=Max('id')).values('latest_id')
+        compacted = BookChange.objects.filter(changed_at__lt=compact_before).exclude(id__in=latest_ids).exclude(
+            action=BookChange.CREATED, book_id__in=Book.objects.values('pk')
+        ).delete()[0]
+
+        truncated = 0
+        if truncate_before is not None:
+            horizon = BookChange.objects.filter(changed_at__lt=truncate_before).aggregate(horizon=Max('id'))['horizon']
+            if horizon is not None:
+                truncated = BookChange.objects.filter(id__lte=horizon).delete()[0]
+                get_change_counter(BOOK_CHANGES_HORIZON)
+                ChangeCounter.objects.filter(name=BOOK_CHANGES_HORIZON, version__lt=horizon).update(
+                    version=horizon, modified_at=timezone.now()
+                )
+    return compacted, truncated
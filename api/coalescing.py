@@ -0,0 +1,152 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+DEFAULT_BOOK_STORE_COALESCING = {
+    'ENABLED': True,
+}
+
+_single_flight = None
+_single_flight_lock = threading.Lock()
+
+# Result of a call given up by its originator, e.g. a cancelled task, for
+# which the waiters call again.
+_ABANDONED = object()
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent identical calls into a single call.
+
+    The first caller of a key originates the call, the callers of the same
+    key arriving while it is in flight wait for it and share its result or
+    its exception. The calls in flight are `concurrent.futures.Future`s so
+    that threads and asyncio tasks, on any event loop, can join the calls of
+    each other. The next caller after the call is done originates a new one.
+    If the originator gives up the call without a result, e.g. on
+    cancellation, a waiter originates a new one as well.
+    """
+    name = 'api_book_store_calls_total'
+    description = 'Book store fetches, by whether they called the stores or joined a fetch in flight.'
+
+    def __init__(self):
+        self.stats = self.get_empty_stats()
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_empty_stats():
+        return {'originated': 0, 'coalesced': 0}
+
+    def join_or_start(self, key):
+        """Returns the future of the call of the key and whether this caller originates it."""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.stats['coalesced'] += 1
+                return future, False
+            future = self._calls[key] = Future()
+            # A running future can not be cancelled by one of its waiters.
+            future.set_running_or_notify_cancel()
+            self.stats['originated'] += 1
+            return future, True
+
+    def finish(self, key, future, result=None, exception=None):
+        with self._lock:
+            self._calls.pop(key, None)
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def call(self, key, func, *args):
+        """Returns `func(*args)`, sharing the call in flight for the key if any."""
+        while True:
+            future, originated = self.join_or_start(key)
+            if not originated:
+                result = future.result()
+                if result is _ABANDONED:
+                    continue
+                return result
+            try:
+                result = func(*args)
+            except Exception as ex:
+                self.finish(key, future, exception=ex)
+                raise
+            except BaseException:
+                # Not an error of the call, e.g. KeyboardInterrupt.
+                self.finish(key, future, _ABANDONED)
+                raise
+            self.finish(key, future, result)
+            return result
+
+    async def acall(self, key, afunc, *args):
+        """
+        Async counterpart of `call` awaiting `afunc(*args)`. When the
+        originating task is cancelled, e.g. as its client went away, the
+        waiters are not failed, one of them calls again.
+        """
+        while True:
+            future, originated = self.join_or_start(key)
+            if not originated:
+                result = await asyncio.wrap_future(future)
+                if result is _ABANDONED:
+                    continue
+                return result
+            try:
+                result = await afunc(*args)
+            # CancelledError derives from Exception up to Python 3.7.
+            except asyncio.CancelledError:
+                self.finish(key, future, _ABANDONED)
+                raise
+            except Exception as ex:
+                self.finish(key, future, exception=ex)
+                raise
+            except BaseException:
+                self.finish(key, future, _ABANDONED)
+                raise
+            self.finish(key, future, result)
+            return result
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+    def clear_stats(self):
+        with self._lock:
+            self.stats = self.get_empty_stats()
+
+    def render(self):
+        """Renders the counters in the Prometheus text exposition format."""
+        with self._lock:
+            stats = dict(self.stats)
+        lines = [
+            '# HELP {0} {1}'.format(self.name, self.description),
+            '# TYPE {0} counter'.format(self.name),
+        ]
+        for call in ('originated', 'coalesced'):
+            lines.append('{0}{{call="{1}"}} {2}'.format(self.name, call, stats[call]))
+        return '\n'.join(lines) + '\n'
+
+
+def get_single_flight():
+    """Returns the process wide coalescer of the book store fetches, or None when disabled."""
+    global _single_flight
+    with _single_flight_lock:
+        if _single_flight is None:
+            options = dict(DEFAULT_BOOK_STORE_COALESCING, **getattr(settings, 'BOOK_STORE_COALESCING', {}))
+            _single_flight = SingleFlight() if options['ENABLED'] else False
+        return _single_flight or None
+
+
+@receiver(setting_changed)
+def reset_single_flight(setting, **kwargs):
+    """Rebuilds the coalescer when its settings are overridden, e.g. in tests."""
+    global _single_flight
+    if setting == 'BOOK_STORE_COALESCING':
+        with _single_flight_lock:
+            _single_flight = None
@@ -0,0 +1,87 @@
+import hashlib
+from calendar import timegm
+
+from django.db.models import F
+from django.dispatch import Signal
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+from api.models import ChangeCounter
+
+BOOKS_COUNTER = 'books'
+
+# Sent after a change counter is bumped, with the `name` of the counter.
+change_counter_bumped = Signal(providing_args=['name'])
+
+
+def get_change_counter(name):
+    """Returns the (version, modified_at) of the change counter."""
+    counter = ChangeCounter.objects.filter(name=name).values_list('version', 'modified_at').first()
+    if counter is None:
+        counter = ChangeCounter.objects.get_or_create(name=name)[0]
+        return counter.version, counter.modified_at
+    return counter
+
+
+def bump_change_counter(name):
+    """Records a change of the tables counted by the counter."""
+    updated = ChangeCounter.objects.filter(name=name).update(version=F('version') + 1, modified_at=timezone.now())
+    if not updated:
+        ChangeCounter.objects.get_or_create(name=name)
+        bump_change_counter(name)
+        return
+    change_counter_bumped.send(sender=ChangeCounter, name=name)
+
+
+class ConditionalGetMixin(object):
+    """
+    Answers the conditional GET requests of the `conditional_actions` with a
+    304 Not Modified when the change counter has not moved, before anything
+    is fetched or serialized.
+
+    The strong ETag is derived from the counter version and everything else
+    the representation depends on: the path, the query string and the
+    negotiated format. `Last-Modified` is the time of the last change. Writes
+    bump the counter from signals, so changes made with `QuerySet.update` or
+    raw SQL are not noticed.
+    """
+    change_counter_name = None
+    conditional_actions = ('list', 'retrieve')
+
+    def get_etag(self, request, version):
+        renderer_format = getattr(request, 'accepted_renderer', None) and request.accepted_renderer.format
+        key = '{0}:{1}:{2}:{3}'.format(version, request.path, request.META.get('QUERY_STRING', ''), renderer_format)
+        return quote_etag(hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def initial(self, request, *args, **kwargs):
+        super(ConditionalGetMixin, self).initial(request, *args, **kwargs)
+        self.etag = self.last_modified = self.change_version = None
+        if request.method in ('GET', 'HEAD') and self.action in self.conditional_actions:
+            version, modified_at = get_change_counter(self.change_counter_name)
+            self.change_version = version
+            self.etag = self.get_etag(request, version)
+            self.last_modified = timegm(modified_at.utctimetuple())
+
+    def get_conditional_response(self, request):
+        """
+        Returns the 304 response if the client has the current representation,
+        the 412 response if a precondition fails, or None otherwise.
+        """
+        if self.etag is None:
+            return None
+        response = get_conditional_response(request, etag=self.etag, last_modified=self.last_modified)
+        if response is not None and response.status_code == 304:
+            self.set_validators(response)
+        return response
+
+    def set_validators(self, response):
+        response['ETag'] = self.etag
+        response['Last-Modified'] = http_date(self.last_modified)
+        return response
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super(ConditionalGetMixin, self).finalize_response(request, response, *args, **kwargs)
+        if getattr(self, 'etag', None) is not None and response.status_code == 200:
+            self.set_validators(response)
+        return response
@@ -0,0 +1,60 @@
+from django.db.models import Case, Value, When
+
+# SQLite builds limit a query to 999 parameters.
+MAX_QUERY_PARAMS = 900
+
+
+def chunked(values, size=MAX_QUERY_PARAMS):
+    """Yields the values in lists of at most `size` items."""
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def filter_in(queryset, field, values):
+    """
+    Returns the objects of the queryset whose `field` is in `values`, in as
+    few `IN` queries as the database allows.
+    """
+    objects = []
+    for values_chunk in chunked(set(values)):
+        objects.extend(queryset.filter(**{'{0}__in'.format(field): values_chunk}))
+    return objects
+
+
+def bulk_create_with_pks(model, objs, lookup_field):
+    """
+    Inserts the objects with bulk queries and sets their primary keys.
+
+    Only PostgreSQL returns the ids of bulk inserted rows, on the other
+    backends they are fetched by the unique `lookup_field`.
+    """
+    objs = model.objects.bulk_create(objs)
+    if objs and objs[0].pk is None:
+        pks = {}
+        for values_chunk in chunked([getattr(obj, lookup_field) for obj in objs]):
+            pks.update(
+                model.objects.filter(**{'{0}__in'.format(lookup_field): values_chunk})
+                .values_list(lookup_field, 'pk')
+            )
+        for obj in objs:
+            obj.pk = pks[getattr(obj, lookup_field)]
+    return objs
+
+
+def bulk_update(model, objs, fields, batch_size=None):
+    """
+    Updates the fields of the objects with one `UPDATE ... CASE` query per
+    batch, like QuerySet.bulk_update of later django versions.
+    """
+    batch_size = batch_size or max(MAX_QUERY_PARAMS // (2 * len(fields) + 1), 1)
+    opts = model._meta
+    for batch in chunked(objs, batch_size):
+        updates = {}
+        for field_name in fields:
+            field = opts.get_field(field_name)
+            updates[field.attname] = Case(
+                *[When(pk=obj.pk, then=Value(getattr(obj, field.attname), output_field=field)) for obj in batch],
+                output_field=field
+            )
+        model.objects.filter(pk__in=[obj.pk for obj in batch]).update(**updates)
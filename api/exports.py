@@ -0,0 +1,57 @@
+import json
+
+from rest_framework.utils.encoders import JSONEncoder
+
+from api.api_utils import get_response_status_info
+from api.pagination import get_ordering_values, is_ordered_by_extra, keyset_filter
+
+
+def iter_queryset_chunks(queryset, ordering, chunk_size=1000):
+    """
+    Yields the queryset in chunks of `chunk_size` model instances.
+
+    Every chunk is a separate keyset query on the unique `ordering`, so the
+    `select_related` and `prefetch_related` of the queryset still apply
+    (unlike `QuerySet.iterator()` which ignores prefetches) and only one
+    chunk is held in memory at a time.
+    """
+    if is_ordered_by_extra(queryset):
+        raise ValueError('The chunks can not keep an ordering by extra selects.')
+    queryset = queryset.order_by(*ordering)
+    chunk_queryset = queryset
+    while True:
+        chunk = list(chunk_queryset[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        if len(chunk) < chunk_size:
+            return
+        chunk_queryset = queryset.filter(keyset_filter(ordering, get_ordering_values(chunk[-1], ordering)))
+
+
+def iter_serialized(queryset, serializer_class, ordering, chunk_size=1000, context=None, **serializer_kwargs):
+    """Yields the serialized representation of every object in the queryset."""
+    for chunk in iter_queryset_chunks(queryset, ordering, chunk_size=chunk_size):
+        serializer = serializer_class(chunk, many=True, context=context, **serializer_kwargs)
+        for item in serializer.data:
+            yield item
+
+
+def stream_json(items, status_code=200):
+    """
+    Yields the items encoded as the usual `{'data': [...]}` response envelope
+    piece by piece.
+    """
+    encoder = JSONEncoder()
+    yield '{"data": ['
+    for index, item in enumerate(items):
+        yield (',' if index else '') + encoder.encode(item)
+    yield '], '
+    yield json.dumps(get_response_status_info(status_code))[1:]
+
+
+def stream_ndjson(items):
+    """Yields the items encoded as newline delimited json."""
+    encoder = JSONEncoder()
+    for item in items:
+        yield encoder.encode(item) + '\n'
@@ -1,14 +1,41 @@
+from datetime import date
+
 from django_filters.rest_framework import CharFilter, FilterSet, NumberFilter
 
 from api.models import Book
+from api.search import get_search_backend
 
 
 class BookFilter(FilterSet):
     """Custom filter which provides data filtration per field for book model."""
 
-    release_date = NumberFilter(field_name='release_date', lookup_expr='year')
+    release_date = NumberFilter(field_name='release_date', method='filter_release_year')
     publisher = CharFilter(field_name='publisher', lookup_expr='name')
+    q = CharFilter(method='filter_search')
 
     class Meta:
         model = Book
         fields = ['name', 'isbn']
+
+    @staticmethod
+    def filter_release_year(queryset, name, value):
+        """
+        Filters the books released in the year with a date range, which unlike
+        a year extraction can be answered from the release date index.
+        """
+        try:
+            year_start, next_year_start = date(int(value), 1, 1), date(int(value) + 1, 1, 1)
+        except (OverflowError, ValueError):
+            return queryset.none()
+        return queryset.filter(**{
+            '{0}__gte'.format(name): year_start,
+            '{0}__lt'.format(name): next_year_start,
+        })
+
+    @staticmethod
+    def filter_search(queryset, name, value):
+        """
+        Narrows the books to the ones matching the words of the query in
+        their name or the names of their authors, best matches first.
+        """
+        return get_search_backend().search(queryset, value)
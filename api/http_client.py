@@ -0,0 +1,253 @@
+import asyncio
+import os
+import threading
+import time
+import weakref
+
+import requests
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+DEFAULT_BOOK_STORE_HTTP = {
+    'CONNECT_TIMEOUT': 3.05,
+    'READ_TIMEOUT': 10,
+    'MAX_RETRIES': 2,
+    'BACKOFF_FACTOR': 0.3,
+    'RETRY_STATUSES': (502, 503, 504),
+    'POOL_CONNECTIONS': 10,
+    'POOL_MAXSIZE': 20,
+    'FAILURE_THRESHOLD': 5,
+    'RECOVERY_TIMEOUT': 30,
+}
+
+_sessions = {}
+_async_clients = weakref.WeakKeyDictionary()
+_circuit_breakers = {}
+_lock = threading.Lock()
+
+
+def get_http_options():
+    """Returns the http options of the book stores merged with the defaults."""
+    return dict(DEFAULT_BOOK_STORE_HTTP, **getattr(settings, 'BOOK_STORE_HTTP', {}))
+
+
+def get_timeout():
+    """Returns the (connect, read) timeout for the book store requests."""
+    options = get_http_options()
+    return options['CONNECT_TIMEOUT'], options['READ_TIMEOUT']
+
+
+class CircuitOpenError(requests.RequestException):
+    """Raised instead of making a request while the circuit of the upstream is open."""
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker for an upstream service.
+
+    After `failure_threshold` consecutive failures the circuit opens and
+    requests fail immediately. Once `recovery_timeout` seconds have passed a
+    single trial request is let through, closing the circuit again if it
+    succeeds.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, failure_threshold=5, recovery_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def before_request(self):
+        """Raises CircuitOpenError if the request should not be made."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.recovery_timeout:
+                self.state = self.HALF_OPEN
+                return
+        raise CircuitOpenError('The circuit of {0} is open'.format(self.name))
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+    def record_cancel(self):
+        """
+        Records a request cancelled before the upstream answered. It tells
+        nothing of the upstream, only a cancelled trial request opens the
+        circuit again so that the next one is let through after the recovery
+        timeout.
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+
+def create_session():
+    """Creates a keep-alive session with a connection pool and retries."""
+    options = get_http_options()
+    retry = Retry(
+        total=options['MAX_RETRIES'],
+        backoff_factor=options['BACKOFF_FACTOR'],
+        status_forcelist=options['RETRY_STATUSES'],
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=options['POOL_CONNECTIONS'],
+        pool_maxsize=options['POOL_MAXSIZE'],
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """
+    Returns the session shared by the book stores of this process. Sessions
+    are not shared with forked worker processes.
+    """
+    pid = os.getpid()
+    with _lock:
+        session = _sessions.get(pid)
+        if session is None:
+            _sessions.clear()
+            session = _sessions[pid] = create_session()
+        return session
+
+
+class AsyncRetryTransport(httpx.AsyncBaseTransport if httpx is not None else object):
+    """
+    httpx transport retrying the requests like the `Retry` of the sessions:
+    on connection errors, timeouts and the `statuses`, `retries` times at
+    most, backing off by `backoff_factor` from the second retry on.
+    """
+
+    def __init__(self, transport, retries=2, backoff_factor=0.3, statuses=()):
+        self.transport = transport
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.statuses = statuses
+
+    def get_backoff_time(self, retry):
+        if retry < 2:
+            return 0
+        return self.backoff_factor * (2 ** (retry - 1))
+
+    async def handle_async_request(self, request):
+        for retry in range(self.retries + 1):
+            await asyncio.sleep(self.get_backoff_time(retry))
+            try:
+                response = await self.transport.handle_async_request(request)
+            except (httpx.TimeoutException, httpx.NetworkError):
+                if retry == self.retries:
+                    raise
+                continue
+            if response.status_code not in self.statuses or retry == self.retries:
+                return response
+            await response.aclose()
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def create_async_client():
+    """Creates a keep-alive httpx client with a connection pool and retries."""
+    options = get_http_options()
+    transport = httpx.AsyncHTTPTransport(
+        limits=httpx.Limits(
+            max_connections=options['POOL_MAXSIZE'],
+            max_keepalive_connections=options['POOL_CONNECTIONS'],
+        ),
+    )
+    transport = AsyncRetryTransport(
+        transport,
+        retries=options['MAX_RETRIES'],
+        backoff_factor=options['BACKOFF_FACTOR'],
+        statuses=options['RETRY_STATUSES'],
+    )
+    timeout = httpx.Timeout(options['READ_TIMEOUT'], connect=options['CONNECT_TIMEOUT'])
+    return httpx.AsyncClient(transport=transport, timeout=timeout)
+
+
+def get_async_client(loop):
+    """
+    Returns the httpx client shared by the book stores running on the event
+    loop. httpx clients can not be shared between event loops.
+    """
+    with _lock:
+        client = _async_clients.get(loop)
+        if client is None:
+            client = _async_clients[loop] = create_async_client()
+        return client
+
+
+def get_circuit_breaker(name):
+    """Returns the process wide circuit breaker of the upstream `name`."""
+    with _lock:
+        circuit_breaker = _circuit_breakers.get(name)
+        if circuit_breaker is None:
+            options = get_http_options()
+            circuit_breaker = _circuit_breakers[name] = CircuitBreaker(
+                name,
+                failure_threshold=options['FAILURE_THRESHOLD'],
+                recovery_timeout=options['RECOVERY_TIMEOUT'],
+            )
+        return circuit_breaker
+
+
+def close_async_client(loop, client):
+    """
+    Closes the httpx client on its event loop, right away if the loop is
+    idle or as soon as it gets to it if running.
+    """
+    if loop.is_closed():
+        return
+    if loop.is_running():
+        loop.call_soon_threadsafe(loop.create_task, client.aclose())
+    else:
+        loop.run_until_complete(client.aclose())
+
+
+def reset_http_clients():
+    """Closes the sessions and the httpx clients and resets the circuit breakers."""
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+        async_clients = list(_async_clients.items())
+        _async_clients.clear()
+        _circuit_breakers.clear()
+    for loop, client in async_clients:
+        close_async_client(loop, client)
+
+
+@receiver(setting_changed)
+def reset_http_clients_on_setting_changed(setting, **kwargs):
+    if setting == 'BOOK_STORE_HTTP':
+        reset_http_clients()
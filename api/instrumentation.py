@@ -0,0 +1,255 @@
+import asyncio
+import random
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import wraps
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connections
+from django.dispatch import receiver
+
+DEFAULT_API_METRICS = {
+    'ENABLED': True,
+    'SAMPLE_RATE': 1.0,
+    'SERVER_TIMING': True,
+    'DURATION_BUCKETS': (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    'QUERY_COUNT_BUCKETS': (1, 2, 5, 10, 20, 50, 100, 200, 500),
+    'ALLOWED_IPS': (),
+}
+
+# Timings recorded per request, with their Server-Timing names and
+# descriptions, in the order of the header.
+TIMINGS = OrderedDict([
+    ('db', 'Database'),
+    ('serializer', 'Serialization'),
+    ('upstream', 'Book stores'),
+    ('total', 'Total'),
+])
+
+_local = threading.local()
+
+
+def get_metrics_options():
+    """Returns the instrumentation options merged with the defaults."""
+    return dict(DEFAULT_API_METRICS, **getattr(settings, 'API_METRICS', {}))
+
+
+def get_request_metrics():
+    """Returns the metrics of the sampled request handled by this thread, or None."""
+    return getattr(_local, 'metrics', None)
+
+
+class RequestMetrics(object):
+    """Query count and timings of a sampled request."""
+
+    def __init__(self):
+        self.view = None
+        self.query_count = 0
+        self.timings = dict.fromkeys(TIMINGS, 0.0)
+
+    def add_time(self, name, seconds):
+        self.timings[name] += seconds
+
+    def get_server_timing(self):
+        """Returns the value of the Server-Timing header, durations in milliseconds."""
+        entries = []
+        for name, description in TIMINGS.items():
+            if name == 'db':
+                description = '{0} queries'.format(self.query_count)
+            entries.append('{0};dur={1:.1f};desc="{2}"'.format(name, self.timings[name] * 1000, description))
+        return ', '.join(entries)
+
+
+class record_time(object):
+    """
+    Adds the time spent in the block, or the decorated function, to a timing
+    of the current request. Outside of a sampled request it does nothing.
+    A decorated coroutine function is timed until its coroutine returns.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.metrics = None
+        self.started_at = None
+
+    def __enter__(self):
+        self.metrics = get_request_metrics()
+        if self.metrics is not None:
+            self.started_at = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        if self.metrics is not None:
+            self.metrics.add_time(self.name, time.perf_counter() - self.started_at)
+            self.metrics = None
+
+    def __call__(self, func):
+        name = self.name
+
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with record_time(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with record_time(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+class Histogram(object):
+    """Cumulative histogram in the Prometheus sense."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get_samples(self):
+        """Yields the (le, cumulative count) of the buckets, ending with +Inf."""
+        cumulative = 0
+        for bucket, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            yield bucket, cumulative
+
+
+class MetricsRegistry(object):
+    """In process histograms of the request metrics by view."""
+    metrics = OrderedDict([
+        ('api_request_duration_seconds', ('total', 'Latency of the requests.')),
+        ('api_db_duration_seconds', ('db', 'Time spent in database queries per request.')),
+        ('api_serializer_duration_seconds', ('serializer', 'Time spent serializing per request.')),
+        ('api_upstream_duration_seconds', ('upstream', 'Time spent fetching from the book stores per request.')),
+        ('api_db_queries', ('query_count', 'Database queries per request.')),
+    ])
+
+    def __init__(self, duration_buckets, query_count_buckets):
+        self.duration_buckets = duration_buckets
+        self.query_count_buckets = query_count_buckets
+        self.histograms = {metric: {} for metric in self.metrics}
+        self._lock = threading.Lock()
+
+    def observe(self, request_metrics):
+        with self._lock:
+            for metric, (source, __) in self.metrics.items():
+                histograms = self.histograms[metric]
+                histogram = histograms.get(request_metrics.view)
+                if histogram is None:
+                    buckets = self.query_count_buckets if source == 'query_count' else self.duration_buckets
+                    histogram = histograms[request_metrics.view] = Histogram(buckets)
+                if source == 'query_count':
+                    histogram.observe(request_metrics.query_count)
+                else:
+                    histogram.observe(request_metrics.timings[source])
+
+    def clear(self):
+        with self._lock:
+            self.histograms = {metric: {} for metric in self.metrics}
+
+    def render(self):
+        """Renders the histograms in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for metric, (__, help_text) in self.metrics.items():
+                lines.append('# HELP {0} {1}'.format(metric, help_text))
+                lines.append('# TYPE {0} histogram'.format(metric))
+                for view, histogram in sorted(self.histograms[metric].items()):
+                    labels = 'view="{0}"'.format(view.replace('\\', '\\\\').replace('"', '\\"'))
+                    for bucket, count in histogram.get_samples():
+                        lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(metric, labels, bucket, count))
+                    lines.append('{0}_sum{{{1}}} {2}'.format(metric, labels, histogram.sum))
+                    lines.append('{0}_count{{{1}}} {2}'.format(metric, labels, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_metrics_registry():
+    """Returns the process wide metrics registry."""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            options = get_metrics_options()
+            _registry = MetricsRegistry(options['DURATION_BUCKETS'], options['QUERY_COUNT_BUCKETS'])
+        return _registry
+
+
+@receiver(setting_changed)
+def reset_metrics_registry(setting, **kwargs):
+    """Rebuilds the registry when the instrumentation settings are overridden, e.g. in tests."""
+    global _registry
+    if setting == 'API_METRICS':
+        with _registry_lock:
+            _registry = None
+
+
+def get_view_name(view_func, method):
+    """Names the view, with the action for the DRF viewsets, e.g. `BookViewSet.list`."""
+    view_class = getattr(view_func, 'cls', None)
+    if view_class is None:
+        return '{0}.{1}'.format(view_func.__module__, view_func.__name__)
+    actions = getattr(view_func, 'actions', None) or {}
+    return '{0}.{1}'.format(view_class.__name__, actions.get(method.lower(), method.lower()))
+
+
+class MetricsMiddleware(object):
+    """
+    Records the query count, the database, serializer, book store and total
+    times of a sample of the requests.
+
+    The sampled responses get a `Server-Timing` header and their metrics are
+    added to the histograms exported by the metrics endpoint. The queries
+    are recorded with django's debug cursor for the sampled requests only,
+    so the other requests do not pay for the instrumentation. The body of a
+    streaming response is produced after the request is recorded.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        options = get_metrics_options()
+        if not options['ENABLED'] or random.random() >= options['SAMPLE_RATE']:
+            return self.get_response(request)
+
+        metrics = _local.metrics = RequestMetrics()
+        debug_cursors = [(connection, connection.force_debug_cursor) for connection in connections.all()]
+        query_log_starts = []
+        for connection, __ in debug_cursors:
+            connection.force_debug_cursor = True
+            query_log_starts.append(len(connection.queries_log))
+        started_at = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.add_time('total', time.perf_counter() - started_at)
+            for (connection, force_debug_cursor), start in zip(debug_cursors, query_log_starts):
+                connection.force_debug_cursor = force_debug_cursor
+                queries = list(connection.queries_log)[start:]
+                metrics.query_count += len(queries)
+                metrics.add_time('db', sum(float(query['time']) for query in queries))
+            _local.metrics = None
+
+        if metrics.view is not None:
+            get_metrics_registry().observe(metrics)
+            if options['SERVER_TIMING']:
+                response['Server-Timing'] = metrics.get_server_timing()
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        metrics = get_request_metrics()
+        if metrics is not None:
+            metrics.view = get_view_name(view_func, request.method)
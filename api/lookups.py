@@ -0,0 +1,179 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+
+from api.db_utils import filter_in
+from api.models import Author, Country, Publisher
+
+DEFAULT_REFERENCE_CACHE = {
+    'ENABLED': True,
+    'CACHE_ALIAS': 'default',
+    'MAX_AGE': 300,
+}
+
+
+def get_reference_cache_options():
+    """Returns the reference cache options merged with the defaults."""
+    return dict(DEFAULT_REFERENCE_CACHE, **getattr(settings, 'REFERENCE_CACHE', {}))
+
+
+class ReferenceCache(object):
+    """
+    Process local cache of the instances of a small reference model by name.
+
+    The countries, publishers and authors are looked up by name over and over
+    while they rarely change, so they are kept in memory once fetched. Saving
+    or deleting an instance bumps the version of the model in django's cache
+    and clears the local instances. Other processes compare their version with
+    the shared one when a request starts and clear theirs if it has moved,
+    the versions of all the models are read at once. On a cache local to
+    the process, e.g. the LocMemCache, the changes made by the other
+    processes are only picked up once the local instances are dropped,
+    after `max_age` seconds.
+
+    Only instances which exist are cached, so creating an instance does not
+    invalidate the cache. Changes made with `QuerySet.update` send no
+    signals and are not picked up.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.version_key = 'reference-cache:{0}:version'.format(model._meta.label_lower)
+        self.version = None
+        self.options = None
+        self.expires_at = 0
+        self._instances = {}
+        self._lock = threading.Lock()
+
+    def get_options(self):
+        if self.options is None:
+            self.options = get_reference_cache_options()
+        return self.options
+
+    @property
+    def enabled(self):
+        return self.get_options()['ENABLED']
+
+    @property
+    def cache(self):
+        return caches[self.get_options()['CACHE_ALIAS']]
+
+    def get_shared_version(self):
+        # Starting from the time rather than 1 keeps a version key evicted
+        # from the cache from coming back to a version seen before.
+        self.cache.add(self.version_key, int(time.time() * 1000), None)
+        return self.cache.get(self.version_key)
+
+    def sync(self, version=None):
+        """
+        Clears the local instances if the model changed in another process.
+        `version` is the shared version if already read.
+        """
+        if not self.enabled:
+            return
+        if version is None:
+            version = self.get_shared_version()
+        with self._lock:
+            if version != self.version:
+                self._instances = {}
+                self.version = version
+
+    def invalidate(self):
+        """Bumps the shared version and clears the local instances."""
+        if not self.enabled:
+            return
+        try:
+            version = self.cache.incr(self.version_key)
+        except ValueError:
+            version = None
+        with self._lock:
+            self._instances = {}
+            self.version = version
+
+    def clear(self):
+        with self._lock:
+            self._instances = {}
+            self.version = None
+            self.options = None
+            self.expires_at = 0
+
+    def get_instances(self):
+        """Returns the local instances, dropped once older than the max age."""
+        if time.time() >= self.expires_at:
+            with self._lock:
+                self._instances = {}
+                self.expires_at = time.time() + self.get_options()['MAX_AGE']
+        return self._instances
+
+    def remember(self, instance):
+        if self.enabled:
+            self.get_instances().setdefault(instance.name, instance)
+
+    def get(self, name):
+        """Returns the instance with the name or raises DoesNotExist."""
+        instance = self.get_instances().get(name) if self.enabled else None
+        if instance is None:
+            instance = self.model.objects.filter(name=name).order_by('pk').first()
+            if instance is None:
+                raise self.model.DoesNotExist(name)
+            self.remember(instance)
+        return instance
+
+    def get_or_create(self, name):
+        """
+        Returns the instance with the name, creating it if it does not exist.
+        A created instance is remembered once its transaction commits.
+        """
+        try:
+            return self.get(name)
+        except self.model.DoesNotExist:
+            instance = self.model.objects.create(name=name)
+            transaction.on_commit(lambda: self.remember(instance))
+            return instance
+
+    def get_many(self, names):
+        """Returns a name to instance map for the names, fetching the unknown ones at once."""
+        local_instances = self.get_instances() if self.enabled else {}
+        instances = {}
+        missing_names = set()
+        for name in names:
+            instance = local_instances.get(name)
+            if instance is None:
+                missing_names.add(name)
+            else:
+                instances[name] = instance
+        for instance in filter_in(self.model.objects.order_by('pk'), 'name', missing_names):
+            instances.setdefault(instance.name, instance)
+        for instance in instances.values():
+            self.remember(instance)
+        return instances
+
+
+reference_caches = {model: ReferenceCache(model) for model in (Country, Publisher, Author)}
+
+
+def sync_reference_caches():
+    """Syncs the reference caches, reading the shared versions with a single cache call."""
+    enabled_caches = [reference_cache for reference_cache in reference_caches.values() if reference_cache.enabled]
+    if not enabled_caches:
+        return
+    versions = enabled_caches[0].cache.get_many([reference_cache.version_key for reference_cache in enabled_caches])
+    for reference_cache in enabled_caches:
+        reference_cache.sync(versions.get(reference_cache.version_key))
+
+
+def clear_reference_caches():
+    for reference_cache in reference_caches.values():
+        reference_cache.clear()
+
+
+@receiver(setting_changed)
+def reset_reference_caches(setting, **kwargs):
+    """Clears the reference caches when their settings are overridden, e.g. in tests."""
+    if setting in ('REFERENCE_CACHE', 'CACHES'):
+        clear_reference_caches()
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from api.changes import compact_book_changes, get_book_changes_options
+
+
+class Command(BaseCommand):
+    """
+    This command will compact the change log served by /v1/books/changes/.
+
+    The entries older than COMPACT_AFTER seconds superseded by a later
+    entry of the same book are deleted, but for the creations of the
+    existing books, the clients lose nothing. The
+    entries older than RETENTION seconds are all deleted, the clients with
+    an older cursor have to list the books again. Both default to the
+    `BOOK_CHANGES` setting. Run it periodically, e.g. from cron.
+
+    EXAMPLE USAGE:
+        ./manage.py compact_book_changes
+        ./manage.py compact_book_changes --compact_after=3600 --retention=604800
+    """
+
+    help = "Compact the change log of the books"
+
+    def add_arguments(self, parser):
+        options = get_book_changes_options()
+        parser.add_argument(
+            '--compact_after',
+            type=int,
+            default=options['COMPACT_AFTER'],
+            dest='compact_after',
+            help="age in seconds of the superseded entries to delete"
+        )
+        parser.add_argument(
+            '--retention',
+            type=int,
+            default=options['RETENTION'],
+            dest='retention',
+            help="age in seconds of the entries to delete, 0 keeps them"
+        )
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        compacted, truncated = compact_book_changes(
+            now - timedelta(seconds=options['compact_after']),
+            now - timedelta(seconds=options['retention']) if options['retention'] else None,
+        )
+        self.stdout.write(self.style.SUCCESS(
+            'Book changes compacted: {0} superseded and {1} expired entries deleted'.format(compacted, truncated)
+        ))
@@ -1,13 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import random
+import time
 import uuid
 from datetime import datetime
 
 from dateutil.relativedelta import relativedelta
 from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
 
-from api.models import Author, Book, Country, Publisher
+from api.db_utils import bulk_create_with_pks
+from api.models import Author, Book, BookChange, Country, Publisher
+from api.signals import books_changed
 
 
 class Command(BaseCommand):
@@ -22,13 +26,25 @@ class Command(BaseCommand):
         ./manage.py generate_books --batch_size=100
     OR
         ./manage.py generate_books
+    OR
+        ./manage.py generate_books --batch_size=1000000 --bulk --chunk_size=1000
 
     If batch size is not provided, the command will generate 10 books
 
+    In bulk mode the publishers, countries and authors are resolved once and
+    the books and their authors are inserted with bulk queries, one
+    transaction per chunk of books.
     """
 
     help = "Populate books model with random data"
 
+    publisher_names = ['DestinationPakistan', 'Traverse', 'IBNFreaks']
+    country_names = [
+        'Pakistan', 'United States', 'Morocco', 'Turkey', 'United Kingdom',
+        'Australia', 'New Zealand'
+    ]
+    author_names = ['Awais Jibran', 'Adeva', 'A.R. Akram', 'Rehman G']
+
     def add_arguments(self, parser):
         """
         Defining the arguments to be used by the command.
@@ -40,30 +56,34 @@ class Command(BaseCommand):
             dest='batch_size',
             help="number to books to generate"
         )
+        parser.add_argument(
+            '--bulk',
+            action='store_true',
+            dest='bulk',
+            help="insert the books with bulk queries"
+        )
+        parser.add_argument(
+            '--chunk_size',
+            type=int,
+            default=500,
+            dest='chunk_size',
+            help="number of books to insert per transaction in bulk mode"
+        )
 
-    @staticmethod
-    def get_random_publisher():
+    def get_random_publisher(self):
         """Get a random publisher instance"""
-        publishers = ['DestinationPakistan', 'Traverse', 'IBNFreaks']
-        publisher, __ = Publisher.objects.get_or_create(name=random.choice(publishers))
+        publisher, __ = Publisher.objects.get_or_create(name=random.choice(self.publisher_names))
         return publisher
 
-    @staticmethod
-    def get_random_country():
+    def get_random_country(self):
         """Get a random country instance"""
-        country_names = [
-            'Pakistan', 'United States', 'Morocco', 'Turkey', 'United Kingdom',
-            'Australia', 'New Zealand'
-        ]
-        country, __ = Country.objects.get_or_create(name=random.choice(country_names))
+        country, __ = Country.objects.get_or_create(name=random.choice(self.country_names))
         return country
 
-    @staticmethod
-    def get_random_authors():
+    def get_random_authors(self):
         """Get random list of authors from some pre-defined authors set"""
-        authors = ['Awais Jibran', 'Adeva', 'A.R. Akram', 'Rehman G']
         author_instances = []
-        for author in random.sample(authors, random.choice(range(0, 3))):
+        for author in random.sample(self.author_names, random.choice(range(0, 3))):
             author, __ = Author.objects.get_or_create(name=author)
             author_instances.append(author)
         return author_instances
@@ -74,11 +94,68 @@ class Command(BaseCommand):
         relative_month = random.choice(range(-36, 36))
         return datetime.now() + relativedelta(months=relative_month)
 
+    @staticmethod
+    def get_or_create_all(model, names):
+        """Get or create the instances of a lookup model for all the names at once."""
+        instances = {instance.name: instance for instance in model.objects.filter(name__in=names)}
+        missing_names = [name for name in names if name not in instances]
+        if missing_names:
+            model.objects.bulk_create([model(name=name) for name in missing_names])
+            instances.update({instance.name: instance for instance in model.objects.filter(name__in=missing_names)})
+        return [instances[name] for name in names]
+
+    def create_books_chunk(self, first_number, count, countries, publishers, authors):
+        """Inserts a chunk of books along with their authors in one transaction."""
+        books = [
+            Book(
+                name="Book: {}".format(number),
+                isbn='BNF-{}'.format(uuid.uuid4()),
+                country=random.choice(countries),
+                publisher=random.choice(publishers),
+                number_of_pages=random.choice(range(100, 1000)),
+                release_date=self.get_random_release_date()
+            )
+            for number in range(first_number, first_number + count)
+        ]
+        with transaction.atomic():
+            bulk_create_with_pks(Book, books, 'isbn')
+
+            BookAuthor = Book.authors.through
+            BookAuthor.objects.bulk_create([
+                BookAuthor(book_id=book.pk, author_id=author.pk)
+                for book in books
+                for author in random.sample(authors, random.choice(range(0, 3)))
+            ])
+            books_changed([book.pk for book in books], BookChange.CREATED)
+
+    def generate_books_in_bulk(self, batch_size, chunk_size):
+        """Generate the books chunk by chunk and report the throughput."""
+        started_at = time.time()
+        countries = self.get_or_create_all(Country, self.country_names)
+        publishers = self.get_or_create_all(Publisher, self.publisher_names)
+        authors = self.get_or_create_all(Author, self.author_names)
+
+        for first_number in range(0, batch_size, chunk_size):
+            count = min(chunk_size, batch_size - first_number)
+            try:
+                self.create_books_chunk(first_number, count, countries, publishers, authors)
+            except Exception as e:
+                raise CommandError('Error Saving Books {}-{}\n{}'.format(
+                    first_number, first_number + count - 1, e))
+            self.stdout.write('Books Created: {}/{}'.format(first_number + count, batch_size))
+
+        elapsed = time.time() - started_at
+        self.stdout.write(self.style.SUCCESS('{} books created in {:.2f}s ({:.0f} books/s)'.format(
+            batch_size, elapsed, batch_size / elapsed if elapsed else batch_size)))
+
     def handle(self, *args, **options):
         """
         Generate books based on the input.
         """
         batch_size = options['batch_size']
+        if options['bulk']:
+            return self.generate_books_in_bulk(batch_size, options['chunk_size'])
+
         for count in range(0, batch_size):
             book = Book(
                 name="Book: {}".format(count),
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.search import get_search_backend
+
+
+class Command(BaseCommand):
+    """
+    This command will re-index all the books for the `?q=` search.
+
+    The index is kept up to date on writes, rebuilding it is only needed
+    after the books or authors were changed without signals, e.g. with
+    `QuerySet.update` or raw SQL.
+
+    EXAMPLE USAGE:
+        ./manage.py rebuild_search_index
+    """
+
+    help = "Rebuild the full text search index of the books"
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            get_search_backend().rebuild()
+        self.stdout.write(self.style.SUCCESS('Search index rebuilt'))
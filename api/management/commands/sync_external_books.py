@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.mirror import MirrorSyncError, sync_external_books
+
+
+class Command(BaseCommand):
+    """
+    This command will mirror the external books catalog into the local database.
+
+    The books are diffed with the mirror by isbn and only the new, changed
+    and removed books are written. `LocalMirrorStore` answers the external
+    books queries from the mirror. Run it periodically, e.g. from cron, or
+    set `EXTERNAL_BOOKS_MIRROR['SYNC_INTERVAL']` to sync in the serving
+    processes.
+
+    EXAMPLE USAGE:
+        ./manage.py sync_external_books
+    """
+
+    help = "Mirror the external books catalog into the local database"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch_size',
+            type=int,
+            default=500,
+            dest='batch_size',
+            help="number of books to insert per query"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            stats = sync_external_books(batch_size=options['batch_size'])
+        except MirrorSyncError as e:
+            raise CommandError('Error Syncing External Books\n{}'.format(e))
+        self.stdout.write(self.style.SUCCESS(
+            'External books synced: {created} created, {updated} updated, '
+            '{deleted} deleted, {unchanged} unchanged'.format(**stats)
+        ))
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class RunSQLForVendor(migrations.RunSQL):
+    """RunSQL applied only on the databases of the `vendor`."""
+
+    def __init__(self, vendor, *args, **kwargs):
+        self.vendor = vendor
+        super(RunSQLForVendor, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, args, kwargs = super(RunSQLForVendor, self).deconstruct()
+        return name, [self.vendor] + list(args), kwargs
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == self.vendor:
+            super(RunSQLForVendor, self).database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == self.vendor:
+            super(RunSQLForVendor, self).database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+DROP_SEARCH_INDEX = 'DROP TABLE IF EXISTS api_book_search'
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_book_filter_indexes'),
+    ]
+
+    operations = [
+        RunSQLForVendor(
+            'sqlite',
+            sql=[
+                "CREATE VIRTUAL TABLE api_book_search USING fts5(name, authors, tokenize = 'unicode61')",
+                "INSERT INTO api_book_search (rowid, name, authors) "
+                "SELECT b.id, b.name, COALESCE(("
+                "    SELECT group_concat(a.name, ' ') FROM api_book_authors ba "
+                "    INNER JOIN api_author a ON a.id = ba.author_id WHERE ba.book_id = b.id"
+                "), '') FROM api_book b",
+            ],
+            reverse_sql=[DROP_SEARCH_INDEX],
+        ),
+        RunSQLForVendor(
+            'postgresql',
+            sql=[
+                'CREATE TABLE api_book_search ('
+                '    book_id integer PRIMARY KEY REFERENCES api_book (id)'
+                '        ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,'
+                '    document tsvector NOT NULL'
+                ')',
+                'CREATE INDEX api_book_search_document ON api_book_search USING GIN (document)',
+                "INSERT INTO api_book_search (book_id, document) "
+                "SELECT b.id, setweight(to_tsvector('simple', b.name), 'A') "
+                "|| setweight(to_tsvector('simple', COALESCE(("
+                "    SELECT string_agg(a.name, ' ') FROM api_book_authors ba "
+                "    INNER JOIN api_author a ON a.id = ba.author_id WHERE ba.book_id = b.id"
+                "), '')), 'B') FROM api_book b",
+            ],
+            reverse_sql=[DROP_SEARCH_INDEX],
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 15:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_change_counter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MirroredBook',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('isbn', models.CharField(max_length=50, unique=True)),
+                ('name', models.CharField(db_index=True, max_length=255)),
+                ('authors', models.TextField(default='[]', help_text='JSON list of the author names.')),
+                ('number_of_pages', models.IntegerField(null=True)),
+                ('publisher', models.CharField(max_length=255, null=True)),
+                ('country', models.CharField(max_length=255, null=True)),
+                ('release_date', models.DateField(null=True)),
+                ('synced_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+    ]
@@ -0,0 +1,190 @@
+import json
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from api.db_utils import bulk_update, chunked
+from api.models import MirroredBook
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EXTERNAL_BOOKS_MIRROR = {
+    'UPSTREAM': 'api.book_stores.IceAndFireStore',
+    'SYNC_INTERVAL': None,
+    'LOCK_CACHE_ALIAS': 'default',
+}
+
+# Fields of the mirrored books compared with the upstream on sync.
+MIRRORED_FIELDS = ('name', 'authors', 'number_of_pages', 'publisher', 'country', 'release_date')
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+class MirrorSyncError(Exception):
+    """Raised when the upstream does not give the complete catalog."""
+
+
+def get_mirror_options():
+    return dict(DEFAULT_EXTERNAL_BOOKS_MIRROR, **getattr(settings, 'EXTERNAL_BOOKS_MIRROR', {}))
+
+
+def get_mirrored_fields(book):
+    """Returns the values of the mirrored fields of a book in the external books representation."""
+    release_date = book.get('release_date')
+    return {
+        'name': book.get('name') or '',
+        'authors': json.dumps(book.get('authors') or []),
+        'number_of_pages': book.get('number_of_pages'),
+        'publisher': book.get('publisher'),
+        'country': book.get('country'),
+        'release_date': datetime.strptime(release_date, '%Y-%m-%d').date() if release_date else None,
+    }
+
+
+def to_representation(row):
+    """Returns the external books representation of a mirrored book given as a values() dict."""
+    return {
+        'name': row['name'],
+        'isbn': row['isbn'],
+        'authors': json.loads(row['authors']),
+        'number_of_pages': row['number_of_pages'],
+        'publisher': row['publisher'],
+        'country': row['country'],
+        'release_date': row['release_date'].strftime('%Y-%m-%d') if row['release_date'] else None,
+    }
+
+
+def get_mirrored_books(name=None):
+    """Returns the mirrored books named `name`, or all of them, like the upstream `?name=` query."""
+    queryset = MirroredBook.objects.all()
+    if name:
+        queryset = queryset.filter(name=name)
+    return [to_representation(row) for row in queryset.values('isbn', *MIRRORED_FIELDS)]
+
+
+def sync_external_books(store=None, batch_size=500):
+    """
+    Mirrors the catalog of the upstream store into the MirroredBook table.
+
+    The upstream books are diffed with the mirror by isbn: new books are
+    inserted and changed books updated with bulk queries, books gone from
+    the upstream are deleted and unchanged books are not written at all.
+    Nothing is written unless the upstream answers successfully with its
+    whole catalog. Returns the
+    counts of the created, updated, deleted and unchanged books.
+    """
+    store = store or import_string(get_mirror_options()['UPSTREAM'])()
+    response_data = store.get_books(None)
+    if response_data.get('status') != 'success':
+        raise MirrorSyncError(response_data.get('message') or 'The upstream did not give the books.')
+    if response_data.get('truncated'):
+        # Mirroring a part of the catalog would delete the rest of it.
+        raise MirrorSyncError('The upstream has more pages than the store fetches, raise its MAX_PAGES.')
+
+    upstream_books = OrderedDict()
+    for book in response_data['data']:
+        if book.get('isbn') and book['isbn'] not in upstream_books:
+            upstream_books[book['isbn']] = get_mirrored_fields(book)
+
+    synced_at = timezone.now()
+    stats = OrderedDict([('created', 0), ('updated', 0), ('deleted', 0), ('unchanged', 0)])
+    with transaction.atomic():
+        mirrored_rows = {
+            row[0]: row[1:]
+            for row in MirroredBook.objects.select_for_update().values_list('isbn', 'pk', *MIRRORED_FIELDS)
+        }
+        created, updated = [], []
+        for isbn, fields in upstream_books.items():
+            row = mirrored_rows.pop(isbn, None)
+            if row is None:
+                created.append(MirroredBook(isbn=isbn, synced_at=synced_at, **fields))
+            elif row[1:] != tuple(fields[field] for field in MIRRORED_FIELDS):
+                updated.append(MirroredBook(pk=row[0], isbn=isbn, synced_at=synced_at, **fields))
+            else:
+                stats['unchanged'] += 1
+
+        MirroredBook.objects.bulk_create(created, batch_size=batch_size)
+        bulk_update(MirroredBook, updated, MIRRORED_FIELDS + ('synced_at',))
+        deleted_pks = [row[0] for row in mirrored_rows.values()]
+        for pks_chunk in chunked(deleted_pks):
+            MirroredBook.objects.filter(pk__in=pks_chunk).delete()
+
+    stats.update(created=len(created), updated=len(updated), deleted=len(deleted_pks))
+    return stats
+
+
+class MirrorSyncScheduler(object):
+    """
+    Syncs the mirror every `interval` seconds in a daemon thread of the
+    process, starting right away. A failed sync is logged and retried at
+    the next interval.
+
+    Each run first takes a lock in the `lock_cache_alias` cache, held for
+    the interval, and skips the sync if another process holds it. With a
+    shared cache a single process syncs per interval, a process local cache
+    does not lock the other processes out.
+    """
+    lock_key = 'external-books-mirror-sync'
+
+    def __init__(self, interval, sync=sync_external_books, lock_cache_alias='default'):
+        self.interval = interval
+        self.sync = sync
+        self.lock_cache_alias = lock_cache_alias
+        self.last_result = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name='external-books-mirror-sync')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.run_once()
+            finally:
+                connections.close_all()
+            self._stopped.wait(self.interval)
+
+    def acquire_lock(self):
+        """Whether this process may sync in the current interval."""
+        return caches[self.lock_cache_alias].add(self.lock_key, True, timeout=self.interval)
+
+    def run_once(self):
+        try:
+            if self.acquire_lock():
+                self.last_result = self.sync()
+        except Exception:
+            logger.exception('Syncing the external books mirror failed')
+
+
+def start_mirror_scheduler():
+    """
+    Starts the periodic sync of the process if
+    `EXTERNAL_BOOKS_MIRROR['SYNC_INTERVAL']` is set. Called by the WSGI and
+    ASGI applications so that only the serving processes sync.
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            options = get_mirror_options()
+            if not options['SYNC_INTERVAL']:
+                _scheduler = False
+                return
+            _scheduler = MirrorSyncScheduler(options['SYNC_INTERVAL'], lock_cache_alias=options['LOCK_CACHE_ALIAS'])
+            _scheduler.start()
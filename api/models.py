@@ -2,17 +2,18 @@
 from __future__ import unicode_literals
 
 from django.db import models
+from django.utils import timezone
 
 
 class Author(models.Model):
-    name = models.CharField(max_length=50)
+    name = models.CharField(max_length=50, db_index=True)
 
     def __unicode__(self):
         return self.name
 
 
 class Country(models.Model):
-    name = models.CharField(max_length=50)
+    name = models.CharField(max_length=50, db_index=True)
 
     class Meta:
         verbose_name_plural = 'Countries'
@@ -22,7 +23,7 @@ class Country(models.Model):
 
 
 class Publisher(models.Model):
-    name = models.CharField(max_length=50)
+    name = models.CharField(max_length=50, db_index=True)
 
     def __unicode__(self):
         return self.name
@@ -38,16 +39,88 @@ class Book(models.Model):
     release_date = models.DateField()
 
     class Meta:
-        ordering = ['name', 'release_date']
+        ordering = ['name', 'release_date', 'id']
+        indexes = [
+            # Serves the default ordering as well as the filter on name.
+            models.Index(fields=['name', 'release_date', 'id'], name='book_ordering_idx'),
+            models.Index(fields=['release_date'], name='book_release_date_idx'),
+        ]
+
+    def __unicode__(self):
+        return self.name
+
+
+class ChangeCounter(models.Model):
+    """
+    Counter of the changes made to a group of tables, e.g. `books` for the
+    books and the authors, countries and publishers rendered with them. It
+    tells cheaply whether anything changed since a response was rendered.
+    """
+    name = models.CharField(max_length=50, unique=True)
+    version = models.BigIntegerField(default=0)
+    modified_at = models.DateTimeField(default=timezone.now)
+
+    def __unicode__(self):
+        return u'{0} v{1}'.format(self.name, self.version)
+
+
+class BookChange(models.Model):
+    """
+    Entry of the change log of the books, served by the changes feed. The id
+    is the cursor of the feed. `compact_book_changes` deletes the entries
+    superseded by a later entry of the same book, but for the creations of
+    the existing books, and, past the retention, all the old entries.
+    """
+    CREATED = 'created'
+    UPDATED = 'updated'
+    DELETED = 'deleted'
+    ACTIONS = (
+        (CREATED, 'Created'),
+        (UPDATED, 'Updated'),
+        (DELETED, 'Deleted'),
+    )
+
+    # Not a foreign key, the entries of deleted books are kept.
+    book_id = models.IntegerField()
+    action = models.CharField(max_length=10, choices=ACTIONS)
+    changed_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            # Serves the latest entry per book looked up by the compaction.
+            models.Index(fields=['book_id', 'id'], name='book_change_book_idx'),
+        ]
+
+    def __unicode__(self):
+        return u'{0} {1} #{2}'.format(self.action, self.book_id, self.pk)
+
+
+class MirroredBook(models.Model):
+    """
+    Book of the external catalog mirrored by `sync_external_books`, in the
+    representation of the external books api.
+    """
+    isbn = models.CharField(max_length=50, unique=True)
+    name = models.CharField(max_length=255, db_index=True)
+    authors = models.TextField(default='[]', help_text='JSON list of the author names.')
+    number_of_pages = models.IntegerField(null=True)
+    publisher = models.CharField(max_length=255, null=True)
+    country = models.CharField(max_length=255, null=True)
+    release_date = models.DateField(null=True)
+    synced_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['id']
 
     def __unicode__(self):
         return self.name
 
 
 class ExternalBook(object):
-    data_keys = [
+    __slots__ = data_keys = (
         'name', 'isbn', 'authors', 'publisher', 'country', 'released', 'numberOfPages'
-    ]
+    )
 
     def __init__(self, **kwargs):
         for data_key in self.data_keys:
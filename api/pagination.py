@@ -0,0 +1,210 @@
+import base64
+import json
+from collections import OrderedDict
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+def get_unique_ordering(queryset):
+    """
+    Returns the ordering of the queryset with the primary key as tie breaker.
+    An ordering by extra selects, e.g. the rank of a search, is not included,
+    see `is_ordered_by_extra`.
+    """
+    ordering = list(queryset.query.order_by or queryset.model._meta.ordering)
+    if not {'id', 'pk', '-id', '-pk'}.intersection(ordering):
+        ordering.append('id')
+    return ['id' if field == 'pk' else '-id' if field == '-pk' else field for field in ordering]
+
+
+def is_ordered_by_extra(queryset):
+    """
+    Whether the queryset is ordered by extra selects, e.g. the rank of a
+    search, which the keyset filters can not page through.
+    """
+    return bool(queryset.query.extra_order_by)
+
+
+def get_ordering_values(instance, ordering):
+    """Returns the values of the ordering fields for a model instance or a `values()` row."""
+    if isinstance(instance, dict):
+        return [instance[field.lstrip('-')] for field in ordering]
+    return [getattr(instance, field.lstrip('-')) for field in ordering]
+
+
+def keyset_filter(ordering, values):
+    """
+    Constructs the filter matching the rows placed after `values` in the
+    given ordering.
+
+    For the ordering ('name', 'release_date', 'id') the filter reads
+        name > n OR (name = n AND release_date > d) OR (name = n AND release_date = d AND id > i)
+    which the database can answer from an index on the ordering fields
+    instead of scanning and discarding the preceding rows like OFFSET does.
+    """
+    keyset = Q()
+    for position, field in enumerate(ordering):
+        field_name = field.lstrip('-')
+        lookup = '{0}__{1}'.format(field_name, 'lt' if field.startswith('-') else 'gt')
+        condition = Q(**{lookup: values[position]})
+        for previous_field, previous_value in zip(ordering[:position], values[:position]):
+            condition &= Q(**{previous_field.lstrip('-'): previous_value})
+        keyset |= condition
+    return keyset
+
+
+class EnvelopePaginationMixin(object):
+    """
+    Mixin for paginators used with views which wrap the results into the
+    `{'data': [...]}` envelope themselves. The paginated response only holds
+    the page data and the view adds the pagination information, returned by
+    the `get_pagination_info()` of the paginator.
+    """
+
+    def get_paginated_response(self, data):
+        return Response(data)
+
+
+class BookPageNumberPagination(EnvelopePaginationMixin, PageNumberPagination):
+    """Page number pagination, e.g. `?page=3&page_size=20`."""
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+
+    def get_pagination_info(self):
+        return OrderedDict([
+            ('count', self.page.paginator.count),
+            ('page', self.page.number),
+            ('page_size', self.page.paginator.per_page),
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+        ])
+
+
+class KeysetPagination(EnvelopePaginationMixin, BasePagination):
+    """
+    Cursor pagination over the unique ordering of the queryset, e.g.
+    `?cursor=<token>&page_size=20`.
+
+    The cursor holds the values of the ordering fields for the last row of
+    the previous page, so fetching any page costs the same regardless of
+    how deep it is. The ordering must be unique which is why it should end
+    with the primary key.
+    """
+    cursor_query_param = 'cursor'
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+    invalid_cursor_message = 'Invalid cursor'
+    extra_ordering_message = 'The cursor pagination can not keep the order of a search, use the page number pagination.'
+
+    def __init__(self):
+        self.request = None
+        self.ordering = None
+        self.page_size_for_request = None
+        self.next_position = None
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def encode_cursor(self, values):
+        """Encodes the ordering values into an opaque url safe token."""
+        values = [value.isoformat() if hasattr(value, 'isoformat') else value for value in values]
+        return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, queryset, token):
+        """Decodes the token into the ordering values for the queryset model."""
+        try:
+            values = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+            if not isinstance(values, list) or len(values) != len(self.ordering):
+                raise ValueError(token)
+            opts = queryset.model._meta
+            return [
+                opts.get_field(field.lstrip('-')).to_python(value)
+                for field, value in zip(self.ordering, values)
+            ]
+        except Exception:
+            raise NotFound(self.invalid_cursor_message)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if is_ordered_by_extra(queryset):
+            raise ValidationError({'pagination': [self.extra_ordering_message]})
+        self.request = request
+        self.ordering = get_unique_ordering(queryset)
+        self.page_size_for_request = self.get_page_size(request)
+
+        queryset = queryset.order_by(*self.ordering)
+        token = request.query_params.get(self.cursor_query_param)
+        if token:
+            queryset = queryset.filter(keyset_filter(self.ordering, self.decode_cursor(queryset, token)))
+
+        results = list(queryset[:self.page_size_for_request + 1])
+        page = results[:self.page_size_for_request]
+        has_next = len(results) > self.page_size_for_request
+        self.next_position = get_ordering_values(page[-1], self.ordering) if has_next else None
+        return page
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.next_position))
+
+    def get_pagination_info(self):
+        return OrderedDict([
+            ('page_size', self.page_size_for_request),
+            ('next', self.get_next_link()),
+        ])
+
+
+class BookPagination(BasePagination):
+    """
+    Opt-in pagination for the books api which picks the pagination mode from
+    the query string.
+
+        ?page=2                 page number pagination
+        ?pagination=cursor      first page of the keyset pagination
+        ?cursor=<token>         following pages of the keyset pagination
+
+    Requests without any of these parameters are not paginated.
+    """
+    mode_query_param = 'pagination'
+    page_number_class = BookPageNumberPagination
+    keyset_class = KeysetPagination
+
+    def __init__(self):
+        self.paginator = None
+
+    def get_paginator(self, request):
+        """Returns the paginator for the mode requested, if any."""
+        mode = request.query_params.get(self.mode_query_param)
+        if mode == 'cursor' or self.keyset_class.cursor_query_param in request.query_params:
+            return self.keyset_class()
+        if mode == 'page' or self.page_number_class.page_query_param in request.query_params:
+            return self.page_number_class()
+        return None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.paginator = self.get_paginator(request)
+        if self.paginator is None:
+            return None
+        return self.paginator.paginate_queryset(queryset, request, view=view)
+
+    def get_paginated_response(self, data):
+        return self.paginator.get_paginated_response(data)
+
+    def get_pagination_info(self):
+        """Returns the pagination information or None if the request was not paginated."""
+        if self.paginator is None:
+            return None
+        return self.paginator.get_pagination_info()
@@ -0,0 +1,84 @@
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser, JSONParser
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Types neither orjson nor msgpack encode, e.g. Decimal, lazy translations and
+# querysets, are encoded like DRF's JSONRenderer does.
+_encoder = JSONEncoder()
+
+
+class ORJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer encoding with orjson, if installed.
+
+    orjson encodes the dicts, lists, strings and numbers of the serializers
+    as well as the dates and datetimes natively in C. Without orjson the
+    data is rendered by DRF's JSONRenderer.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None:
+            return super(ORJSONRenderer, self).render(data, accepted_media_type, renderer_context)
+        if data is None:
+            return bytes()
+
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z
+        # orjson only indents by two spaces.
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(data, default=_encoder.default, option=option)
+
+
+class ORJSONParser(JSONParser):
+    """JSONParser decoding with orjson, if installed."""
+    renderer_class = ORJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get('encoding', settings.DEFAULT_CHARSET)
+        if orjson is None or encoding.lower().replace('-', '') != 'utf8':
+            return super(ORJSONParser, self).parse(stream, media_type, parser_context)
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError('JSON parse error - {0}'.format(exc))
+
+
+class MessagePackRenderer(BaseRenderer):
+    """
+    Renders the data as MessagePack, a compact binary encoding of the json
+    data types. Dates and datetimes are encoded as iso 8601 strings, like in
+    the json responses. Requires msgpack.
+    """
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return bytes()
+        return msgpack.packb(data, default=_encoder.default, use_bin_type=True)
+
+
+class MessagePackParser(BaseParser):
+    """Parses MessagePack request bodies. Requires msgpack."""
+    media_type = 'application/msgpack'
+    renderer_class = MessagePackRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return msgpack.unpackb(stream.read(), raw=False)
+        except ValueError as exc:
+            raise ParseError('MessagePack parse error - {0}'.format(exc))
@@ -0,0 +1,154 @@
+import re
+
+from django.db import connection
+from django.db.models import Q
+
+from api.db_utils import chunked
+
+SEARCH_TABLE = 'api_book_search'
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def get_search_terms(query):
+    """Splits the search query into lower cased words."""
+    return WORD.findall(query.lower())
+
+
+class SearchBackend(object):
+    """
+    Full text index of the books over their names and the names of their
+    authors, kept in the `api_book_search` table created by the migrations.
+
+    `update(book_ids)` re-indexes the books from the database, dropping the
+    ones which no longer exist, and `search(queryset, query)` narrows the
+    queryset to the matching books ordered by relevance, matching a book name
+    above an author name.
+
+    The backends implement `search` and, for `update` and `rebuild`,
+    `insert_documents(cursor, where, params)` which indexes the books of
+    `api_book b` matching the `where` clause.
+    """
+    vendor = None
+    id_column = None
+
+    def update(self, book_ids):
+        """Re-indexes the books with the given ids."""
+        with connection.cursor() as cursor:
+            for ids_chunk in chunked(book_ids):
+                placeholders = ', '.join(['%s'] * len(ids_chunk))
+                cursor.execute(
+                    'DELETE FROM {0} WHERE {1} IN ({2})'.format(SEARCH_TABLE, self.id_column, placeholders),
+                    ids_chunk
+                )
+                self.insert_documents(cursor, 'WHERE b.id IN ({0})'.format(placeholders), ids_chunk)
+
+    def rebuild(self, cursor=None):
+        """Re-indexes all the books."""
+        if cursor is None:
+            with connection.cursor() as cursor:
+                return self.rebuild(cursor)
+        cursor.execute('DELETE FROM {0}'.format(SEARCH_TABLE))
+        self.insert_documents(cursor)
+
+
+class SQLiteSearchBackend(SearchBackend):
+    """Search backend on an SQLite FTS5 virtual table ranked by bm25."""
+    vendor = 'sqlite'
+    id_column = 'rowid'
+    name_weight = 10.0
+    authors_weight = 1.0
+
+    def insert_documents(self, cursor, where='', params=()):
+        cursor.execute(
+            "INSERT INTO {0} (rowid, name, authors) "
+            "SELECT b.id, b.name, COALESCE(("
+            "    SELECT group_concat(a.name, ' ') FROM api_book_authors ba "
+            "    INNER JOIN api_author a ON a.id = ba.author_id WHERE ba.book_id = b.id"
+            "), '') FROM api_book b {1}".format(SEARCH_TABLE, where),
+            params
+        )
+
+    def search(self, queryset, query):
+        terms = get_search_terms(query)
+        if not terms:
+            return queryset.none()
+        book_table = queryset.model._meta.db_table
+        return queryset.extra(
+            tables=[SEARCH_TABLE],
+            where=[
+                '{0}.rowid = {1}.id'.format(SEARCH_TABLE, book_table),
+                '{0} MATCH %s'.format(SEARCH_TABLE),
+            ],
+            params=[' '.join('"{0}"*'.format(term) for term in terms)],
+            select={'search_rank': 'bm25({0}, {1}, {2})'.format(SEARCH_TABLE, self.name_weight, self.authors_weight)},
+            order_by=['search_rank'] + list(queryset.model._meta.ordering),
+        )
+
+
+class PostgresSearchBackend(SearchBackend):
+    """Search backend on a tsvector column with a GIN index ranked by ts_rank."""
+    vendor = 'postgresql'
+    id_column = 'book_id'
+
+    def insert_documents(self, cursor, where='', params=()):
+        cursor.execute(
+            "INSERT INTO {0} (book_id, document) "
+            "SELECT b.id, setweight(to_tsvector('simple', b.name), 'A') || setweight(to_tsvector('simple', COALESCE(("
+            "    SELECT string_agg(a.name, ' ') FROM api_book_authors ba "
+            "    INNER JOIN api_author a ON a.id = ba.author_id WHERE ba.book_id = b.id"
+            "), '')), 'B') FROM api_book b {1}".format(SEARCH_TABLE, where),
+            params
+        )
+
+    def search(self, queryset, query):
+        terms = get_search_terms(query)
+        if not terms:
+            return queryset.none()
+        ts_query = ' & '.join('{0}:*'.format(term) for term in terms)
+        book_table = queryset.model._meta.db_table
+        return queryset.extra(
+            tables=[SEARCH_TABLE],
+            where=[
+                '{0}.book_id = {1}.id'.format(SEARCH_TABLE, book_table),
+                "{0}.document @@ to_tsquery('simple', %s)".format(SEARCH_TABLE),
+            ],
+            params=[ts_query],
+            select={'search_rank': "ts_rank({0}.document, to_tsquery('simple', %s))".format(SEARCH_TABLE)},
+            select_params=[ts_query],
+            order_by=['-search_rank'] + list(queryset.model._meta.ordering),
+        )
+
+
+class FallbackSearchBackend(SearchBackend):
+    """Unindexed substring search for the databases without a full text index."""
+
+    def update(self, book_ids):
+        pass
+
+    def rebuild(self, cursor=None):
+        pass
+
+    def search(self, queryset, query):
+        terms = get_search_terms(query)
+        if not terms:
+            return queryset.none()
+        for term in terms:
+            queryset = queryset.filter(Q(name__icontains=term) | Q(authors__name__icontains=term))
+        return queryset.distinct()
+
+
+SEARCH_BACKENDS = {backend.vendor: backend for backend in (SQLiteSearchBackend, PostgresSearchBackend)}
+
+
+def get_search_backend(using_connection=None):
+    """Returns the search backend for the database vendor of the connection."""
+    vendor = (using_connection or connection).vendor
+    return SEARCH_BACKENDS.get(vendor, FallbackSearchBackend)()
+
+
+def update_search_index(book_ids):
+    """Re-indexes the books with the given ids."""
+    book_ids = [book_id for book_id in book_ids if book_id is not None]
+    if book_ids:
+        get_search_backend().update(book_ids)
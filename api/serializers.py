@@ -1,7 +1,68 @@
+import re
+from collections import Counter, OrderedDict
+from datetime import date, datetime
+
 from dateutil import parser
 from rest_framework import serializers
 
-from api.models import Author, Book, Country, ExternalBook, Publisher
+from api.db_utils import bulk_create_with_pks, bulk_update, chunked, filter_in
+from api.instrumentation import record_time
+from api.lookups import reference_caches
+from api.models import Author, Book, BookChange, Country, ExternalBook, Publisher
+from api.pagination import get_unique_ordering
+from api.signals import books_changed, collect_books_changes
+
+
+class NameLookups(object):
+    """
+    Name to instance maps of the countries, publishers and authors named by a
+    batch of books, resolved from the reference caches with at most one `IN`
+    query per model.
+
+    Pass it as the `name_lookups` context of the book serializers to resolve
+    the names without a query per book. Authors which do not exist yet are
+    built unsaved, shared by all the books naming them, and inserted by
+    `save_new_authors`.
+    """
+
+    def __init__(self, books_data):
+        books_data = [book_data for book_data in books_data if isinstance(book_data, dict)]
+        self.instances = {
+            Country: reference_caches[Country].get_many(self.collect_names(books_data, 'country')),
+            Publisher: reference_caches[Publisher].get_many(self.collect_names(books_data, 'publisher')),
+            Author: reference_caches[Author].get_many(self.collect_names(books_data, 'authors')),
+        }
+        self.new_authors = []
+
+    @staticmethod
+    def collect_names(books_data, key):
+        names = set()
+        for book_data in books_data:
+            value = book_data.get(key)
+            values = value if isinstance(value, list) else [value]
+            names.update(name for name in values if isinstance(name, str))
+        return names
+
+    def get(self, model, name):
+        """Returns the instance of the model with the name or raises model.DoesNotExist."""
+        try:
+            return self.instances[model][name]
+        except KeyError:
+            raise model.DoesNotExist(name)
+
+    def get_or_build_author(self, name):
+        """Returns the author with the name, building an unsaved one if it does not exist."""
+        try:
+            return self.get(Author, name)
+        except Author.DoesNotExist:
+            author = self.instances[Author][name] = Author(name=name)
+            self.new_authors.append(author)
+            return author
+
+    def save_new_authors(self):
+        """Inserts the authors built for the names which did not exist."""
+        bulk_create_with_pks(Author, self.new_authors, 'name')
+        self.new_authors = []
 
 
 class AuthorSerializer(serializers.ModelSerializer):
@@ -13,8 +74,10 @@ class AuthorSerializer(serializers.ModelSerializer):
         return instance.name
 
     def to_internal_value(self, data):
-        instance, __ = Author.objects.get_or_create(name=data)
-        return instance
+        name_lookups = self.context.get('name_lookups')
+        if name_lookups is not None:
+            return name_lookups.get_or_build_author(data)
+        return reference_caches[Author].get_or_create(data)
 
 
 class CountryField(serializers.Field):
@@ -22,16 +85,22 @@ class CountryField(serializers.Field):
         return country.name
 
     def to_internal_value(self, data):
+        name_lookups = self.context.get('name_lookups')
         try:
-            return Country.objects.get(name=data)
+            if name_lookups is not None:
+                return name_lookups.get(Country, data)
+            return reference_caches[Country].get(data)
         except Country.DoesNotExist as ex:
             raise serializers.ValidationError(u"Country {} does not exist.".format(data))
 
 
 class PublisherField(serializers.Field):
     def to_internal_value(self, data):
+        name_lookups = self.context.get('name_lookups')
         try:
-            return Publisher.objects.get(name=data)
+            if name_lookups is not None:
+                return name_lookups.get(Publisher, data)
+            return reference_caches[Publisher].get(data)
         except Publisher.DoesNotExist:
             raise serializers.ValidationError(u"Publisher {} does not exist.".format(data))
 
@@ -39,37 +108,283 @@ class PublisherField(serializers.Field):
         return publisher.name
 
 
-class BookSerializer(serializers.ModelSerializer):
-    """Book serializer with all fields"""
+class RepresentationTimingMixin(object):
+    """Adds the time spent representing instances to the serializer timing of the request."""
+
+    def to_representation(self, instance):
+        with record_time('serializer'):
+            return super(RepresentationTimingMixin, self).to_representation(instance)
+
+
+class SparseFieldsMixin(object):
+    """Drops the fields of the serializer which are not in the `fields` argument."""
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super(SparseFieldsMixin, self).__init__(*args, **kwargs)
+        if fields is not None:
+            for field_name in set(self.fields) - set(fields):
+                self.fields.pop(field_name)
+
+
+BOOK_FIELDS = ('id', 'name', 'isbn', 'authors', 'number_of_pages', 'publisher', 'country', 'release_date')
+
+
+class BookSerializer(RepresentationTimingMixin, SparseFieldsMixin, serializers.ModelSerializer):
+    """
+    Book serializer with all fields.
+
+    When updating, `add_authors` and `remove_authors` change the authors of
+    the book by name without restating the others.
+    """
     authors = AuthorSerializer(many=True)
     country = CountryField()
     publisher = PublisherField()
+    add_authors = AuthorSerializer(many=True, write_only=True, required=False)
+    remove_authors = serializers.ListField(child=serializers.CharField(), write_only=True, required=False)
 
     class Meta:
         model = Book
-        fields = ('id', 'name', 'isbn', 'authors', 'number_of_pages', 'publisher', 'country', 'release_date')
+        fields = BOOK_FIELDS + ('add_authors', 'remove_authors')
+
+    @staticmethod
+    def setup_eager_loading(queryset, fields=None):
+        """
+        Joins the foreign keys and prefetches the authors rendered by this
+        serializer so that representing a page of books costs a constant
+        number of queries. Given the subset of `fields` to render, only the
+        columns and relations they need are loaded.
+        """
+        if fields is None:
+            return queryset.select_related('country', 'publisher').prefetch_related('authors')
+
+        related_fields = [field for field in ('country', 'publisher') if field in fields]
+        if related_fields:
+            queryset = queryset.select_related(*related_fields)
+        if 'authors' in fields:
+            queryset = queryset.prefetch_related('authors')
+        columns = {'id'}.union(field.lstrip('-') for field in queryset.model._meta.ordering)
+        columns.update(
+            '{0}__name'.format(field) if field in related_fields else field
+            for field in fields if field != 'authors'
+        )
+        return queryset.only(*columns)
+
+    def validate(self, attrs):
+        if 'add_authors' in attrs or 'remove_authors' in attrs:
+            if self.instance is None:
+                raise serializers.ValidationError('Authors can only be added or removed when updating a book.')
+            if 'authors' in attrs:
+                raise serializers.ValidationError('Either replace the authors or add and remove some, not both.')
+        return attrs
 
     def create(self, validated_data):
         """Overriding create method to write nested relationships"""
         authors = validated_data.pop('authors', None)
 
-        book = super(BookSerializer, self).create(validated_data)
-        book.authors.add(*authors)
+        with collect_books_changes():
+            book = super(BookSerializer, self).create(validated_data)
+            book.authors.add(*authors)
         return book
 
     def update(self, instance, validated_data):
         """Overriding update method to write nested relationships"""
         authors = validated_data.pop('authors', None)
-        book = super(BookSerializer, self).update(instance, validated_data)
-        self._update_authors(instance, authors)
+        add_authors = validated_data.pop('add_authors', [])
+        remove_authors = set(validated_data.pop('remove_authors', []))
+        with collect_books_changes():
+            book = super(BookSerializer, self).update(instance, validated_data)
+            if authors is None and (add_authors or remove_authors):
+                authors = [author for author in instance.authors.all() if author.name not in remove_authors]
+                authors.extend(add_authors)
+            self._update_authors(instance, authors)
         return book
 
     def _update_authors(self, instance, validated_authors):
-        """Helper method to update book authors"""
+        """
+        Helper method to update book authors. Only the through rows of the
+        authors added or removed are written.
+        """
         if validated_authors is None:
             return
-        instance.authors.clear()
-        instance.authors.add(*validated_authors)
+        current_ids = {author.pk for author in instance.authors.all()}
+        new_ids = {author.pk for author in validated_authors}
+        if current_ids - new_ids:
+            instance.authors.remove(*(current_ids - new_ids))
+        if new_ids - current_ids:
+            instance.authors.add(*(new_ids - current_ids))
+
+
+class BookListSerializer(serializers.ListSerializer):
+    """
+    Validates and writes a batch of books together.
+
+    Items with an `id` replace the existing book, the others are created.
+    The names are resolved with the `NameLookups` of the batch and the isbn
+    uniqueness is checked for the whole batch at once, so validating costs a
+    handful of queries whatever the size of the batch. The errors are
+    reported per item, an empty dict standing for a valid item.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(BookListSerializer, self).__init__(*args, **kwargs)
+        self.books_by_id = {}
+        self.created_books = []
+        self.updated_books = []
+
+    def to_internal_value(self, data):
+        if not isinstance(data, list):
+            raise serializers.ValidationError({'non_field_errors': ['Expected a list of books.']})
+        self._context = dict(self.context, name_lookups=NameLookups(data))
+
+        book_ids = [item.get('id') for item in data if isinstance(item, dict) and item.get('id') is not None]
+        self.books_by_id = {book.id: book for book in filter_in(Book.objects.all(), 'id', book_ids)}
+
+        validated_items, errors = [], []
+        for item in data:
+            try:
+                validated = self.child.run_validation(item)
+                if isinstance(item, dict) and item.get('id') is not None:
+                    validated['id'] = self.get_book_id(item['id'])
+                validated_items.append(validated)
+                errors.append({})
+            except serializers.ValidationError as exc:
+                validated_items.append(None)
+                errors.append(exc.detail)
+
+        self.validate_isbns(validated_items, errors)
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return validated_items
+
+    def get_book_id(self, book_id):
+        try:
+            book_id = int(book_id)
+        except (TypeError, ValueError):
+            book_id = None
+        if book_id not in self.books_by_id:
+            raise serializers.ValidationError({'id': ['Book does not exist.']})
+        return book_id
+
+    def validate_isbns(self, validated_items, errors):
+        """Reports the isbns used twice in the batch or by other books."""
+        isbns = [item['isbn'] for item in validated_items if item is not None]
+        duplicates = {isbn for isbn, count in Counter(isbns).items() if count > 1}
+        used_by = dict(
+            (book.isbn, book.id) for book in filter_in(Book.objects.only('id', 'isbn'), 'isbn', isbns)
+        )
+        for item, item_errors in zip(validated_items, errors):
+            if item is None:
+                continue
+            if item['isbn'] in duplicates:
+                item_errors.setdefault('isbn', []).append('Duplicate isbn in the batch.')
+            elif used_by.get(item['isbn'], item.get('id')) != item.get('id'):
+                item_errors.setdefault('isbn', []).append('book with this isbn already exists.')
+
+    def create(self, validated_data):
+        """
+        Writes the books and their authors with bulk queries in one
+        transaction and returns them in the order of the batch.
+        """
+        books, created, updated, book_authors = [], [], [], {}
+        for item in validated_data:
+            item = dict(item)
+            authors = item.pop('authors')
+            book_id = item.pop('id', None)
+            if book_id is None:
+                book = Book(**item)
+                created.append(book)
+            else:
+                book = self.books_by_id[book_id]
+                for attr, value in item.items():
+                    setattr(book, attr, value)
+                updated.append(book)
+            books.append(book)
+            book_authors[id(book)] = authors
+
+        with collect_books_changes():
+            self.context['name_lookups'].save_new_authors()
+            bulk_create_with_pks(Book, created, 'isbn')
+            if updated:
+                bulk_update(Book, updated, ['name', 'isbn', 'number_of_pages', 'publisher', 'country', 'release_date'])
+            BookAuthor = Book.authors.through
+            for ids_chunk in chunked([book.pk for book in updated]):
+                BookAuthor.objects.filter(book_id__in=ids_chunk).delete()
+            BookAuthor.objects.bulk_create([
+                BookAuthor(book_id=book.pk, author_id=author.pk)
+                for book in created + updated
+                for author in {author.pk: author for author in book_authors[id(book)]}.values()
+            ])
+            # Bulk queries send no signals, so the search index, the cached
+            # representations, the change counter and the change log are
+            # updated here.
+            books_changed([book.pk for book in created], BookChange.CREATED)
+            books_changed([book.pk for book in updated], BookChange.UPDATED)
+        self.created_books, self.updated_books = created, updated
+        return books
+
+
+class BulkBookSerializer(BookSerializer):
+    """Book serializer for validating and writing batches of books."""
+
+    class Meta(BookSerializer.Meta):
+        list_serializer_class = BookListSerializer
+        extra_kwargs = {'isbn': {'validators': []}}
+
+
+class BookValuesSerializer(object):
+    """
+    Read only book serializer for the lists of books without their authors.
+
+    The books are fetched as `QuerySet.values()` rows, see `select_values`,
+    and mapped to dicts by hand instead of going through model instances and
+    DRF fields, which is several times faster for large slim lists such as
+    `?fields=id,name`.
+    """
+    related_lookups = {'country': 'country__name', 'publisher': 'publisher__name'}
+
+    def __init__(self, instance=None, fields=None, many=False, context=None):
+        self.instance = instance
+        self.fields = BOOK_FIELDS if fields is None else fields
+        self.many = many
+        self.context = context or {}
+
+    @staticmethod
+    def supports(fields):
+        """Whether the fields can be rendered from values rows."""
+        return fields is not None and 'authors' not in fields
+
+    @staticmethod
+    def setup_eager_loading(queryset, fields=None):
+        return queryset
+
+    @classmethod
+    def select_values(cls, queryset, fields):
+        """
+        Returns the queryset as values rows holding the fields along with the
+        ordering fields needed by the keyset pagination and the extra selects
+        the queryset may be ordered by, e.g. the search rank.
+        """
+        lookups = {cls.related_lookups.get(field, field) for field in fields}
+        lookups.update(field.lstrip('-') for field in get_unique_ordering(queryset))
+        lookups.update(queryset.query.extra)
+        return queryset.values(*lookups)
+
+    def to_representation(self, row):
+        data = OrderedDict()
+        for field in self.fields:
+            value = row[self.related_lookups.get(field, field)]
+            if field == 'release_date' and value is not None:
+                value = value.isoformat()
+            data[field] = value
+        return data
+
+    @property
+    def data(self):
+        with record_time('serializer'):
+            if self.many:
+                return [self.to_representation(row) for row in self.instance]
+            return self.to_representation(self.instance)
 
 
 class MinimalBookSerializer(BookSerializer):
@@ -89,11 +404,33 @@ class ExternalAuthorSerializer(serializers.Serializer):
         return instance
 
 
+ISO_DATE_PREFIX = re.compile(r'(\d{4})-(\d{2})-(\d{2})(?:$|T)')
+
+
+def parse_external_date(value):
+    """
+    Parses the date of the external api. The api sends ISO 8601 dates, e.g.
+    `1996-08-01T00:00:00`, which are parsed directly; anything else falls
+    back to dateutil.
+    """
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    match = ISO_DATE_PREFIX.match(value)
+    if match:
+        try:
+            return date(*map(int, match.groups()))
+        except ValueError:
+            pass
+    return parser.parse(value).date()
+
+
 class ExternalDateField(serializers.DateField):
     """Custom date field to handle external api date."""
 
     def to_representation(self, value):
-        parsed_date = parser.parse(value).date()
+        parsed_date = parse_external_date(value)
         return super(ExternalDateField, self).to_representation(parsed_date)
 
 
@@ -117,3 +454,33 @@ class IceAndFireSerializer(serializers.Serializer):
     publisher = serializers.CharField()
     country = serializers.CharField()
     release_date = ExternalDateField(format="%Y-%m-%d", source='released')
+
+    @staticmethod
+    def transform_many(books_data):
+        """
+        Transforms a list of external api books in one pass.
+
+        Produces the same representation as serializing every book with this
+        serializer, without building an ExternalBook and the serializer
+        fields per book.
+        """
+        def as_text(value):
+            return None if value is None else str(value)
+
+        return [
+            {
+                'name': as_text(book_data.get('name')),
+                'isbn': as_text(book_data.get('isbn')),
+                'authors': book_data.get('authors'),
+                'number_of_pages': (
+                    None if book_data.get('numberOfPages') is None else int(book_data['numberOfPages'])
+                ),
+                'publisher': as_text(book_data.get('publisher')),
+                'country': as_text(book_data.get('country')),
+                'release_date': (
+                    None if book_data.get('released') is None
+                    else parse_external_date(book_data['released']).strftime('%Y-%m-%d')
+                ),
+            }
+            for book_data in books_data
+        ]
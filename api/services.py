@@ -7,3 +7,7 @@ class BooksService(object):
     def get_books(self, name=None):
         """Returns & transforms the books information."""
         return BookStore().get_books(name)
+
+    async def aget_books(self, name=None):
+        """Returns & transforms the books information without blocking the event loop."""
+        return await BookStore().aget_books(name)
@@ -0,0 +1,171 @@
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.core.signals import request_started
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from api.caches import get_book_representation_cache
+from api.changes import record_book_changes
+from api.conditional import BOOKS_COUNTER, bump_change_counter, change_counter_bumped
+from api.lookups import reference_caches, sync_reference_caches
+from api.models import Author, Book, BookChange, Country, Publisher
+from api.search import update_search_index
+from api.snapshot import get_book_snapshot_engine
+
+
+_collected = threading.local()
+
+
+def merge_book_action(previous, action):
+    """Returns the action of a book changed by `previous`, then by `action`, in one transaction."""
+    if action == BookChange.DELETED or previous is None:
+        return action
+    return BookChange.CREATED if previous == BookChange.CREATED else action
+
+
+@contextmanager
+def collect_books_changes():
+    """
+    Runs the block in a transaction, collecting the changes of the books it
+    makes and applying them once at its end: a write sending several
+    signals for a book, e.g. saving it and then replacing its authors,
+    re-indexes the book and records its change only once. Nested blocks
+    are part of the outermost one.
+    """
+    if getattr(_collected, 'changes', None) is not None:
+        with transaction.atomic():
+            yield
+        return
+    _collected.changes = changes = OrderedDict()
+    try:
+        with transaction.atomic():
+            yield
+            _collected.changes = None
+            apply_books_changes(changes)
+    finally:
+        _collected.changes = None
+
+
+def books_changed(book_ids, action=BookChange.UPDATED):
+    """
+    Re-indexes the books, drops their cached representations, updates the
+    snapshot, bumps the books change counter and records the change log,
+    at the end of the collect_books_changes block if any.
+    """
+    changes = getattr(_collected, 'changes', None)
+    collecting = changes is not None
+    if not collecting:
+        changes = OrderedDict()
+    for book_id in book_ids:
+        if book_id is not None:
+            changes[book_id] = merge_book_action(changes.get(book_id), action)
+    if not collecting:
+        apply_books_changes(changes)
+
+
+def apply_books_changes(changes):
+    """Applies the changes of the books, given as an ordered {book_id: action} dict."""
+    if not changes:
+        return
+    book_ids = list(changes)
+    update_search_index(book_ids)
+    representation_cache = get_book_representation_cache()
+    if representation_cache is not None:
+        representation_cache.invalidate(book_ids)
+    snapshot_engine = get_book_snapshot_engine()
+    if snapshot_engine is not None:
+        snapshot_engine.books_changed(book_ids)
+    record_changes(changes.items())
+
+
+def record_changes(changes):
+    """Bumps the books change counter, then appends the (book_id, action) pairs to the change log."""
+    # The counter row stays locked until the commit, so the change log
+    # entries written after it are allocated ids in commit order.
+    with transaction.atomic(savepoint=False):
+        bump_change_counter(BOOKS_COUNTER)
+        record_book_changes(changes)
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Country)
+@receiver(post_save, sender=Publisher)
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=Country)
+@receiver(post_delete, sender=Publisher)
+def invalidate_reference_cache(sender, created=False, **kwargs):
+    """Invalidates the cached instances of the model when one is renamed or deleted."""
+    if not created:
+        reference_caches[sender].invalidate()
+
+
+@receiver(request_started)
+def sync_reference_caches_on_request(**kwargs):
+    """Picks up the reference models changed by other processes."""
+    sync_reference_caches()
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+def book_saved_or_deleted(instance, signal, created=False, **kwargs):
+    if signal is post_delete:
+        books_changed([instance.pk], BookChange.DELETED)
+    else:
+        books_changed([instance.pk], BookChange.CREATED if created else BookChange.UPDATED)
+
+
+@receiver(pre_delete, sender=Author)
+def remember_author_books(instance, **kwargs):
+    # The books of a deleted author are gone by the time of post_delete.
+    instance._book_ids = list(instance.books.values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_delete, sender=Author)
+def author_renamed_or_deleted(instance, created=False, **kwargs):
+    """Updates the books of a renamed or deleted author."""
+    if not created:
+        book_ids = instance.__dict__.pop('_book_ids', None)
+        books_changed(instance.books.values_list('pk', flat=True) if book_ids is None else book_ids)
+
+
+@receiver(post_save, sender=Country)
+@receiver(post_save, sender=Publisher)
+def country_or_publisher_renamed(sender, instance, created=False, **kwargs):
+    """
+    Retires all the cached book representations and the snapshot, too many
+    may name the instance, and records the change of its books.
+    """
+    if created:
+        return
+    representation_cache = get_book_representation_cache()
+    if representation_cache is not None:
+        representation_cache.invalidate_all()
+    snapshot_engine = get_book_snapshot_engine()
+    if snapshot_engine is not None:
+        snapshot_engine.catalog_changed()
+    book_ids = list(Book.objects.filter(**{sender._meta.model_name: instance}).values_list('pk', flat=True))
+    if book_ids:
+        record_changes((book_id, BookChange.UPDATED) for book_id in book_ids)
+
+
+@receiver(m2m_changed, sender=Book.authors.through)
+def book_authors_changed(instance, action, reverse, pk_set, **kwargs):
+    """Updates the books whose authors were added, removed or cleared."""
+    if action == 'pre_clear' and reverse:
+        # The books of a cleared author are gone by the time of post_clear.
+        instance._book_ids = list(instance.books.values_list('pk', flat=True))
+    elif action in ('post_add', 'post_remove') and pk_set:
+        books_changed(pk_set if reverse else [instance.pk])
+    elif action == 'post_clear':
+        books_changed(instance.__dict__.pop('_book_ids', []) if reverse else [instance.pk])
+
+
+@receiver(change_counter_bumped)
+def count_committed_books_changes(name, **kwargs):
+    snapshot_engine = get_book_snapshot_engine()
+    if name == BOOKS_COUNTER and snapshot_engine is not None:
+        snapshot_engine.counter_bumped()
@@ -0,0 +1,479 @@
+import heapq
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, connections, transaction
+from django.dispatch import receiver
+
+from api.conditional import BOOKS_COUNTER, get_change_counter
+from api.db_utils import chunked
+from api.instrumentation import record_time
+from api.models import Book
+
+DEFAULT_BOOK_SNAPSHOT = {
+    'ENABLED': False,
+    'BACKGROUND_REFRESH': True,
+}
+
+# Columns of a book row, in the order of the values_list query.
+BookRow = namedtuple('BookRow', 'id name isbn number_of_pages release_date publisher country authors')
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_sort_key(row):
+    """The key of the default ordering of the books, by name, release date and id."""
+    return row.name, row.release_date.toordinal(), row.id
+
+
+class InternTable(object):
+    """Maps the names to small integer ids, in order of appearance."""
+
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+
+    def intern(self, name):
+        intern_id = self.ids.get(name)
+        if intern_id is None:
+            intern_id = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return intern_id
+
+    def copy(self):
+        table = InternTable()
+        table.names, table.ids = list(self.names), dict(self.ids)
+        return table
+
+
+class SortedIndex(object):
+    """
+    Positions of the rows sorted by a key, answering equality lookups with
+    a binary search. Within a key the positions are ascending.
+    """
+
+    def __init__(self, keys, positions):
+        self.keys = keys
+        self.positions = positions
+
+    @classmethod
+    def build(cls, column, typecode=None):
+        order = sorted(range(len(column)), key=column.__getitem__)
+        keys = [column[position] for position in order]
+        return cls(array(typecode, keys) if typecode else keys, array('l', order))
+
+    def lookup(self, key):
+        return self.positions[bisect_left(self.keys, key):bisect_right(self.keys, key)]
+
+    def splice(self, position_map, added, typecode=None):
+        """
+        Returns a new index with the positions moved by `position_map`, where
+        the removed positions map to -1, and the (key, position) pairs of
+        `added` merged in.
+        """
+        kept = (
+            (key, position_map[position])
+            for key, position in zip(self.keys, self.positions) if position_map[position] >= 0
+        )
+        entries = list(heapq.merge(kept, sorted(added)))
+        keys = [key for key, __ in entries]
+        return SortedIndex(
+            array(typecode, keys) if typecode else keys, array('l', (position for __, position in entries))
+        )
+
+
+class BookSnapshot(object):
+    """
+    Immutable, columnar snapshot of the books catalog at a version of the
+    books change counter.
+
+    The rows are kept in the default ordering of the books, by name, release
+    date and id, compared by code point like the SQLite collation does,
+    which is why the engine is only enabled on SQLite. Numbers and
+    dates are held in typed arrays, the publishers, countries and authors as
+    interned ids, and the authors of the books as ranges of one array. The
+    snapshot is never changed once built, a change builds a new snapshot.
+    """
+
+    def __init__(self, rows, version, committed_bumps=0):
+        self.version = version
+        # The changes committed by this process which the snapshot includes.
+        self.committed_bumps = committed_bumps
+        self.publishers, self.countries, self.authors = InternTable(), InternTable(), InternTable()
+
+        self.ids = array('q')
+        self.names = []
+        self.isbns = []
+        self.number_of_pages = array('q')
+        self.release_dates = array('l')
+        self.publisher_ids = array('l')
+        self.country_ids = array('l')
+        self.author_offsets = array('l', [0])
+        self.author_ids = array('l')
+        for row in sorted(rows, key=get_sort_key):
+            self.append_row(row)
+
+        self.positions_by_id = {book_id: position for position, book_id in enumerate(self.ids)}
+        self.name_index = SortedIndex(self.names, array('l', range(len(self))))
+        self.isbn_index = SortedIndex.build(self.isbns)
+        self.release_year_index = SortedIndex.build(
+            [date.fromordinal(ordinal).year for ordinal in self.release_dates], 'l'
+        )
+        self.publisher_index = SortedIndex.build(self.publisher_ids, 'l')
+
+    def append_row(self, row):
+        self.ids.append(row.id)
+        self.names.append(row.name)
+        self.isbns.append(row.isbn)
+        self.number_of_pages.append(row.number_of_pages)
+        self.release_dates.append(row.release_date.toordinal())
+        self.publisher_ids.append(self.publishers.intern(row.publisher))
+        self.country_ids.append(self.countries.intern(row.country))
+        self.author_ids.extend(self.authors.intern(name) for name in row.authors)
+        self.author_offsets.append(len(self.author_ids))
+
+    def extend_rows(self, snapshot, rows):
+        """Appends the rows of the `rows` slice of the snapshot, which shares the intern tables."""
+        self.ids.extend(snapshot.ids[rows])
+        self.names.extend(snapshot.names[rows])
+        self.isbns.extend(snapshot.isbns[rows])
+        self.number_of_pages.extend(snapshot.number_of_pages[rows])
+        self.release_dates.extend(snapshot.release_dates[rows])
+        self.publisher_ids.extend(snapshot.publisher_ids[rows])
+        self.country_ids.extend(snapshot.country_ids[rows])
+        authors_start = snapshot.author_offsets[rows.start]
+        shift = len(self.author_ids) - authors_start
+        self.author_ids.extend(snapshot.author_ids[authors_start:snapshot.author_offsets[rows.stop]])
+        self.author_offsets.extend(
+            offset + shift for offset in snapshot.author_offsets[rows.start + 1:rows.stop + 1]
+        )
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_row(self, position):
+        return BookRow(
+            self.ids[position],
+            self.names[position],
+            self.isbns[position],
+            self.number_of_pages[position],
+            date.fromordinal(self.release_dates[position]),
+            self.publishers.names[self.publisher_ids[position]],
+            self.countries.names[self.country_ids[position]],
+            tuple(
+                self.authors.names[author_id]
+                for author_id in self.author_ids[self.author_offsets[position]:self.author_offsets[position + 1]]
+            ),
+        )
+
+    def find_position(self, row):
+        """Returns the position of the first book not ordered before the row."""
+        key = get_sort_key(row)
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if (self.names[middle], self.release_dates[middle], self.ids[middle]) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def with_changes(self, book_ids, rows, version, committed_bumps):
+        """
+        Returns a new snapshot with the books of `book_ids` replaced by `rows`,
+        missing ones removed.
+
+        The rows are spliced in: the runs of unchanged books are copied as
+        slices of the columns, the changed rows are placed with a binary
+        search, and the positions of the indexes are moved rather than sorted
+        again. Only the changed rows are sorted, the copies still take a pass
+        over the columns and indexes as the snapshot is left to its readers.
+        """
+        removed = [
+            (self.positions_by_id[book_id], 1, None) for book_id in set(book_ids) if book_id in self.positions_by_id
+        ]
+        rows = sorted(rows, key=get_sort_key)
+        inserted = [(self.find_position(row), 0, index) for index, row in enumerate(rows)]
+
+        snapshot = BookSnapshot((), version, committed_bumps)
+        snapshot.publishers, snapshot.countries, snapshot.authors = (
+            self.publishers.copy(), self.countries.copy(), self.authors.copy()
+        )
+        position_map = array('l', [-1]) * len(self)
+        added_positions = []
+        start = 0
+        for position, is_removal, index in sorted(removed + inserted) + [(len(self), 1, None)]:
+            if start < position:
+                position_map[start:position] = array('l', range(len(snapshot), len(snapshot) + position - start))
+                snapshot.extend_rows(self, slice(start, position))
+            if is_removal:
+                start = position + 1
+            else:
+                start = position
+                added_positions.append(len(snapshot))
+                snapshot.append_row(rows[index])
+
+        snapshot.positions_by_id = {book_id: position for position, book_id in enumerate(snapshot.ids)}
+        snapshot.name_index = SortedIndex(snapshot.names, array('l', range(len(snapshot))))
+        snapshot.isbn_index = self.isbn_index.splice(
+            position_map, [(row.isbn, position) for row, position in zip(rows, added_positions)]
+        )
+        snapshot.release_year_index = self.release_year_index.splice(
+            position_map, [(row.release_date.year, position) for row, position in zip(rows, added_positions)], 'l'
+        )
+        snapshot.publisher_index = self.publisher_index.splice(
+            position_map,
+            [(snapshot.publisher_ids[position], position) for position in added_positions],
+            'l',
+        )
+        return snapshot
+
+    def filter(self, name=None, isbn=None, release_year=None, publisher=None):
+        """
+        Returns the positions of the books matching all the given lookups, in
+        the default ordering. The lookups match exactly like the BookFilter.
+        """
+        matches = []
+        if name is not None:
+            matches.append(self.name_index.lookup(name))
+        if isbn is not None:
+            matches.append(self.isbn_index.lookup(isbn))
+        if release_year is not None:
+            matches.append(self.release_year_index.lookup(release_year))
+        if publisher is not None:
+            publisher_id = self.publishers.ids.get(publisher)
+            matches.append(array('l') if publisher_id is None else self.publisher_index.lookup(publisher_id))
+        if not matches:
+            return list(range(len(self)))
+
+        matches.sort(key=len)
+        positions = set(matches[0])
+        for other_positions in matches[1:]:
+            if not positions:
+                break
+            positions.intersection_update(other_positions)
+        return sorted(positions)
+
+    def represent(self, positions, fields):
+        """Returns the `fields` of the books at the positions as rendered by BookSerializer."""
+        getters = {
+            'id': self.ids.__getitem__,
+            'name': self.names.__getitem__,
+            'isbn': self.isbns.__getitem__,
+            'authors': lambda position: [
+                self.authors.names[author_id]
+                for author_id in self.author_ids[self.author_offsets[position]:self.author_offsets[position + 1]]
+            ],
+            'number_of_pages': self.number_of_pages.__getitem__,
+            'publisher': lambda position: self.publishers.names[self.publisher_ids[position]],
+            'country': lambda position: self.countries.names[self.country_ids[position]],
+            'release_date': lambda position: date.fromordinal(self.release_dates[position]).isoformat(),
+        }
+        field_getters = [(field, getters[field]) for field in fields]
+        with record_time('serializer'):
+            return [
+                OrderedDict((field, getter(position)) for field, getter in field_getters)
+                for position in positions
+            ]
+
+
+def fetch_book_rows(book_ids=None):
+    """Fetches the rows of the books with the ids, or of all the books."""
+    columns = ('id', 'name', 'isbn', 'number_of_pages', 'release_date', 'publisher__name', 'country__name')
+    BookAuthor = Book.authors.through
+    if book_ids is None:
+        books = Book.objects.order_by().values_list(*columns).iterator()
+        book_authors = BookAuthor.objects.order_by('id').values_list('book_id', 'author__name').iterator()
+    else:
+        books, book_authors = [], []
+        for ids_chunk in chunked(book_ids):
+            books.extend(Book.objects.filter(id__in=ids_chunk).order_by().values_list(*columns))
+            book_authors.extend(
+                BookAuthor.objects.filter(book_id__in=ids_chunk).order_by('id').values_list('book_id', 'author__name')
+            )
+
+    authors_by_book = {}
+    for book_id, author_name in book_authors:
+        authors_by_book.setdefault(book_id, []).append(author_name)
+    return [BookRow(*(book + (tuple(authors_by_book.get(book[0], ())),))) for book in books]
+
+
+class BookSnapshotEngine(object):
+    """
+    Keeps the snapshot of the books catalog of the process up to date.
+
+    A snapshot is only served at the version of the books change counter it
+    was built at, so it never answers for a state other than the current
+    one. Readers take the current snapshot with a single reference read and
+    a refresh swaps in a completely built one.
+
+    The changes committed by this process are collected from the signals
+    and applied incrementally, fetching only the changed books. When the
+    counter moved further than these changes explain, i.e. other processes
+    changed the books, the snapshot is rebuilt from scratch.
+    """
+
+    def __init__(self, background_refresh=True):
+        self.background_refresh = background_refresh
+        self.snapshot = None
+        self._pending_book_ids = set()
+        self._pending_rebuild = False
+        self._committed_bumps = 0
+        self._lock = threading.Lock()
+        # Serializes the refreshes, a refresh which took no pending changes
+        # must not swap in its snapshot after one which took them.
+        self._refresh_lock = threading.Lock()
+        self._executor = None
+        self._refresh_future = None
+
+    @classmethod
+    def from_settings(cls):
+        """Returns the engine configured by `settings.BOOK_SNAPSHOT` or None if disabled."""
+        options = dict(DEFAULT_BOOK_SNAPSHOT, **getattr(settings, 'BOOK_SNAPSHOT', {}))
+        if not options['ENABLED']:
+            return None
+        if connection.vendor != 'sqlite':
+            # The snapshot sorts the names by code point, like the SQLite
+            # collation. The locale collations of other databases order the
+            # pages differently.
+            raise ImproperlyConfigured('BOOK_SNAPSHOT can only be enabled on SQLite databases.')
+        return cls(background_refresh=options['BACKGROUND_REFRESH'])
+
+    def clear(self):
+        """Drops the snapshot, the next request builds it again."""
+        self.wait_for_refresh()
+        with self._lock:
+            self.snapshot = None
+            self._pending_book_ids, self._pending_rebuild = set(), False
+
+    def books_changed(self, book_ids):
+        """Records the books changed by the current transaction, once it commits."""
+        def record():
+            with self._lock:
+                self._pending_book_ids.update(book_ids)
+        transaction.on_commit(record)
+
+    def catalog_changed(self):
+        """Records a change of many books, e.g. a renamed publisher, once the transaction commits."""
+        def record():
+            with self._lock:
+                self._pending_rebuild = True
+        transaction.on_commit(record)
+
+    def counter_bumped(self):
+        """
+        Counts the changes of the books counter committed by this process.
+        The books are recorded before the counter is bumped, so a counted
+        change never lacks its books.
+        """
+        def record():
+            with self._lock:
+                self._committed_bumps += 1
+        transaction.on_commit(record)
+
+    def get_snapshot(self, version):
+        """Returns the snapshot at the version of the books, or None and schedules a refresh."""
+        snapshot = self.snapshot
+        if snapshot is not None and snapshot.version == version:
+            return snapshot
+        if not self.background_refresh:
+            snapshot = self.refresh()
+            return snapshot if snapshot.version == version else None
+        self.schedule_refresh()
+        return None
+
+    def schedule_refresh(self):
+        with self._lock:
+            if self._refresh_future is not None and not self._refresh_future.done():
+                return
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1)
+            self._refresh_future = self._executor.submit(self.refresh_in_background)
+
+    def refresh_in_background(self):
+        try:
+            self.refresh()
+        finally:
+            connections.close_all()
+
+    def wait_for_refresh(self, timeout=None):
+        future = self._refresh_future
+        if future is not None:
+            future.result(timeout)
+
+    def refresh(self):
+        """Brings the snapshot to the current version of the books and returns it."""
+        with self._refresh_lock, transaction.atomic():
+            version = get_change_counter(BOOKS_COUNTER)[0]
+            with self._lock:
+                book_ids, rebuild, committed_bumps = (
+                    self._pending_book_ids, self._pending_rebuild, self._committed_bumps
+                )
+                self._pending_book_ids, self._pending_rebuild = set(), False
+            snapshot = self.snapshot
+            try:
+                if snapshot is not None and snapshot.version == version and not book_ids and not rebuild:
+                    return snapshot
+                if (snapshot is None or rebuild
+                        or version != snapshot.version + committed_bumps - snapshot.committed_bumps):
+                    snapshot = BookSnapshot(fetch_book_rows(), version, committed_bumps)
+                else:
+                    snapshot = snapshot.with_changes(book_ids, fetch_book_rows(book_ids), version, committed_bumps)
+            except Exception:
+                with self._lock:
+                    self._pending_rebuild = True
+                raise
+            self.snapshot = snapshot
+        return snapshot
+
+
+def get_book_snapshot_engine():
+    """Returns the process wide books snapshot engine, or None when disabled."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = BookSnapshotEngine.from_settings() or False
+        return _engine or None
+
+
+@receiver(setting_changed)
+def reset_book_snapshot_engine(setting, **kwargs):
+    """Rebuilds the engine when its settings are overridden, e.g. in tests."""
+    global _engine
+    if setting == 'BOOK_SNAPSHOT':
+        with _engine_lock:
+            _engine = None
+
+
+def get_snapshot_lookups(filterset):
+    """
+    Returns the lookups of the snapshot for the query of the BookFilter, or
+    None if the snapshot can not answer it, e.g. for a full text search or
+    invalid filter values, which are left to the database.
+    """
+    if not filterset.form.is_valid():
+        return None
+    values = filterset.form.cleaned_data
+    if values.get('q'):
+        return None
+    lookups = {
+        'name': values.get('name') or None,
+        'isbn': values.get('isbn') or None,
+        'publisher': values.get('publisher') or None,
+    }
+    if values.get('release_date') is not None:
+        try:
+            lookups['release_year'] = int(values['release_date'])
+            date(lookups['release_year'] + 1, 1, 1)
+            date(lookups['release_year'], 1, 1)
+        except (OverflowError, ValueError):
+            return None
+    return lookups
@@ -0,0 +1,88 @@
+import asyncio
+import json
+from urllib.parse import parse_qs, urlparse
+
+import mock
+from django.test import SimpleTestCase, override_settings
+
+from api.book_stores import IceAndFireStore
+from api.caches import get_book_store_cache
+from api.http_client import reset_http_clients
+from api.tests.utils import PaginatedUpstream, StubServer
+from api_project.asgi import application
+
+
+def call_asgi(app, path, query_string=b'', method='GET'):
+    """Runs the request through the ASGI application and returns the sent messages."""
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query_string, 'headers': []}
+    asyncio.get_event_loop().run_until_complete(app(scope, receive, send))
+    return messages
+
+
+@override_settings(BOOK_STORE_HTTP={'BACKOFF_FACTOR': 0})
+class AsyncBooksListTests(SimpleTestCase):
+    """Tests for the ASGI external books endpoint"""
+    books_fetch_path = '/api/external-books/'
+
+    def setUp(self):
+        super(AsyncBooksListTests, self).setUp()
+        get_book_store_cache().clear()
+        reset_http_clients()
+        self.upstream = PaginatedUpstream(book_count=12)
+        self.server = StubServer(self.upstream).start()
+        patcher = mock.patch.object(IceAndFireStore, 'url', self.server.url + '/api/books')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.server.stop)
+
+    def get_response(self, *args, **kwargs):
+        start, body = call_asgi(application, *args, **kwargs)
+        return start['status'], json.loads(body['body'].decode('utf-8'))
+
+    @override_settings(ICE_AND_FIRE_STORE={'PAGE_SIZE': 5})
+    def test_external_books(self):
+        """Tests that the async endpoint returns the books of all upstream pages."""
+        status, response_data = self.get_response(self.books_fetch_path)
+        self.assertEqual(status, 200)
+        self.assertEqual(response_data['status'], 'success')
+        self.assertEqual(len(response_data['data']), 12)
+        self.assertEqual(response_data['data'][0]['release_date'], '1996-08-01')
+        self.assertEqual(len(self.server.paths), 3)
+
+    def test_call_with_querystring(self):
+        """Tests that the name filter is passed on to the upstream, encoded."""
+        self.get_response(self.books_fetch_path, query_string=b'name=Fire+%26+Blood%231%3D')
+        for path in self.server.paths:
+            self.assertEqual(parse_qs(urlparse(path).query)['name'], ['Fire & Blood#1='])
+
+    def test_without_httpx(self):
+        """Tests that the store falls back to the sync client on the executor without httpx."""
+        with mock.patch('api.book_stores.httpx', None):
+            status, response_data = self.get_response(self.books_fetch_path)
+        self.assertEqual(status, 200)
+        self.assertEqual(len(response_data['data']), 12)
+
+    def test_not_found(self):
+        """Tests that the paths without an async implementation are not found."""
+        status, __ = self.get_response('/api/v1/books/')
+        self.assertEqual(status, 404)
+
+    def test_method_not_allowed(self):
+        """Tests that only GET requests are allowed."""
+        status, __ = self.get_response(self.books_fetch_path, method='POST')
+        self.assertEqual(status, 405)
+
+    def test_head(self):
+        """Tests that HEAD requests are answered with the headers of the GET response only."""
+        start, body = call_asgi(application, self.books_fetch_path, method='HEAD')
+        self.assertEqual(start['status'], 200)
+        self.assertEqual(body['body'], b'')
+        self.assertGreater(int(dict(start['headers'])[b'content-length']), 0)
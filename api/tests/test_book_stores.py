@@ -0,0 +1,499 @@
+import asyncio
+import threading
+import time
+
+import mock
+from django.test import SimpleTestCase, override_settings
+
+from api.api_utils import get_response_status_info
+from api.book_stores import BookStore, BookStoreBase, IceAndFireStore
+from api.coalescing import get_single_flight
+from api.http_client import CircuitBreaker, get_async_client, reset_http_clients
+from api.tests.utils import BOOK_DATA, PaginatedUpstream, StubServer
+
+TEST_HTTP_SETTINGS = {
+    'CONNECT_TIMEOUT': 1,
+    'READ_TIMEOUT': 0.5,
+    'MAX_RETRIES': 2,
+    'BACKOFF_FACTOR': 0,
+    'FAILURE_THRESHOLD': 2,
+    'RECOVERY_TIMEOUT': 30,
+}
+
+
+@override_settings(BOOK_STORE_HTTP=TEST_HTTP_SETTINGS)
+class IceAndFireStoreHTTPTests(SimpleTestCase):
+    """Tests for the http behaviour of the store against a local stub server"""
+
+    def setUp(self):
+        super(IceAndFireStoreHTTPTests, self).setUp()
+        reset_http_clients()
+        self.store = IceAndFireStore()
+
+    def tearDown(self):
+        reset_http_clients()
+        super(IceAndFireStoreHTTPTests, self).tearDown()
+
+    def get_books(self, server, name=None):
+        with mock.patch.object(IceAndFireStore, 'url', server.url + '/api/books'):
+            return self.store.get_books(name)
+
+    def test_connection_reused(self):
+        """Tests that consecutive requests reuse the keep-alive connection."""
+        with StubServer(lambda request: (200, [BOOK_DATA], {})) as server:
+            for __ in range(3):
+                response_data = self.get_books(server)
+                self.assertEqual(response_data['status'], 'success')
+                self.assertEqual(response_data['data'][0]['name'], 'A Game of Thrones')
+        self.assertEqual(len(server.paths), 3)
+        self.assertEqual(len(server.client_addresses), 1)
+
+    @override_settings(BOOK_STORE_HTTP=dict(TEST_HTTP_SETTINGS, READ_TIMEOUT=0.2, MAX_RETRIES=0))
+    def test_read_timeout(self):
+        """Tests that a slow upstream results in an error response."""
+        def slow_handler(request):
+            time.sleep(0.5)
+            return 200, [], {}
+
+        with StubServer(slow_handler) as server:
+            response_data = self.get_books(server)
+        self.assertEqual(response_data['status'], 'error')
+        self.assertEqual(response_data['status_code'], 500)
+
+    def test_retry_unavailable_upstream(self):
+        """Tests that requests answered with 503 are retried."""
+        responses = [(503, {}, {}), (200, [BOOK_DATA], {})]
+        with StubServer(lambda request: responses.pop(0)) as server:
+            response_data = self.get_books(server, name='A Game of Thrones')
+        self.assertEqual(response_data['status'], 'success')
+        self.assertEqual(len(server.paths), 2)
+
+    def test_circuit_breaker_opens(self):
+        """Tests that the requests short circuit to an error while the upstream is failing."""
+        with StubServer(lambda request: (500, {}, {})) as server:
+            for __ in range(TEST_HTTP_SETTINGS['FAILURE_THRESHOLD']):
+                self.assertEqual(self.get_books(server)['status'], 'error')
+            requests_made = len(server.paths)
+
+            response_data = self.get_books(server)
+        self.assertEqual(response_data['status'], 'error')
+        self.assertIn('circuit', response_data['message'])
+        self.assertEqual(len(server.paths), requests_made)
+        self.assertEqual(self.store.circuit_breaker.state, CircuitBreaker.OPEN)
+
+    def test_async_retry_unavailable_upstream(self):
+        """Tests that the async requests answered with 503 are retried alike."""
+        responses = [(503, {}, {}), (503, {}, {}), (200, [BOOK_DATA], {})]
+        with StubServer(lambda request: responses.pop(0)) as server:
+            with mock.patch.object(IceAndFireStore, 'url', server.url + '/api/books'):
+                response_data = asyncio.get_event_loop().run_until_complete(self.store.aget_books())
+        self.assertEqual(response_data['status'], 'success')
+        self.assertEqual(len(server.paths), 3)
+
+    def test_reset_closes_async_clients(self):
+        """Tests that resetting the http clients closes the httpx clients."""
+        loop = asyncio.get_event_loop()
+        client = get_async_client(loop)
+        reset_http_clients()
+        self.assertTrue(client.is_closed)
+        self.assertIsNot(get_async_client(loop), client)
+
+    def test_cancelled_trial_request(self):
+        """Tests that a cancelled trial request opens the circuit again."""
+        def slow_handler(request):
+            time.sleep(0.3)
+            return 200, [], {}
+
+        circuit_breaker = self.store.circuit_breaker
+        circuit_breaker.state = CircuitBreaker.OPEN
+        circuit_breaker.opened_at = time.time() - TEST_HTTP_SETTINGS['RECOVERY_TIMEOUT']
+
+        async def cancel_trial(url):
+            task = asyncio.ensure_future(self.store.ahttp_get(url))
+            await asyncio.sleep(0.05)
+            self.assertEqual(circuit_breaker.state, CircuitBreaker.HALF_OPEN)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        with StubServer(slow_handler) as server:
+            asyncio.get_event_loop().run_until_complete(cancel_trial(server.url + '/api/books'))
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.OPEN)
+
+    def test_client_errors_keep_circuit_closed(self):
+        """Tests that client errors are not counted as failures of the upstream."""
+        with StubServer(lambda request: (404, {}, {})) as server:
+            for __ in range(TEST_HTTP_SETTINGS['FAILURE_THRESHOLD'] + 1):
+                self.assertEqual(self.get_books(server)['status'], 'error')
+        self.assertEqual(len(server.paths), TEST_HTTP_SETTINGS['FAILURE_THRESHOLD'] + 1)
+        self.assertEqual(self.store.circuit_breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(self.store.circuit_breaker.failures, 0)
+
+
+@override_settings(BOOK_STORE_HTTP=TEST_HTTP_SETTINGS)
+class IceAndFireStorePaginationTests(SimpleTestCase):
+    """Tests for following the pages of the Ice and Fire api"""
+
+    def setUp(self):
+        super(IceAndFireStorePaginationTests, self).setUp()
+        reset_http_clients()
+
+    def tearDown(self):
+        reset_http_clients()
+        super(IceAndFireStorePaginationTests, self).tearDown()
+
+    def get_books(self, server, store):
+        with mock.patch.object(IceAndFireStore, 'url', server.url + '/api/books'):
+            return store.get_books()
+
+    def test_all_pages_merged_in_order(self):
+        """Tests that the books of all pages are returned in the upstream order."""
+        upstream = PaginatedUpstream(book_count=23, delay=0.05)
+        with StubServer(upstream) as server:
+            response_data = self.get_books(server, IceAndFireStore(page_size=5, max_workers=4))
+        self.assertEqual(response_data['status'], 'success')
+        self.assertEqual(
+            [book['name'] for book in response_data['data']],
+            ['Book {0}'.format(number) for number in range(23)]
+        )
+        self.assertEqual(len(server.paths), 5)
+        self.assertGreater(upstream.max_in_flight, 1)
+        self.assertLessEqual(upstream.max_in_flight, 4)
+
+    def test_max_pages(self):
+        """Tests that no more than the maximum pages are fetched."""
+        with StubServer(PaginatedUpstream(book_count=23)) as server:
+            response_data = self.get_books(server, IceAndFireStore(page_size=5, max_pages=2))
+        self.assertEqual(len(response_data['data']), 10)
+        self.assertTrue(response_data['truncated'])
+        self.assertEqual(len(server.paths), 2)
+
+    def test_single_page(self):
+        """Tests that a single page is fetched once."""
+        with StubServer(PaginatedUpstream(book_count=3)) as server:
+            response_data = self.get_books(server, IceAndFireStore(page_size=5))
+        self.assertEqual(len(response_data['data']), 3)
+        self.assertNotIn('truncated', response_data)
+        self.assertEqual(len(server.paths), 1)
+
+
+class StaticStore(BookStoreBase):
+    """Store answering with a fixed list of books."""
+    books = [
+        {'name': 'A Game of Thrones', 'isbn': '978-0553103540'},
+        {'name': 'A Clash of Kings', 'isbn': '978-0553108033'},
+    ]
+    delay = 0
+
+    def get_books(self, name=None):
+        time.sleep(self.delay)
+        response_data = get_response_status_info(200)
+        response_data['data'] = list(self.books)
+        return response_data
+
+    async def aget_books(self, name=None):
+        await asyncio.sleep(self.delay)
+        return self.get_books(name)
+
+
+class OtherStore(StaticStore):
+    books = [
+        {'name': 'A Game of Thrones', 'isbn': '9780553103540'},
+        {'name': 'A Storm of Swords', 'isbn': '978-0553106633'},
+    ]
+
+
+class SlowStore(StaticStore):
+    books = [{'name': 'A Feast for Crows', 'isbn': '978-0553801507'}]
+    delay = 0.3
+
+
+class HangingStore(StaticStore):
+    """Store holding the fetches until the release."""
+    release = threading.Event()
+
+    def get_books(self, name=None):
+        self.release.wait(5)
+        return super(HangingStore, self).get_books(name)
+
+
+class FailingStore(BookStoreBase):
+    def get_books(self, name=None):
+        raise RuntimeError('Store is down')
+
+    async def aget_books(self, name=None):
+        raise RuntimeError('Store is down')
+
+
+def store_path(store_class):
+    return '{0}.{1}'.format(store_class.__module__, store_class.__name__)
+
+
+@override_settings(BOOK_STORE_CACHE={'ENABLED': False})
+class BookStoreFanOutTests(SimpleTestCase):
+    """Tests for querying several active stores"""
+
+    def get_names(self, response_data):
+        return [book['name'] for book in response_data['data']]
+
+    def get_store_statuses(self, response_data):
+        return [info['status'] for info in response_data['stores']]
+
+    @override_settings(ACTIVE_BOOK_STORES=[store_path(StaticStore), store_path(OtherStore)])
+    def test_merged_and_deduplicated_by_isbn(self):
+        """Tests that the books of all stores are merged in order without duplicates."""
+        response_data = BookStore().get_books(None)
+        self.assertEqual(response_data['status'], 'success')
+        self.assertFalse(response_data['partial'])
+        self.assertEqual(
+            self.get_names(response_data),
+            ['A Game of Thrones', 'A Clash of Kings', 'A Storm of Swords']
+        )
+
+    @override_settings(ACTIVE_BOOK_STORES=[store_path(StaticStore), store_path(FailingStore)])
+    def test_failing_store_partial_result(self):
+        """Tests that a failing store results in a partial response."""
+        response_data = BookStore().get_books(None)
+        self.assertEqual(response_data['status'], 'success')
+        self.assertTrue(response_data['partial'])
+        self.assertEqual(self.get_store_statuses(response_data), ['success', 'error'])
+        self.assertEqual(response_data['stores'][1]['message'], 'Store is down')
+
+    @override_settings(ACTIVE_BOOK_STORES=[
+        store_path(StaticStore), {'BACKEND': store_path(SlowStore), 'DEADLINE': 0.05}
+    ])
+    def test_store_deadline(self):
+        """Tests that a store missing its deadline does not hold up the response."""
+        started_at = time.time()
+        response_data = BookStore().get_books(None)
+        self.assertLess(time.time() - started_at, SlowStore.delay)
+        self.assertEqual(self.get_store_statuses(response_data), ['success', 'timeout'])
+        self.assertEqual(self.get_names(response_data), ['A Game of Thrones', 'A Clash of Kings'])
+
+    @override_settings(ACTIVE_BOOK_STORES=[
+        {'BACKEND': store_path(StaticStore), 'DEADLINE': 1}, {'BACKEND': store_path(HangingStore), 'DEADLINE': 0.01}
+    ])
+    def test_late_fetches_keep_other_stores_answering(self):
+        """Tests that the late fetches of a store do not take the threads of the other stores."""
+        self.addCleanup(HangingStore.release.set)
+        with mock.patch('api.book_stores.FAN_OUT_WORKERS', 2):
+            for __ in range(4):
+                response_data = BookStore().get_books(None)
+                self.assertEqual(self.get_store_statuses(response_data), ['success', 'timeout'])
+
+    @override_settings(ACTIVE_BOOK_STORES=[store_path(StaticStore), store_path(FailingStore)])
+    def test_pool_threads_close_their_connections(self):
+        """Tests that the pool threads close their database connections after each fetch."""
+        with mock.patch('api.book_stores.connections') as connections:
+            BookStore().get_books(None)
+            asyncio.get_event_loop().run_until_complete(BookStoreBase.aget_books(StaticStore(), None))
+        self.assertEqual(connections.close_all.call_count, 3)
+
+    @override_settings(ACTIVE_BOOK_STORES=[store_path(FailingStore), store_path(FailingStore)])
+    def test_all_stores_failing(self):
+        """Tests that the response is an error when no store answers."""
+        response_data = BookStore().get_books(None)
+        self.assertEqual(response_data['status'], 'error')
+        self.assertEqual(response_data['status_code'], 500)
+
+    @override_settings(ACTIVE_BOOK_STORES=[
+        store_path(OtherStore), {'BACKEND': store_path(SlowStore), 'DEADLINE': 0.05}, store_path(FailingStore)
+    ])
+    def test_async_fan_out(self):
+        """Tests that the async fan out applies the deadlines and merges the results alike."""
+        response_data = asyncio.get_event_loop().run_until_complete(BookStore().aget_books(None))
+        self.assertEqual(self.get_store_statuses(response_data), ['success', 'timeout', 'error'])
+        self.assertEqual(self.get_names(response_data), ['A Game of Thrones', 'A Storm of Swords'])
+
+
+class GatedStore(StaticStore):
+    """Store holding the fetches until the gate opens, counting the calls."""
+    calls = []
+    gate = threading.Event()
+
+    def get_books(self, name=None):
+        self.calls.append(name)
+        self.gate.wait(5)
+        return super(GatedStore, self).get_books(name)
+
+    async def aget_books(self, name=None):
+        self.calls.append(name)
+        while not self.gate.is_set():
+            await asyncio.sleep(0.01)
+        return super(GatedStore, self).get_books(name)
+
+
+class FailingGatedStore(GatedStore):
+    def get_books(self, name=None):
+        super(FailingGatedStore, self).get_books(name)
+        raise RuntimeError('Store is down')
+
+
+@override_settings(BOOK_STORE_CACHE={'ENABLED': False}, ACTIVE_BOOK_STORES=[store_path(GatedStore)])
+class BookStoreCoalescingTests(SimpleTestCase):
+    """Tests for sharing the concurrent fetches of a query"""
+
+    def setUp(self):
+        super(BookStoreCoalescingTests, self).setUp()
+        GatedStore.calls = []
+        GatedStore.gate = threading.Event()
+        self.single_flight = get_single_flight()
+        if self.single_flight is not None:
+            self.single_flight.clear_stats()
+
+    def wait_for_callers(self, count):
+        """Waits until `count` fetches are coalesced with the one in flight."""
+        deadline = time.time() + 5
+        while self.single_flight.stats['coalesced'] < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def fetch_in_threads(self, names):
+        results, errors = [None] * len(names), [None] * len(names)
+
+        def fetch(index, name):
+            try:
+                results[index] = BookStore().get_books(name)
+            except Exception as ex:
+                errors[index] = ex
+
+        threads = [threading.Thread(target=fetch, args=item) for item in enumerate(names)]
+        for thread in threads:
+            thread.start()
+        return threads, results, errors
+
+    def test_concurrent_threads_share_the_fetch(self):
+        """Tests that threads fetching the same query while it is in flight share its result."""
+        threads, results, errors = self.fetch_in_threads(['A Game of Thrones', ' A Game  of Thrones'] * 3)
+        self.wait_for_callers(5)
+        GatedStore.gate.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(GatedStore.calls), 1)
+        self.assertEqual(errors, [None] * 6)
+        self.assertEqual(results, [results[0]] * 6)
+        self.assertEqual(self.single_flight.stats, {'originated': 1, 'coalesced': 5})
+        self.assertEqual(self.single_flight.in_flight(), 0)
+
+    def test_different_queries_not_coalesced(self):
+        """Tests that only the fetches of the same normalized query are shared."""
+        GatedStore.gate.set()
+        threads, results, errors = self.fetch_in_threads(['A Game of Thrones', 'A Clash of Kings'])
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(GatedStore.calls), ['A Clash of Kings', 'A Game of Thrones'])
+        self.assertEqual(self.single_flight.stats, {'originated': 2, 'coalesced': 0})
+
+    def test_sequential_fetches_not_coalesced(self):
+        """Tests that a fetch after the call is done calls the stores again."""
+        GatedStore.gate.set()
+        BookStore().get_books('A Game of Thrones')
+        BookStore().get_books('A Game of Thrones')
+        self.assertEqual(len(GatedStore.calls), 2)
+
+    @override_settings(ACTIVE_BOOK_STORES=[store_path(FailingGatedStore)])
+    def test_exception_shared(self):
+        """Tests that the coalesced fetches get the exception of the call."""
+        threads, results, errors = self.fetch_in_threads(['A Game of Thrones'] * 3)
+        self.wait_for_callers(2)
+        GatedStore.gate.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(GatedStore.calls), 1)
+        self.assertEqual([str(error) for error in errors], ['Store is down'] * 3)
+        self.assertEqual(self.single_flight.in_flight(), 0)
+
+    def test_concurrent_tasks_share_the_fetch(self):
+        """Tests that asyncio tasks fetching the same query share its result."""
+        async def fetch_all():
+            tasks = [asyncio.ensure_future(BookStore().aget_books('A Game of Thrones')) for __ in range(4)]
+            await asyncio.sleep(0.05)
+            GatedStore.gate.set()
+            return await asyncio.gather(*tasks)
+
+        results = asyncio.get_event_loop().run_until_complete(fetch_all())
+        self.assertEqual(len(GatedStore.calls), 1)
+        self.assertEqual(results, [results[0]] * 4)
+        self.assertEqual(self.single_flight.stats, {'originated': 1, 'coalesced': 3})
+
+    def test_task_joins_thread_fetch(self):
+        """Tests that an asyncio task joins the fetch of a thread in flight."""
+        threads, results, errors = self.fetch_in_threads(['A Game of Thrones'])
+        while not GatedStore.calls:
+            time.sleep(0.01)
+        loop = asyncio.get_event_loop()
+        task = asyncio.ensure_future(BookStore().aget_books('A Game of Thrones'))
+        loop.call_later(0.05, GatedStore.gate.set)
+        response_data = loop.run_until_complete(task)
+        threads[0].join()
+
+        self.assertEqual(len(GatedStore.calls), 1)
+        self.assertEqual(response_data, results[0])
+        self.assertEqual(self.single_flight.stats, {'originated': 1, 'coalesced': 1})
+
+    def test_cancelled_originator(self):
+        """Tests that the waiters of a cancelled task are not cancelled, one of them fetches again."""
+        loop = asyncio.get_event_loop()
+
+        async def fetch_all():
+            originator = asyncio.ensure_future(BookStore().aget_books('A Game of Thrones'))
+            await asyncio.sleep(0.05)
+            waiter = asyncio.ensure_future(BookStore().aget_books('A Game of Thrones'))
+            await asyncio.sleep(0.05)
+            originator.cancel()
+            await asyncio.sleep(0.05)
+            GatedStore.gate.set()
+            return await waiter
+
+        response_data = loop.run_until_complete(fetch_all())
+        self.assertEqual(response_data['status'], 'success')
+        self.assertEqual(len(GatedStore.calls), 2)
+        self.assertEqual(self.single_flight.stats, {'originated': 2, 'coalesced': 1})
+        self.assertEqual(self.single_flight.in_flight(), 0)
+
+    @override_settings(BOOK_STORE_COALESCING={'ENABLED': False})
+    def test_coalescing_disabled(self):
+        """Tests that every fetch calls the stores with coalescing disabled."""
+        self.assertIsNone(get_single_flight())
+        threads, results, errors = self.fetch_in_threads(['A Game of Thrones'] * 3)
+        while len(GatedStore.calls) < 3:
+            time.sleep(0.01)
+        GatedStore.gate.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(GatedStore.calls), 3)
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def test_half_open_after_recovery_timeout(self):
+        """Tests that a trial request closes the circuit after the recovery timeout."""
+        circuit_breaker = CircuitBreaker('upstream', failure_threshold=1, recovery_timeout=10)
+        circuit_breaker.record_failure()
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.OPEN)
+
+        with mock.patch('api.http_client.time.time', return_value=time.time() + 11):
+            circuit_breaker.before_request()
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.HALF_OPEN)
+        circuit_breaker.record_success()
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.CLOSED)
+
+    def test_failed_trial_reopens(self):
+        """Tests that a failed trial request opens the circuit again."""
+        circuit_breaker = CircuitBreaker('upstream', failure_threshold=3, recovery_timeout=0)
+        circuit_breaker.state = CircuitBreaker.HALF_OPEN
+        circuit_breaker.record_failure()
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.OPEN)
+
+    def test_cancel_keeps_circuit_closed(self):
+        """Tests that cancelled requests are not counted as failures of the upstream."""
+        circuit_breaker = CircuitBreaker('upstream', failure_threshold=1, recovery_timeout=10)
+        circuit_breaker.record_cancel()
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(circuit_breaker.failures, 0)
+
+    def test_cancelled_trial_reopens(self):
+        """Tests that a cancelled trial request opens the circuit again."""
+        circuit_breaker = CircuitBreaker('upstream', failure_threshold=3, recovery_timeout=0)
+        circuit_breaker.state = CircuitBreaker.HALF_OPEN
+        circuit_breaker.record_cancel()
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.OPEN)
@@ -0,0 +1,117 @@
+import time
+
+import mock
+from django.test import SimpleTestCase, override_settings
+
+from api.caches import BookStoreCache, RepresentationCache, get_book_store_cache
+
+SUCCESS_RESPONSE = {'data': [], 'status': 'success', 'status_code': 200}
+ERROR_RESPONSE = {'status': 'error', 'status_code': 500, 'message': 'failed'}
+
+
+class BookStoreCacheTests(SimpleTestCase):
+    def setUp(self):
+        super(BookStoreCacheTests, self).setUp()
+        self.store_cache = BookStoreCache(timeout=60, stale_timeout=60, max_entries=2)
+        self.fetch = mock.Mock(return_value=SUCCESS_RESPONSE)
+
+    def tearDown(self):
+        self.store_cache.clear()
+        super(BookStoreCacheTests, self).tearDown()
+
+    def test_hit_and_miss_counters(self):
+        """Tests that the first query is a miss and the repeated query a hit."""
+        self.store_cache.get_or_fetch('A Game of Thrones', self.fetch)
+        data = self.store_cache.get_or_fetch('A  Game of Thrones ', self.fetch)
+        self.assertEqual(data, SUCCESS_RESPONSE)
+        self.assertEqual(self.fetch.call_count, 1)
+        self.assertEqual(self.store_cache.stats['misses'], 1)
+        self.assertEqual(self.store_cache.stats['hits'], 1)
+
+    def test_error_response_not_cached(self):
+        """Tests that error responses are fetched again on the next query."""
+        self.fetch.return_value = ERROR_RESPONSE
+        self.store_cache.get_or_fetch('A Game of Thrones', self.fetch)
+        self.store_cache.get_or_fetch('A Game of Thrones', self.fetch)
+        self.assertEqual(self.fetch.call_count, 2)
+
+    def test_least_recently_used_eviction(self):
+        """Tests that the least recently used entry is evicted beyond max entries."""
+        self.store_cache.get_or_fetch('first', self.fetch)
+        self.store_cache.get_or_fetch('second', self.fetch)
+        self.store_cache.get_or_fetch('first', self.fetch)
+        self.store_cache.get_or_fetch('third', self.fetch)
+        self.assertEqual(self.store_cache.stats['evictions'], 1)
+        self.assertIsNone(self.store_cache.cache.get(self.store_cache.make_key('second')))
+        self.assertIsNotNone(self.store_cache.cache.get(self.store_cache.make_key('first')))
+
+    def test_stale_while_revalidate(self):
+        """Tests that an expired entry is served stale while it is refreshed."""
+        self.store_cache.get_or_fetch('A Game of Thrones', self.fetch)
+        refreshed_response = dict(SUCCESS_RESPONSE, data=[{'name': 'A Game of Thrones'}])
+        self.fetch.return_value = refreshed_response
+
+        with mock.patch('api.caches.time.time', return_value=time.time() + 90):
+            data = self.store_cache.get_or_fetch('A Game of Thrones', self.fetch)
+            self.assertEqual(data, SUCCESS_RESPONSE)
+            self.store_cache.wait_for_refreshes()
+
+        self.assertEqual(self.store_cache.stats['stale_hits'], 1)
+        self.assertEqual(self.store_cache.stats['refreshes'], 1)
+        self.assertEqual(self.store_cache.get_or_fetch('A Game of Thrones', self.fetch), refreshed_response)
+
+    @override_settings(BOOK_STORE_CACHE={'ENABLED': False})
+    def test_cache_disabled(self):
+        """Tests that the cache can be disabled from the settings."""
+        self.assertIsNone(get_book_store_cache())
+
+
+class RepresentationCacheTests(SimpleTestCase):
+    def setUp(self):
+        super(RepresentationCacheTests, self).setUp()
+        self.representation_cache = RepresentationCache('test-representation')
+        self.representation_cache.invalidate_all()
+        self.fetch = mock.Mock(side_effect=lambda pks: [mock.Mock(pk=pk) for pk in pks])
+        self.serialize = mock.Mock(side_effect=lambda instances: [{'id': instance.pk} for instance in instances])
+
+    def get_many(self, pks):
+        return self.representation_cache.get_many(pks, self.fetch, self.serialize)
+
+    def test_only_misses_are_serialized(self):
+        """Tests that the cached representations are reused and the missing ones rendered."""
+        self.get_many([1, 2])
+        self.assertEqual(self.get_many([3, 2, 1]), [{'id': 3}, {'id': 2}, {'id': 1}])
+        self.fetch.assert_called_with([3])
+        self.assertEqual(self.serialize.call_count, 2)
+
+    def test_invalidate(self):
+        self.get_many([1, 2])
+        self.representation_cache.invalidate([2])
+        self.get_many([1, 2])
+        self.fetch.assert_called_with([2])
+
+    def test_invalidate_all(self):
+        self.get_many([1, 2])
+        self.representation_cache.invalidate_all()
+        self.get_many([1, 2])
+        self.fetch.assert_called_with([1, 2])
+
+    def test_invalidate_all_with_evicted_generation(self):
+        """Tests that the entries are retired when the generation key was evicted."""
+        self.get_many([1, 2])
+        self.representation_cache.cache.delete(self.representation_cache.generation_key)
+        with mock.patch('api.caches.time.time', return_value=time.time() + 1):
+            self.representation_cache.invalidate_all()
+        self.get_many([1, 2])
+        self.fetch.assert_called_with([1, 2])
+
+    def test_disabled_on_process_local_cache(self):
+        """Tests that the cache is off by default when the cache is local to the process."""
+        self.assertIsNone(RepresentationCache.from_settings('test-representation', 'TEST_CACHE', {
+            'ENABLED': None, 'CACHE_ALIAS': 'default', 'TIMEOUT': 300,
+        }))
+
+    def test_missing_instances_are_skipped(self):
+        """Tests that the instances which no longer exist are left out."""
+        self.fetch.side_effect = lambda pks: [mock.Mock(pk=pk) for pk in pks if pk != 2]
+        self.assertEqual(self.get_many([1, 2, 3]), [{'id': 1}, {'id': 3}])
@@ -0,0 +1,117 @@
+from datetime import timedelta
+
+from django.test import TestCase
+from django.utils import timezone
+
+from api.changes import (
+    ChangesCompacted, collapse_book_changes, compact_book_changes, get_book_changes, get_current_cursor
+)
+from api.conditional import BOOKS_COUNTER, get_change_counter
+from api.models import BookChange
+from api.signals import collect_books_changes
+from api.tests.factories import BookFactory
+
+
+class BookChangesTests(TestCase):
+    def setUp(self):
+        self.book1 = BookFactory()
+        self.book2 = BookFactory()
+        for book in (self.book1, self.book2, self.book1):
+            book.number_of_pages += 1
+            book.save()
+        self.book2_id = self.book2.pk
+        self.book2.delete()
+
+    def get_entries(self):
+        return list(BookChange.objects.values_list('book_id', 'action'))
+
+    def age_entries(self, days):
+        BookChange.objects.update(changed_at=timezone.now() - timedelta(days=days))
+
+    def test_books_changes_are_recorded(self):
+        """Tests that the books creates, saves, authors changes and deletes are recorded in order."""
+        book1, book2 = self.book1.pk, self.book2_id
+        self.assertEqual(self.get_entries(), [
+            # The factories add the authors and save the books again.
+            (book1, 'created'), (book1, 'updated'), (book1, 'updated'),
+            (book2, 'created'), (book2, 'updated'), (book2, 'updated'),
+            (book1, 'updated'), (book2, 'updated'), (book1, 'updated'),
+            (book2, 'deleted'),
+        ])
+
+    def test_get_book_changes(self):
+        entries = list(BookChange.objects.all())
+        changes, has_more = get_book_changes(entries[0].id, 2)
+        self.assertEqual(changes, entries[1:3])
+        self.assertTrue(has_more)
+        changes, has_more = get_book_changes(entries[-3].id, 2)
+        self.assertEqual(changes, entries[-2:])
+        self.assertFalse(has_more)
+        self.assertEqual(get_current_cursor(), entries[-1].id)
+
+    def test_compaction_keeps_the_last_entry_per_book(self):
+        """Tests that the superseded entries older than the threshold are deleted."""
+        cursor = BookChange.objects.earliest('id').id - 1
+        self.age_entries(2)
+        self.book1.save()
+        compacted, truncated = compact_book_changes(timezone.now() - timedelta(days=1))
+        self.assertEqual(truncated, 0)
+        self.assertGreater(compacted, 0)
+        # The recent entry of book1 supersedes its old updates.
+        self.assertEqual(self.get_entries(), [
+            (self.book1.pk, 'created'), (self.book2_id, 'deleted'), (self.book1.pk, 'updated')
+        ])
+        # Cursors from before the compaction are still served, with book1 as created.
+        changes = get_book_changes(cursor, 10)[0]
+        self.assertEqual(
+            [(change.book_id, action) for change, action in collapse_book_changes(changes, {self.book1.pk})],
+            [(self.book2_id, 'deleted'), (self.book1.pk, 'created')]
+        )
+
+    def test_recent_entries_are_not_compacted(self):
+        entries = self.get_entries()
+        self.assertEqual(compact_book_changes(timezone.now() - timedelta(days=1)), (0, 0))
+        self.assertEqual(self.get_entries(), entries)
+
+    def test_truncation_moves_the_horizon(self):
+        """Tests that the entries past the retention are deleted and the older cursors refused."""
+        old_cursor = BookChange.objects.latest('id').id - 1
+        self.age_entries(40)
+        self.book1.save()
+        cursor = get_current_cursor() - 1
+        compacted, truncated = compact_book_changes(
+            timezone.now() - timedelta(days=1), timezone.now() - timedelta(days=30)
+        )
+        self.assertEqual(self.get_entries(), [(self.book1.pk, 'updated')])
+        with self.assertRaises(ChangesCompacted):
+            get_book_changes(old_cursor, 10)
+        self.assertEqual(len(get_book_changes(cursor, 10)[0]), 1)
+
+        # The current cursor does not go back when the log is emptied.
+        self.age_entries(40)
+        compact_book_changes(timezone.now(), timezone.now() - timedelta(days=30))
+        self.assertEqual(self.get_entries(), [])
+        self.assertEqual(get_current_cursor(), cursor + 1)
+
+    def test_changes_are_collected_per_block(self):
+        """Tests that the changes of a block are recorded once per book at its end."""
+        cursor = get_current_cursor()
+        with collect_books_changes():
+            book = BookFactory()
+            self.book1.save()
+            book.save()
+            self.assertEqual(get_current_cursor(), cursor)
+        self.assertEqual(self.get_entries()[-2:], [(book.pk, 'created'), (self.book1.pk, 'updated')])
+
+        with self.assertRaises(ValueError), collect_books_changes():
+            self.book1.save()
+            raise ValueError()
+        self.assertEqual(get_current_cursor(), cursor + 2)
+
+    def test_renames_bump_the_counter_once(self):
+        """Tests that renaming a name rendered with the books bumps the books counter once."""
+        for instance in (self.book1.publisher, self.book1.country, self.book1.authors.first()):
+            version = get_change_counter(BOOKS_COUNTER)[0]
+            instance.name += ' renamed'
+            instance.save()
+            self.assertEqual(get_change_counter(BOOKS_COUNTER)[0], version + 1)
@@ -0,0 +1,95 @@
+from datetime import timedelta
+
+import mock
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.six import StringIO
+
+from api.book_stores import IceAndFireStore
+from api.models import Author, Book, BookChange, Country, MirroredBook, Publisher
+from api.tests.factories import BookFactory
+from api.tests.utils import PaginatedUpstream, StubServer
+
+
+class GenerateBooksCommandTests(TestCase):
+    def call_command(self, *args):
+        out = StringIO()
+        call_command('generate_books', *args, stdout=out)
+        return out.getvalue()
+
+    def test_generate_books(self):
+        """Tests that the books are generated one by one."""
+        self.call_command('--batch_size=3')
+        self.assertEqual(Book.objects.count(), 3)
+
+    def test_generate_books_in_bulk(self):
+        """Tests that the bulk mode generates the books with their relations."""
+        output = self.call_command('--batch_size=25', '--bulk', '--chunk_size=10')
+        self.assertEqual(Book.objects.count(), 25)
+        self.assertEqual(Country.objects.count(), 7)
+        self.assertEqual(Publisher.objects.count(), 3)
+        self.assertEqual(Author.objects.count(), 4)
+        self.assertIn('Books Created: 10/25', output)
+        self.assertIn('25 books created', output)
+
+    def test_bulk_queries_per_chunk(self):
+        """Tests that the number of queries depends on the chunks, not the books."""
+        self.call_command('--batch_size=1', '--bulk')
+        with CaptureQueriesContext(connection) as small_batch:
+            self.call_command('--batch_size=10', '--bulk', '--chunk_size=10')
+        Book.objects.all().delete()
+        with CaptureQueriesContext(connection) as large_batch:
+            self.call_command('--batch_size=100', '--bulk', '--chunk_size=100')
+        self.assertEqual(len(small_batch.captured_queries), len(large_batch.captured_queries))
+
+    def test_large_chunks_stay_under_the_parameters_limit(self):
+        """Tests that the ids of a chunk larger than the parameters limit are fetched in several queries."""
+        with CaptureQueriesContext(connection) as context:
+            self.call_command('--batch_size=1000', '--bulk', '--chunk_size=1000')
+        self.assertEqual(Book.objects.count(), 1000)
+        isbn_queries = [query['sql'] for query in context.captured_queries if '"isbn" IN' in query['sql']]
+        self.assertEqual(len(isbn_queries), 2)
+
+
+@override_settings(BOOK_STORE_HTTP={'MAX_RETRIES': 0})
+class SyncExternalBooksCommandTests(TestCase):
+    def call_command(self, server):
+        out = StringIO()
+        with mock.patch.object(IceAndFireStore, 'url', server.url + '/api/books'):
+            call_command('sync_external_books', stdout=out)
+        return out.getvalue()
+
+    def test_sync_external_books(self):
+        """Tests that the upstream catalog is mirrored and re-synced without writes."""
+        with StubServer(PaginatedUpstream(book_count=60)) as server:
+            output = self.call_command(server)
+            self.assertIn('60 created, 0 updated, 0 deleted, 0 unchanged', output)
+            self.assertIn('0 created, 0 updated, 0 deleted, 60 unchanged', self.call_command(server))
+        self.assertEqual(MirroredBook.objects.count(), 60)
+
+    def test_upstream_error(self):
+        """Tests that an upstream error fails the command."""
+        with StubServer(lambda request: (503, {}, {})) as server:
+            with self.assertRaises(CommandError):
+                self.call_command(server)
+
+
+class CompactBookChangesCommandTests(TestCase):
+    def call_command(self, *args):
+        out = StringIO()
+        call_command('compact_book_changes', *args, stdout=out)
+        return out.getvalue()
+
+    def test_compact_book_changes(self):
+        """Tests that the superseded and the expired entries are deleted."""
+        BookFactory()
+        book = BookFactory()
+        BookChange.objects.update(changed_at=timezone.now() - timedelta(days=2))
+        book.save()
+        # All but the creation and the last entry of each book, the factories save the books three times.
+        self.assertIn('3 superseded and 0 expired entries deleted', self.call_command())
+        self.assertIn('0 superseded and 3 expired entries deleted', self.call_command('--retention=3600'))
+        self.assertEqual(BookChange.objects.count(), 1)
@@ -0,0 +1,71 @@
+from unittest import skipUnless
+
+from django.db import connection
+from django.test import TestCase
+
+from api.filters import BookFilter
+from api.models import Book
+from api.serializers import BookSerializer
+from api.tests.factories import BookFactory
+
+
+def explain(queryset):
+    """Returns the query plan of the queryset as text."""
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return '\n'.join(row[-1] for row in cursor.fetchall())
+        # Postgres prefers sequential scans on tiny tables, discourage them to see the usable indexes.
+        cursor.execute('SET LOCAL enable_seqscan = off')
+        cursor.execute('EXPLAIN ' + sql, params)
+        return '\n'.join(row[0] for row in cursor.fetchall())
+
+
+@skipUnless(connection.vendor in ('sqlite', 'postgresql'), 'Query plans are checked for SQLite and Postgres')
+class BookFilterQueryPlanTests(TestCase):
+    """Tests that the book filters and the default ordering are answered from indexes"""
+
+    @classmethod
+    def setUpTestData(cls):
+        for number in range(20):
+            BookFactory(release_date='20{0:02d}-06-01'.format(number))
+
+    def get_plan(self, filters):
+        queryset = BookSerializer.setup_eager_loading(Book.objects.all())
+        return explain(BookFilter(filters, queryset=queryset).qs)
+
+    def assert_uses_index(self, plan, index_name):
+        self.assertIn(index_name, plan)
+
+    def assert_no_sort(self, plan):
+        self.assertNotIn('TEMP B-TREE FOR ORDER BY', plan)
+        self.assertNotIn('Sort Key', plan)
+
+    def test_unfiltered_list(self):
+        """Tests that the default ordering is read from the ordering index."""
+        plan = self.get_plan({})
+        self.assert_uses_index(plan, 'book_ordering_idx')
+        self.assert_no_sort(plan)
+
+    def test_filter_by_name(self):
+        """Tests that the name filter searches the ordering index and needs no sort."""
+        plan = self.get_plan({'name': 'Book 1'})
+        self.assert_uses_index(plan, 'book_ordering_idx')
+        self.assert_no_sort(plan)
+
+    def test_filter_by_isbn(self):
+        """Tests that the isbn filter searches the unique isbn index."""
+        plan = self.get_plan({'isbn': 'isbn_1'})
+        self.assert_uses_index(plan, 'isbn')
+
+    def test_filter_by_release_year(self):
+        """Tests that the release year filter is a range search on the release date index."""
+        plan = self.get_plan({'release_date': '2018'})
+        self.assert_uses_index(plan, 'book_release_date_idx')
+
+    def test_filter_by_publisher(self):
+        """Tests that the publisher filter searches the publisher name and book publisher indexes."""
+        plan = self.get_plan({'publisher': 'Lahore Books'})
+        self.assert_uses_index(plan, 'api_publisher_name')
+        self.assert_uses_index(plan, 'api_book_publisher_id')
@@ -0,0 +1,132 @@
+import asyncio
+import re
+import time
+
+import mock
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.reverse import reverse
+from rest_framework.test import APITestCase
+
+from api.caches import get_book_store_cache
+from api.instrumentation import Histogram, RequestMetrics, get_metrics_registry, record_time
+from api.tests.factories import BookFactory
+from api.tests.test_views import MockResponse
+
+SERVER_TIMING = re.compile(
+    r'^db;dur=[\d.]+;desc="(\d+) queries", '
+    r'serializer;dur=([\d.]+);desc="Serialization", '
+    r'upstream;dur=([\d.]+);desc="Book stores", '
+    r'total;dur=([\d.]+);desc="Total"$'
+)
+
+
+class HistogramTests(SimpleTestCase):
+    def test_cumulative_buckets(self):
+        histogram = Histogram((1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value)
+        self.assertEqual(list(histogram.get_samples()), [(1, 2), (5, 3), ('+Inf', 4)])
+        self.assertEqual(histogram.sum, 14.5)
+        self.assertEqual(histogram.count, 4)
+
+
+class RecordTimeTests(SimpleTestCase):
+    def test_outside_of_a_request(self):
+        """Tests that timing outside of a sampled request does nothing."""
+        with record_time('db'):
+            pass
+        self.assertEqual(record_time('db')(lambda: 42)(), 42)
+
+    def test_coroutine_function(self):
+        """Tests that a decorated coroutine function is timed until its coroutine returns."""
+        metrics = RequestMetrics()
+
+        @record_time('upstream')
+        async def fetch():
+            await asyncio.sleep(0.01)
+            return 42
+
+        with mock.patch('api.instrumentation.get_request_metrics', return_value=metrics):
+            self.assertEqual(asyncio.get_event_loop().run_until_complete(fetch()), 42)
+        self.assertGreaterEqual(metrics.timings['upstream'], 0.01)
+
+
+@override_settings(API_METRICS={'SAMPLE_RATE': 1.0, 'ALLOWED_IPS': ('127.0.0.1',)})
+class MetricsMiddlewareTests(APITestCase):
+    books_api_url = reverse('api:v1:books-list')
+    metrics_url = reverse('api:metrics')
+
+    def setUp(self):
+        super(MetricsMiddlewareTests, self).setUp()
+        get_book_store_cache().clear()
+        BookFactory()
+        BookFactory()
+
+    def get_server_timing(self, response):
+        match = SERVER_TIMING.match(response['Server-Timing'])
+        self.assertIsNotNone(match, response['Server-Timing'])
+        return match.groups()
+
+    def test_server_timing(self):
+        """Tests that a sampled response reports its query count and timings."""
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.books_api_url)
+        query_count, serializer_time, upstream_time, total_time = self.get_server_timing(response)
+        self.assertEqual(int(query_count), len(context.captured_queries))
+        self.assertGreater(float(serializer_time), 0)
+        self.assertEqual(float(upstream_time), 0)
+        self.assertGreaterEqual(float(total_time), float(serializer_time))
+
+    @mock.patch('requests.Session.get')
+    def test_upstream_time(self, session_get):
+        def slow_get(*args, **kwargs):
+            time.sleep(0.01)
+            return MockResponse
+        session_get.side_effect = slow_get
+        response = self.client.get(reverse('api:external_books'))
+        self.assertGreaterEqual(float(self.get_server_timing(response)[2]), 10)
+
+    @override_settings(API_METRICS={'SAMPLE_RATE': 0, 'ALLOWED_IPS': ('127.0.0.1',)})
+    def test_unsampled_requests(self):
+        self.client.get(self.books_api_url)
+        response = self.client.get(self.books_api_url)
+        self.assertNotIn('Server-Timing', response)
+        self.assertNotIn('view="BookViewSet.list"', self.client.get(self.metrics_url).content.decode('utf-8'))
+
+    @override_settings(API_METRICS={'SAMPLE_RATE': 1.0, 'SERVER_TIMING': False})
+    def test_server_timing_disabled(self):
+        self.assertNotIn('Server-Timing', self.client.get(self.books_api_url))
+
+    def test_prometheus_export(self):
+        """Tests that the histograms are exported by view and action."""
+        self.client.get(self.books_api_url)
+        self.client.get(self.books_api_url)
+        self.client.get('{0}{1}/'.format(self.books_api_url, BookFactory().id))
+        response = self.client.get(self.metrics_url)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        content = response.content.decode('utf-8')
+        self.assertIn('# TYPE api_request_duration_seconds histogram', content)
+        self.assertIn('api_request_duration_seconds_count{view="BookViewSet.list"} 2', content)
+        self.assertIn('api_request_duration_seconds_count{view="BookViewSet.retrieve"} 1', content)
+        self.assertIn('api_db_queries_bucket{view="BookViewSet.list",le="+Inf"} 2', content)
+        self.assertIn('api_upstream_duration_seconds_sum{view="BookViewSet.list"} 0.0', content)
+        self.assertIn('# TYPE api_book_store_calls_total counter', content)
+        self.assertIn('api_book_store_calls_total{call="coalesced"}', content)
+
+    @override_settings(API_METRICS={'SAMPLE_RATE': 1.0})
+    def test_metrics_access(self):
+        """Tests that only the staff users and the allowed ips may read the metrics."""
+        self.assertEqual(self.client.get(self.metrics_url).status_code, 403)
+        user = User.objects.create_user('reader', password='password')
+        self.client.force_login(user)
+        self.assertEqual(self.client.get(self.metrics_url).status_code, 403)
+        user.is_staff = True
+        user.save()
+        self.assertEqual(self.client.get(self.metrics_url).status_code, 200)
+
+    def test_clear(self):
+        get_metrics_registry().clear()
+        self.assertNotIn('BookViewSet', get_metrics_registry().render())
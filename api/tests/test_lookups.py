@@ -0,0 +1,98 @@
+import time
+
+import mock
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from api.lookups import clear_reference_caches, reference_caches, sync_reference_caches
+from api.models import Author, Country, Publisher
+from api.serializers import AuthorSerializer, CountryField, NameLookups, PublisherField
+from api.tests.factories import AuthorFactory, CountryFactory, PublisherFactory
+
+
+class ReferenceCacheTests(TestCase):
+    def setUp(self):
+        super(ReferenceCacheTests, self).setUp()
+        clear_reference_caches()
+        self.country = CountryFactory(name='Pakistan')
+        self.publisher = PublisherFactory(name='Traverse')
+        self.author = AuthorFactory(name='Awais Jibran')
+
+    def test_repeated_names_cost_no_queries(self):
+        """Tests that the names are fetched from the database once with the default settings."""
+        for __ in range(2):
+            self.assertEqual(CountryField().to_internal_value('Pakistan'), self.country)
+            self.assertEqual(PublisherField().to_internal_value('Traverse'), self.publisher)
+            self.assertEqual(AuthorSerializer().to_internal_value('Awais Jibran'), self.author)
+
+        with self.assertNumQueries(0):
+            CountryField().to_internal_value('Pakistan')
+            PublisherField().to_internal_value('Traverse')
+            AuthorSerializer().to_internal_value('Awais Jibran')
+            NameLookups([{'country': 'Pakistan', 'publisher': 'Traverse', 'authors': ['Awais Jibran']}])
+
+    def test_rename_invalidates(self):
+        """Tests that renaming an instance invalidates the cached instances of the model."""
+        reference_caches[Country].get('Pakistan')
+        self.country.name = 'Turkey'
+        self.country.save()
+        with self.assertRaises(Country.DoesNotExist):
+            reference_caches[Country].get('Pakistan')
+        self.assertEqual(reference_caches[Country].get('Turkey'), self.country)
+
+    def test_delete_invalidates(self):
+        """Tests that deleting an instance invalidates the cached instances of the model."""
+        reference_caches[Publisher].get('Traverse')
+        self.publisher.delete()
+        with self.assertRaises(Publisher.DoesNotExist):
+            reference_caches[Publisher].get('Traverse')
+
+    def test_create_keeps_cache(self):
+        """Tests that creating an instance keeps the cached instances."""
+        reference_caches[Author].get('Awais Jibran')
+        AuthorFactory(name='Adeva')
+        with self.assertNumQueries(0):
+            reference_caches[Author].get('Awais Jibran')
+
+    def test_version_changed_by_other_process(self):
+        """Tests that the local instances are cleared when the shared version moves."""
+        reference_caches[Country].sync()
+        reference_caches[Country].get('Pakistan')
+        cache.incr(reference_caches[Country].version_key)
+        reference_caches[Country].sync()
+        with self.assertNumQueries(1):
+            reference_caches[Country].get('Pakistan')
+
+    def test_evicted_version(self):
+        """Tests that a version key evicted from the cache does not come back to a past version."""
+        reference_caches[Country].sync()
+        reference_caches[Country].get('Pakistan')
+        cache.delete(reference_caches[Country].version_key)
+        Country.objects.filter(pk=self.country.pk).update(name='Turkey')
+        with mock.patch('api.lookups.time.time', return_value=time.time() + 1):
+            sync_reference_caches()
+        with self.assertRaises(Country.DoesNotExist):
+            reference_caches[Country].get('Pakistan')
+
+    def test_sync_reads_the_versions_at_once(self):
+        sync_reference_caches()
+        with mock.patch.object(cache, 'get_many', wraps=cache.get_many) as get_many, \
+                mock.patch.object(cache, 'add', wraps=cache.add) as add:
+            sync_reference_caches()
+        self.assertEqual(get_many.call_count, 1)
+        self.assertEqual(add.call_count, 0)
+
+    @override_settings(REFERENCE_CACHE={'ENABLED': True, 'MAX_AGE': 60})
+    def test_max_age(self):
+        """Tests that the local instances are fetched again after the max age."""
+        reference_caches[Country].get('Pakistan')
+        with self.assertNumQueries(1), mock.patch('api.lookups.time.time', return_value=time.time() + 61):
+            reference_caches[Country].get('Pakistan')
+
+    @override_settings(REFERENCE_CACHE={'ENABLED': False})
+    def test_disabled(self):
+        """Tests that the instances are not cached when disabled."""
+        self.assertFalse(reference_caches[Country].enabled)
+        reference_caches[Country].get('Pakistan')
+        with self.assertNumQueries(1):
+            reference_caches[Country].get('Pakistan')
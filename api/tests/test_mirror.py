@@ -0,0 +1,188 @@
+import json
+import time
+from datetime import date
+
+import mock
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.reverse import reverse
+from rest_framework.test import APITestCase
+
+from api.api_utils import get_response_status_info
+from api.book_stores import BookStore, IceAndFireStore, LocalMirrorStore
+from api.mirror import MirrorSyncError, MirrorSyncScheduler, start_mirror_scheduler, sync_external_books
+from api.models import MirroredBook
+from api.serializers import IceAndFireSerializer
+from api.tests.utils import BOOK_DATA, PaginatedUpstream, StubServer
+
+
+class UpstreamStore(object):
+    """Store answering with the given external books."""
+
+    def __init__(self, books_data, status_code=200):
+        self.books_data = books_data
+        self.status_code = status_code
+
+    def get_books(self, name=None):
+        response_data = get_response_status_info(self.status_code)
+        if self.status_code == 200:
+            response_data['data'] = IceAndFireSerializer.transform_many(self.books_data)
+        else:
+            response_data['message'] = 'Upstream is down'
+        return response_data
+
+
+def make_books(count, **overrides):
+    return [dict(BOOK_DATA, name='Book {0}'.format(number), isbn=str(number), **overrides) for number in range(count)]
+
+
+class SyncExternalBooksTests(TestCase):
+    def sync(self, books_data):
+        return sync_external_books(UpstreamStore(books_data))
+
+    def test_initial_sync(self):
+        """Tests that the upstream books are mirrored in their external representation."""
+        stats = self.sync([BOOK_DATA])
+        self.assertEqual(stats, {'created': 1, 'updated': 0, 'deleted': 0, 'unchanged': 0})
+        book = MirroredBook.objects.get()
+        self.assertEqual(book.isbn, '978-0553103540')
+        self.assertEqual(json.loads(book.authors), ['George R. R. Martin'])
+        self.assertEqual(book.release_date, date(1996, 8, 1))
+
+    def test_only_changes_written(self):
+        """Tests that a sync inserts, updates and deletes only the books that changed."""
+        books_data = make_books(5)
+        self.sync(books_data)
+        unchanged_synced_at = MirroredBook.objects.get(isbn='0').synced_at
+
+        books_data = books_data[:3] + make_books(7)[5:]
+        books_data[1] = dict(books_data[1], name='Renamed')
+        books_data[2] = dict(books_data[2], numberOfPages=None)
+        stats = self.sync(books_data)
+
+        self.assertEqual(stats, {'created': 2, 'updated': 2, 'deleted': 2, 'unchanged': 1})
+        self.assertEqual(
+            list(MirroredBook.objects.order_by('isbn').values_list('isbn', 'name', 'number_of_pages')),
+            [('0', 'Book 0', 694), ('1', 'Renamed', 694), ('2', 'Book 2', None), ('5', 'Book 5', 694),
+             ('6', 'Book 6', 694)]
+        )
+        self.assertEqual(MirroredBook.objects.get(isbn='0').synced_at, unchanged_synced_at)
+
+    def test_unchanged_catalog_not_written(self):
+        """Tests that syncing an unchanged catalog only reads the mirror."""
+        books_data = make_books(50)
+        self.sync(books_data)
+        with CaptureQueriesContext(connection) as context:
+            stats = self.sync(books_data)
+        self.assertEqual(stats['unchanged'], 50)
+        self.assertEqual(
+            [
+                query['sql'] for query in context.captured_queries
+                if not query['sql'].startswith(('SELECT', 'SAVEPOINT', 'RELEASE'))
+            ],
+            []
+        )
+
+    def test_bulk_queries(self):
+        """Tests that the number of queries does not depend on the number of changed books."""
+        with CaptureQueriesContext(connection) as small_sync:
+            self.sync(make_books(2))
+        MirroredBook.objects.all().delete()
+        with CaptureQueriesContext(connection) as large_sync:
+            self.sync(make_books(200))
+        self.assertEqual(len(small_sync.captured_queries), len(large_sync.captured_queries))
+
+    def test_upstream_error(self):
+        """Tests that the mirror is left untouched when the upstream fails."""
+        self.sync(make_books(3))
+        with self.assertRaises(MirrorSyncError):
+            sync_external_books(UpstreamStore([], status_code=500))
+        self.assertEqual(MirroredBook.objects.count(), 3)
+
+    def test_truncated_catalog(self):
+        """Tests that the mirror is left untouched when the store fetches only a part of the catalog."""
+        with StubServer(PaginatedUpstream(book_count=23)) as server:
+            with mock.patch.object(IceAndFireStore, 'url', server.url + '/api/books'):
+                sync_external_books(IceAndFireStore(page_size=5))
+                with self.assertRaises(MirrorSyncError):
+                    sync_external_books(IceAndFireStore(page_size=5, max_pages=2))
+        self.assertEqual(MirroredBook.objects.count(), 23)
+
+
+@override_settings(ACTIVE_BOOK_STORE='api.book_stores.LocalMirrorStore')
+class LocalMirrorStoreTests(APITestCase):
+    def setUp(self):
+        super(LocalMirrorStoreTests, self).setUp()
+        sync_external_books(UpstreamStore([BOOK_DATA] + make_books(3)))
+
+    def test_name_query(self):
+        """Tests that the books are queried by name like the upstream does."""
+        response_data = LocalMirrorStore().get_books('A Game of Thrones')
+        self.assertEqual(response_data['status'], 'success')
+        self.assertEqual(response_data['data'], IceAndFireSerializer.transform_many([BOOK_DATA]))
+        self.assertEqual(len(LocalMirrorStore().get_books(None)['data']), 4)
+        self.assertEqual(LocalMirrorStore().get_books('Unknown')['data'], [])
+
+    @mock.patch('requests.Session.get')
+    def test_external_books_api(self, session_get):
+        """Tests that the external books api is answered from the mirror without the upstream."""
+        response = self.client.get(reverse('api:external_books'), {'name': 'Book 1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([book['isbn'] for book in response.data['data']], ['1'])
+        session_get.assert_not_called()
+
+    @mock.patch('api.book_stores.get_book_store_cache')
+    def test_not_cached(self, get_book_store_cache):
+        """Tests that the responses of the local store are not cached."""
+        BookStore().get_books('Book 1')
+        get_book_store_cache.assert_not_called()
+
+
+class MirrorSyncSchedulerTests(SimpleTestCase):
+    def setUp(self):
+        super(MirrorSyncSchedulerTests, self).setUp()
+        cache.delete(MirrorSyncScheduler.lock_key)
+        self.addCleanup(cache.delete, MirrorSyncScheduler.lock_key)
+
+    def test_failed_sync_is_retried(self):
+        """Tests that a failing sync does not stop the scheduler."""
+        sync = mock.Mock(side_effect=[MirrorSyncError('Upstream is down'), {'created': 1}])
+        scheduler = MirrorSyncScheduler(interval=60, sync=sync)
+        with self.assertLogs('api.mirror', level='ERROR'):
+            scheduler.run_once()
+        self.assertIsNone(scheduler.last_result)
+        cache.delete(MirrorSyncScheduler.lock_key)
+        scheduler.run_once()
+        self.assertEqual(scheduler.last_result, {'created': 1})
+
+    def test_locked_sync_is_skipped(self):
+        """Tests that a single scheduler sharing the lock cache syncs per interval."""
+        sync = mock.Mock(return_value={})
+        MirrorSyncScheduler(interval=60, sync=sync).run_once()
+        MirrorSyncScheduler(interval=60, sync=sync).run_once()
+        self.assertEqual(sync.call_count, 1)
+
+    def test_periodic_sync(self):
+        """Tests that the scheduler syncs right away and then every interval."""
+        sync = mock.Mock(return_value={})
+        scheduler = MirrorSyncScheduler(interval=0.01, sync=sync)
+        scheduler.start()
+        deadline = time.time() + 5
+        while sync.call_count < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        scheduler.stop(timeout=1)
+        self.assertGreaterEqual(sync.call_count, 3)
+        self.assertFalse(scheduler._thread.is_alive())
+
+    @mock.patch('api.mirror._scheduler', None)
+    @mock.patch.object(MirrorSyncScheduler, 'start')
+    def test_not_started_by_default(self, start):
+        """Tests that the scheduler is only started with a sync interval."""
+        start_mirror_scheduler()
+        start.assert_not_called()
+        with mock.patch('api.mirror._scheduler', None), \
+                override_settings(EXTERNAL_BOOKS_MIRROR={'SYNC_INTERVAL': 60}):
+            start_mirror_scheduler()
+        start.assert_called_once_with()
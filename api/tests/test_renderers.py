@@ -0,0 +1,65 @@
+import json
+from collections import OrderedDict
+from datetime import date
+from decimal import Decimal
+from io import BytesIO
+from unittest import skipIf
+
+import mock
+from django.test import SimpleTestCase
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
+
+from api.renderers import MessagePackParser, MessagePackRenderer, ORJSONParser, ORJSONRenderer, msgpack, orjson
+
+BOOK = OrderedDict([
+    ('id', 1),
+    ('name', 'A Game of Thrones – édition'),
+    ('isbn', '978-0553103540'),
+    ('authors', ['George R. R. Martin']),
+    ('number_of_pages', 694),
+    ('publisher', 'Bantam Books'),
+    ('country', 'United States'),
+    ('release_date', date(1996, 8, 1)),
+])
+RESPONSE_DATA = {'status_code': 200, 'status': 'success', 'data': [BOOK, dict(BOOK, id=2, price=Decimal('9.99'))]}
+
+
+@skipIf(orjson is None, 'orjson is not installed')
+class ORJSONRendererTests(SimpleTestCase):
+    def test_same_data_as_json_renderer(self):
+        """Tests that the orjson output decodes to the same data as DRF's JSONRenderer output."""
+        content = ORJSONRenderer().render(RESPONSE_DATA)
+        self.assertEqual(json.loads(content.decode('utf-8')), json.loads(JSONRenderer().render(RESPONSE_DATA)))
+        self.assertIn(b'"release_date":"1996-08-01"', content)
+
+    def test_indent(self):
+        """Tests that an indent asked for in the media type pretty prints the output."""
+        content = ORJSONRenderer().render({'data': [1]}, 'application/json; indent=4')
+        self.assertEqual(content, b'{\n  "data": [\n    1\n  ]\n}')
+
+    def test_without_orjson(self):
+        """Tests that the data is rendered by DRF's JSONRenderer without orjson."""
+        with mock.patch('api.renderers.orjson', None):
+            self.assertEqual(ORJSONRenderer().render(RESPONSE_DATA), JSONRenderer().render(RESPONSE_DATA))
+
+    def test_parser(self):
+        """Tests that the parser decodes json and rejects invalid json."""
+        self.assertEqual(ORJSONParser().parse(BytesIO(b'{"name": "\xc3\xa9"}')), {'name': 'é'})
+        with self.assertRaises(ParseError):
+            ORJSONParser().parse(BytesIO(b'{"name":'))
+
+
+@skipIf(msgpack is None, 'msgpack is not installed')
+class MessagePackRendererTests(SimpleTestCase):
+    def test_round_trip(self):
+        """Tests that the data is decoded as rendered, dates as iso 8601 strings."""
+        content = MessagePackRenderer().render(RESPONSE_DATA)
+        data = MessagePackParser().parse(BytesIO(content))
+        self.assertEqual(data, json.loads(JSONRenderer().render(RESPONSE_DATA)))
+        self.assertEqual(list(data['data'][0]), list(BOOK))
+
+    def test_invalid_data(self):
+        """Tests that an invalid body is a parse error."""
+        with self.assertRaises(ParseError):
+            MessagePackParser().parse(BytesIO(MessagePackRenderer().render(RESPONSE_DATA)[:-3]))
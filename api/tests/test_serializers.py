@@ -1,7 +1,11 @@
+from datetime import date
+
+from django.test import SimpleTestCase
 from rest_framework.test import APITestCase
 
-from api.serializers import BookSerializer, MinimalBookSerializer
+from api.serializers import BookSerializer, IceAndFireSerializer, MinimalBookSerializer, parse_external_date
 from api.tests.factories import BookFactory
+from api.tests.utils import BOOK_DATA
 
 
 class BookSerializerTests(APITestCase):
@@ -12,8 +16,9 @@ class BookSerializerTests(APITestCase):
     def test_book_serializer(self):
         """Test book serializer has all the required fields"""
         serializer = BookSerializer(instance=self.book)
-        for field in serializer.fields:
-            self.assertIsNotNone(serializer.data.get(field))
+        for field_name, field in serializer.fields.items():
+            if not field.write_only:
+                self.assertIsNotNone(serializer.data.get(field_name))
 
     def test_book_minimal_serializer(self):
         """Test minimal book serializer has all the required fields but the excluded"""
@@ -21,3 +26,26 @@ class BookSerializerTests(APITestCase):
         excluded_fields = serializer.Meta.exclude
         for field in excluded_fields:
             self.assertNotIn(field, serializer.data)
+
+
+class IceAndFireSerializerTests(SimpleTestCase):
+    books_data = [
+        BOOK_DATA,
+        dict(BOOK_DATA, released='August 1, 1996', numberOfPages='694'),
+        dict(BOOK_DATA, released='1996-08-01', authors=[]),
+        dict(BOOK_DATA, country=None, publisher=None),
+    ]
+
+    def test_transform_many_matches_serializer(self):
+        """Tests that the batch transform gives the same representation as the serializer."""
+        self.assertEqual(
+            IceAndFireSerializer.transform_many(self.books_data),
+            [dict(IceAndFireSerializer(book_data).data) for book_data in self.books_data]
+        )
+
+    def test_parse_external_date(self):
+        """Tests that iso dates are parsed directly and the other formats by dateutil."""
+        self.assertEqual(parse_external_date('1996-08-01T00:00:00'), date(1996, 8, 1))
+        self.assertEqual(parse_external_date('1996-08-01'), date(1996, 8, 1))
+        self.assertEqual(parse_external_date('August 1, 1996'), date(1996, 8, 1))
+        self.assertEqual(parse_external_date(date(1996, 8, 1)), date(1996, 8, 1))
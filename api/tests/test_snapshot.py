@@ -0,0 +1,181 @@
+import threading
+from datetime import date
+
+import mock
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import F
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+
+from api.conditional import BOOKS_COUNTER
+from api.models import ChangeCounter
+from api.snapshot import BookRow, BookSnapshot, BookSnapshotEngine, fetch_book_rows, get_book_snapshot_engine
+from api.tests.factories import BookFactory, PublisherFactory
+
+FIELDS = ('id', 'name', 'authors', 'publisher', 'release_date')
+
+
+def make_row(book_id, name, release_date, publisher='Traverse', authors=('Adeva',)):
+    return BookRow(book_id, name, 'isbn-{0}'.format(book_id), 100, release_date, publisher, 'Pakistan', authors)
+
+
+class BookSnapshotTests(SimpleTestCase):
+    def setUp(self):
+        super(BookSnapshotTests, self).setUp()
+        self.snapshot = BookSnapshot([
+            make_row(3, 'Book B', date(2019, 1, 1), publisher='IBNFreaks', authors=()),
+            make_row(1, 'Book A', date(2019, 5, 1), authors=('Adeva', 'Rehman G')),
+            make_row(2, 'Book A', date(2018, 1, 1)),
+            make_row(4, 'Book C', date(2018, 7, 1)),
+        ], version=7)
+
+    def get_ids(self, **lookups):
+        return [self.snapshot.ids[position] for position in self.snapshot.filter(**lookups)]
+
+    def test_default_ordering(self):
+        """Tests that the books are kept ordered by name, release date and id."""
+        self.assertEqual(self.get_ids(), [2, 1, 3, 4])
+
+    def test_interned_names(self):
+        """Tests that the repeated names are stored once."""
+        self.assertEqual(self.snapshot.publishers.names, ['Traverse', 'IBNFreaks'])
+        self.assertEqual(self.snapshot.authors.names, ['Adeva', 'Rehman G'])
+        self.assertEqual(list(self.snapshot.publisher_ids), [0, 0, 1, 0])
+
+    def test_filter(self):
+        """Tests that the lookups are answered from the indexes and combined."""
+        self.assertEqual(self.get_ids(name='Book A'), [2, 1])
+        self.assertEqual(self.get_ids(isbn='isbn-3'), [3])
+        self.assertEqual(self.get_ids(release_year=2018), [2, 4])
+        self.assertEqual(self.get_ids(publisher='Traverse'), [2, 1, 4])
+        self.assertEqual(self.get_ids(publisher='Traverse', release_year=2018, name='Book C'), [4])
+        self.assertEqual(self.get_ids(publisher='Unknown'), [])
+        self.assertEqual(self.get_ids(name='Book B', release_year=2018), [])
+
+    def test_represent(self):
+        """Tests that the books are represented like BookSerializer does."""
+        self.assertEqual(self.snapshot.represent(self.snapshot.filter(name='Book A'), FIELDS), [
+            {'id': 2, 'name': 'Book A', 'authors': ['Adeva'], 'publisher': 'Traverse', 'release_date': '2018-01-01'},
+            {'id': 1, 'name': 'Book A', 'authors': ['Adeva', 'Rehman G'], 'publisher': 'Traverse',
+             'release_date': '2019-05-01'},
+        ])
+
+    def test_with_changes(self):
+        """Tests that the changed books are replaced and the deleted removed in a new snapshot."""
+        snapshot = self.snapshot.with_changes([1, 4], [make_row(1, 'Book Z', date(2019, 5, 1))], 8, 1)
+        self.assertEqual(snapshot.version, 8)
+        self.assertEqual([snapshot.ids[position] for position in snapshot.filter()], [2, 3, 1])
+        self.assertEqual(snapshot.get_row(2), make_row(1, 'Book Z', date(2019, 5, 1)))
+        self.assertEqual(self.get_ids(), [2, 1, 3, 4])
+
+    def test_with_changes_matches_rebuild(self):
+        """Tests that the spliced snapshot answers like a snapshot built from all the rows."""
+        changed_rows = [
+            make_row(2, 'Book D', date(2018, 7, 1), publisher='IBNFreaks', authors=('Rehman G', 'Ali')),
+            make_row(5, 'Book A', date(2019, 5, 1), publisher='Nawa', authors=()),
+            make_row(6, 'Book 0', date(2020, 2, 1)),
+        ]
+        snapshot = self.snapshot.with_changes([2, 3, 5, 6], changed_rows, 8, 1)
+        rows = [self.snapshot.get_row(position) for position in (1, 3)] + changed_rows
+        rebuilt = BookSnapshot(rows, 8, 1)
+
+        self.assertEqual([snapshot.get_row(position) for position in range(len(snapshot))],
+                         [rebuilt.get_row(position) for position in range(len(rebuilt))])
+        self.assertEqual(snapshot.positions_by_id, rebuilt.positions_by_id)
+        for lookups in ({'name': 'Book A'}, {'isbn': 'isbn-2'}, {'isbn': 'isbn-3'}, {'release_year': 2018},
+                        {'release_year': 2019}, {'publisher': 'Traverse'}, {'publisher': 'IBNFreaks'},
+                        {'publisher': 'Nawa', 'release_year': 2019}):
+            self.assertEqual(snapshot.filter(**lookups), rebuilt.filter(**lookups))
+        self.assertEqual(snapshot.represent(snapshot.filter(), FIELDS), rebuilt.represent(rebuilt.filter(), FIELDS))
+
+
+@override_settings(BOOK_SNAPSHOT={'ENABLED': True, 'BACKGROUND_REFRESH': False})
+class BookSnapshotEngineTests(TransactionTestCase):
+    """Tests for refreshing the snapshot from the committed changes"""
+
+    def setUp(self):
+        super(BookSnapshotEngineTests, self).setUp()
+        self.engine = get_book_snapshot_engine()
+        self.engine.clear()
+        self.book = BookFactory(name='Book 1')
+        self.other_book = BookFactory(name='Book 2')
+
+    def get_names(self, snapshot):
+        return [book['name'] for book in snapshot.represent(snapshot.filter(), ('name',))]
+
+    def refresh(self):
+        with mock.patch('api.snapshot.fetch_book_rows', side_effect=fetch_book_rows) as fetch:
+            snapshot = self.engine.refresh()
+        return snapshot, fetch.call_args[0] if fetch.called else None
+
+    def test_incremental_refresh(self):
+        """Tests that only the books changed by this process are fetched again."""
+        snapshot, fetch_args = self.refresh()
+        self.assertEqual(fetch_args, ())
+
+        self.book.name = 'Book 3'
+        self.book.save()
+        new_snapshot, fetch_args = self.refresh()
+        self.assertEqual(fetch_args, ({self.book.id},))
+        self.assertEqual(self.get_names(new_snapshot), ['Book 2', 'Book 3'])
+        self.assertEqual(new_snapshot.version, ChangeCounter.objects.get(name=BOOKS_COUNTER).version)
+        # Readers of the previous snapshot are not affected.
+        self.assertEqual(self.get_names(snapshot), ['Book 1', 'Book 2'])
+
+    def test_unchanged(self):
+        """Tests that the snapshot is kept as long as the books do not change."""
+        snapshot, __ = self.refresh()
+        self.assertEqual(self.refresh(), (snapshot, None))
+
+    def test_changes_of_other_processes(self):
+        """Tests that the snapshot is rebuilt when the counter moved for changes made elsewhere."""
+        self.refresh()
+        self.book.delete()
+        ChangeCounter.objects.filter(name=BOOKS_COUNTER).update(version=F('version') + 1)
+        snapshot, fetch_args = self.refresh()
+        self.assertEqual(fetch_args, ())
+        self.assertEqual(self.get_names(snapshot), ['Book 2'])
+
+    def test_renamed_publisher(self):
+        """Tests that renaming a publisher rebuilds the snapshot."""
+        self.refresh()
+        publisher = self.book.publisher
+        publisher.name = 'Renamed Publisher'
+        publisher.save()
+        PublisherFactory()
+        snapshot, fetch_args = self.refresh()
+        self.assertEqual(fetch_args, ())
+        self.assertEqual(snapshot.represent(snapshot.filter(name='Book 1'), ('publisher',)),
+                         [{'publisher': 'Renamed Publisher'}])
+
+    def test_concurrent_refreshes(self):
+        """Tests that a refresh waits for the one in progress instead of swapping in an older snapshot."""
+        self.refresh()
+        self.book.name = 'New'
+        self.book.save()
+        fetching, release = threading.Event(), threading.Event()
+
+        def fetch(book_ids=None):
+            fetching.set()
+            release.wait(5)
+            return fetch_book_rows(book_ids)
+
+        with mock.patch('api.snapshot.fetch_book_rows', side_effect=fetch):
+            first = threading.Thread(target=self.engine.refresh_in_background)
+            first.start()
+            fetching.wait(5)
+            second = threading.Thread(target=self.engine.refresh_in_background)
+            second.start()
+            second.join(0.2)
+            self.assertTrue(second.is_alive())
+            release.set()
+            first.join(5)
+            second.join(5)
+        self.assertEqual(self.get_names(self.engine.snapshot), ['Book 2', 'New'])
+        self.assertEqual(self.engine.snapshot.version, ChangeCounter.objects.get(name=BOOKS_COUNTER).version)
+
+    def test_other_databases(self):
+        """Tests that the snapshot is refused on databases collating the names differently."""
+        with mock.patch('api.snapshot.connection') as connection:
+            connection.vendor = 'postgresql'
+            with self.assertRaises(ImproperlyConfigured):
+                BookSnapshotEngine.from_settings()
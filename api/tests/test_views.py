@@ -2,9 +2,12 @@ import mock
 from rest_framework.reverse import reverse
 from rest_framework.test import APITestCase
 
-MockedEmptyResponse = mock.Mock(status_code=200, json=mock.Mock(return_value=[]))
+from api.caches import get_book_store_cache
+
+MockedEmptyResponse = mock.Mock(status_code=200, links={}, json=mock.Mock(return_value=[]))
 MockResponse = mock.Mock(
     status_code=200,
+    links={},
     json=mock.Mock(
         return_value=[{
             'url': 'dummy-url',
@@ -24,7 +27,11 @@ MockResponse = mock.Mock(
 class BooksListTests(APITestCase):
     books_fetch_url = reverse('api:external_books')
 
-    @mock.patch('requests.get', return_value=MockResponse)
+    def setUp(self):
+        super(BooksListTests, self).setUp()
+        get_book_store_cache().clear()
+
+    @mock.patch('requests.Session.get', return_value=MockResponse)
     def test_api_response_transformation(self, __):
         """
         Tests that the data is correctly transformed into the required
@@ -39,7 +46,7 @@ class BooksListTests(APITestCase):
         self.assertIn('release_date', response_data['data'][0], book_1)
         self.assertEqual(book_1['release_date'], '1996-08-01')
 
-    @mock.patch('requests.get', return_value=MockResponse)
+    @mock.patch('requests.Session.get', return_value=MockResponse)
     def test_api_response_with_extra_fields(self, __):
         """
         Tests that the data is extra fields are removed and not included in
@@ -51,7 +58,7 @@ class BooksListTests(APITestCase):
         self.assertNotIn('characters', book_1)
         self.assertNotIn('url', book_1)
 
-    @mock.patch('requests.get', return_value=MockedEmptyResponse)
+    @mock.patch('requests.Session.get', return_value=MockedEmptyResponse)
     def test_empty_get_books(self, __):
         """ Tests that empty response contains response status information. """
         response = self.client.get(self.books_fetch_url)
@@ -61,15 +68,22 @@ class BooksListTests(APITestCase):
         self.assertIn('status', response_data)
         self.assertEqual(response_data['status'], 'success')
 
-    @mock.patch('requests.get', return_value=MockedEmptyResponse)
+    @mock.patch('requests.Session.get', return_value=MockedEmptyResponse)
     def test_call_with_querystring(self, mocked_api_call):
         """
         Test api call contains querystring when user provides the filter
         criteria in querystring.
         """
-        filter_name = 'Foo'
+        filter_name = 'Fire & Blood #1'
         __ = self.client.get(self.books_fetch_url, {'name': filter_name})
-        self.assertEqual(
-            mocked_api_call.call_args[0][0],
-            'https://www.anapioficeandfire.com/api/books?name={}'.format(filter_name)
-        )
+        self.assertEqual(mocked_api_call.call_args[0][0], 'https://www.anapioficeandfire.com/api/books')
+        self.assertEqual(mocked_api_call.call_args[1]['params']['name'], filter_name)
+
+    @mock.patch('requests.Session.get', return_value=MockResponse)
+    def test_repeated_query_is_cached(self, mocked_api_call):
+        """Tests that identical queries are answered from the cache."""
+        first_response = self.client.get(self.books_fetch_url, {'name': 'dummy-name'}).json()
+        second_response = self.client.get(self.books_fetch_url, {'name': ' dummy-name '}).json()
+        self.assertEqual(first_response, second_response)
+        self.assertEqual(mocked_api_call.call_count, 1)
+        self.assertEqual(get_book_store_cache().stats['hits'], 1)
@@ -0,0 +1,129 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+BOOK_DATA = {
+    'url': 'dummy-url',
+    'name': 'A Game of Thrones',
+    'isbn': '978-0553103540',
+    'authors': ['George R. R. Martin'],
+    'numberOfPages': 694,
+    'publisher': 'Bantam Books',
+    'country': 'United States',
+    'characters': [],
+    'released': '1996-08-01T00:00:00'
+}
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    """Answers the requests with the responses queued on the stub server."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        status, body, headers = self.server.stub.get_response(self)
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        """Clients hanging up on purpose, e.g. on timeouts, are not errors."""
+        pass
+
+
+class StubServer(object):
+    """
+    Local HTTP server standing in for an upstream api in tests.
+
+    The handler is called with the request handler for every request and
+    returns a (status, json body, headers) tuple. The server keeps the
+    requested paths and the client addresses of the connections.
+
+    EXAMPLE USAGE:
+        with StubServer(lambda request: (200, [], {})) as server:
+            requests.get(server.url)
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.paths = []
+        self.client_addresses = set()
+        self._lock = threading.Lock()
+        self.httpd = None
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.httpd.server_port)
+
+    def get_response(self, request):
+        with self._lock:
+            self.paths.append(request.path)
+            self.client_addresses.add(request.client_address)
+        return self.handler(request)
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), StubRequestHandler)
+        self.httpd.stub = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class PaginatedUpstream(object):
+    """Stub upstream serving numbered books over pages advertised with `Link` headers."""
+
+    def __init__(self, book_count, delay=0):
+        self.book_count = book_count
+        self.delay = delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def get_link_header(self, request, last_page, page_size):
+        url = 'http://{0}{1}'.format(request.headers['Host'], urlparse(request.path).path)
+        return ', '.join(
+            '<{0}?page={1}&pageSize={2}>; rel="{3}"'.format(url, page, page_size, rel)
+            for page, rel in ((1, 'first'), (last_page, 'last'))
+        )
+
+    def __call__(self, request):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.delay)
+        query = parse_qs(urlparse(request.path).query)
+        page, page_size = int(query['page'][0]), int(query['pageSize'][0])
+        last_page = max((self.book_count + page_size - 1) // page_size, 1)
+        books = [
+            dict(BOOK_DATA, name='Book {0}'.format(number), isbn=str(number))
+            for number in range((page - 1) * page_size, min(page * page_size, self.book_count))
+        ]
+        with self._lock:
+            self.in_flight -= 1
+        return 200, books, {'Link': self.get_link_header(request, last_page, page_size)}
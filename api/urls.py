@@ -8,8 +8,9 @@ router = routers.DefaultRouter()
 # Wire up our API using automatic URL routing.
 # Additionally, we include login URLs for the browsable API.
 urlpatterns = [
-    url('', include(router.urls)),
-    url('external-books/', views.BooksList.as_view(), name='external_books'),
-    url('api-auth/', include('rest_framework.urls', namespace='rest_framework')),
-    url('v1/', include('api.v1.urls', namespace='v1'))
+    url(r'^', include(router.urls)),
+    url(r'^external-books/$', views.BooksList.as_view(), name='external_books'),
+    url(r'^metrics/$', views.metrics, name='metrics'),
+    url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework')),
+    url(r'^v1/', include('api.v1.urls', namespace='v1'))
 ]
@@ -1,12 +1,28 @@
+import json
+
 import mock
+from django.db import connection
+from unittest import skipIf
+
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.fields import DateTimeField
 from rest_framework.reverse import reverse
 from rest_framework.test import APITestCase
 
-from api.tests.factories import BookFactory, CountryFactory, PublisherFactory
+from api.caches import get_book_representation_cache
+from api.changes import compact_book_changes
+from api.lookups import clear_reference_caches
+from api.models import Book, BookChange
+from api.renderers import msgpack
+from api.snapshot import get_book_snapshot_engine
+from api.tests.factories import AuthorFactory, BookFactory, CountryFactory, PublisherFactory
 
-MockedEmptyResponse = mock.Mock(status_code=200, json=mock.Mock(return_value=[]))
+MockedEmptyResponse = mock.Mock(status_code=200, links={}, json=mock.Mock(return_value=[]))
 MockResponse = mock.Mock(
     status_code=200,
+    links={},
     json=mock.Mock(
         return_value=[{
             'url': 'dummy-url',
@@ -29,6 +45,8 @@ class BooksTests(APITestCase):
     def setUp(self):
         """Setup some data for testing"""
         super(BooksTests, self).setUp()
+        clear_reference_caches()
+        self.invalidate_representation_cache()
         morocco_publisher = PublisherFactory(name='Morocco Books')
         lahore_publisher = PublisherFactory(name='Lahore Books')
         usa_publisher = PublisherFactory(name='USA Books')
@@ -97,6 +115,28 @@ class BooksTests(APITestCase):
     def assert_response_data_count(self, response, expected_count):
         self.assertEqual(len(response['data']), expected_count)
 
+    def invalidate_representation_cache(self):
+        representation_cache = get_book_representation_cache()
+        if representation_cache is not None:
+            representation_cache.invalidate_all()
+
+    def count_queries(self, url, data=None):
+        """Returns the number of queries made while fetching the url."""
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(url, data=data)
+        return len(context.captured_queries)
+
+    def assert_constant_query_count(self, url, data=None, extra_books=10):
+        """
+        Helper method to verify the number of queries made to fetch the url
+        does not grow with the number of books, none of them being cached.
+        """
+        expected_count = self.count_queries(url, data=data)
+        for __ in range(extra_books):
+            BookFactory(authors=['Author 1', 'Author 2'])
+        self.invalidate_representation_cache()
+        self.assertEqual(self.count_queries(url, data=data), expected_count)
+
 
 class BooksCRUDTests(BooksTests):
     """Tests for crud operations on Book viewset"""
@@ -174,6 +214,797 @@ class BooksCRUDTests(BooksTests):
         self.assertEqual(post_create_book_count, pre_create_book_count + 1)
 
 
+class BooksQueryCountTests(BooksTests):
+    """Tests for the number of queries made by the Book viewset"""
+
+    def test_list_query_count(self):
+        """Tests that listing books makes a constant number of queries."""
+        self.assert_constant_query_count(self.books_api_url)
+
+    def test_filtered_list_query_count(self):
+        """Tests that filtering books makes a constant number of queries."""
+        self.assert_constant_query_count(self.books_api_url, data={'release_date': '2018'})
+
+    def test_list_queries_are_eager(self):
+        """Tests that the change counter, books, authors and nothing else are fetched for the list."""
+        self.assertEqual(self.count_queries(self.books_api_url), 3)
+
+    def test_retrieve_query_count(self):
+        """Tests that retrieving a book does not query the relations one by one."""
+        self.assertEqual(self.count_queries(self.book_detail_url(self.book1.id)), 3)
+
+
+class BooksWriteQueryTests(BooksTests):
+    """Tests for the queries made by the update and destroy endpoints of the Book viewset"""
+
+    def setUp(self):
+        super(BooksWriteQueryTests, self).setUp()
+        self.book1.authors.add(AuthorFactory(name='Second Author'))
+
+    def capture(self, method, data=None):
+        with CaptureQueriesContext(connection) as context:
+            response = getattr(self.client, method)(self.book_detail_url(self.book1.id), data=data, format='json')
+        queries = [query['sql'] for query in context.captured_queries]
+        return response, queries
+
+    def get_book_selects(self, queries):
+        return [sql for sql in queries if sql.startswith('SELECT') and 'FROM "api_book" ' in sql]
+
+    def get_through_writes(self, queries):
+        return [sql for sql in queries if sql.startswith(('INSERT', 'DELETE')) and '"api_book_authors"' in sql]
+
+    def get_author_names(self):
+        return set(self.book1.authors.values_list('name', flat=True))
+
+    def test_update_fetches_the_book_once(self):
+        response, queries = self.capture('patch', {'name': 'Renamed'})
+        self.assertEqual(response.json()['message'], 'The book Renamed was updated successfully')
+        self.assertEqual(len(self.get_book_selects(queries)), 1)
+        self.assertEqual(self.get_through_writes(queries), [])
+
+    def test_destroy_fetches_the_book_once(self):
+        response, queries = self.capture('delete')
+        self.assertEqual(response.json()['message'], 'The book Book 1 was deleted successfully')
+        self.assertEqual(len(self.get_book_selects(queries)), 1)
+        # Nor are the relations of the deleted book loaded.
+        self.assertFalse([sql for sql in queries if sql.startswith('SELECT') and '"api_publisher"' in sql])
+
+    def test_replacing_authors_writes_the_difference(self):
+        """Tests that only the through rows of the added and removed authors are written."""
+        response, queries = self.capture('patch', {'authors': ['George R. R. Martin', 'Third Author']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['data']['authors'], ['George R. R. Martin', 'Third Author'])
+        through_writes = self.get_through_writes(queries)
+        self.assertEqual(len(through_writes), 2)
+        self.assertTrue(through_writes[0].startswith('DELETE'))
+        self.assertTrue(through_writes[1].startswith('INSERT'))
+        self.assertEqual(self.get_author_names(), {'George R. R. Martin', 'Third Author'})
+
+    def test_unchanged_authors_are_not_written(self):
+        response, queries = self.capture('put', {
+            'name': 'Book 1',
+            'isbn': 'M-Book1',
+            'authors': ['Second Author', 'George R. R. Martin'],
+            'country': self.book1.country.name,
+            'number_of_pages': 10,
+            'publisher': 'Morocco Books',
+            'release_date': '2018-01-01',
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_through_writes(queries), [])
+
+    def test_update_query_count(self):
+        """Tests the number of queries of an update replacing an author."""
+        __, queries = self.capture('patch', {'authors': ['George R. R. Martin', 'Third Author']})
+        # The book with its authors, the authors by name and the new one, in
+        # a savepoint the book update, the removed and the added through rows
+        # with their lookups, then once for the book the search index, change
+        # counter and change log updates, and the authors of the response.
+        self.assertEqual(len(queries), 17)
+        self.assertEqual(len([sql for sql in queries if 'api_changecounter' in sql]), 1)
+        self.assertEqual(len([sql for sql in queries if sql.startswith('INSERT INTO "api_bookchange"')]), 1)
+
+    def test_add_and_remove_authors(self):
+        """Tests that authors are added and removed by name without restating the others."""
+        response, queries = self.capture(
+            'patch', {'add_authors': ['Third Author'], 'remove_authors': ['Second Author']}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.json()['data']['authors']), {'George R. R. Martin', 'Third Author'})
+        self.assertEqual(len(self.get_through_writes(queries)), 2)
+        self.assertEqual(self.get_author_names(), {'George R. R. Martin', 'Third Author'})
+
+        response = self.client.patch(
+            self.book_detail_url(self.book1.id), data={'add_authors': ['Third Author']}, format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_author_names(), {'George R. R. Martin', 'Third Author'})
+
+    def test_add_authors_with_authors(self):
+        response, __ = self.capture('patch', {'authors': ['Third Author'], 'add_authors': ['Fourth Author']})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.get_author_names(), {'George R. R. Martin', 'Second Author'})
+
+    def test_add_authors_on_create(self):
+        response = self.client.post(self.books_api_url, data={
+            'name': 'New Book',
+            'isbn': 'new-book',
+            'authors': ['Third Author'],
+            'add_authors': ['Fourth Author'],
+            'country': self.book1.country.name,
+            'number_of_pages': 10,
+            'publisher': 'Morocco Books',
+            'release_date': '2018-01-01',
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+class BooksPaginationTests(BooksTests):
+    """Tests for the page number and cursor pagination of the Book viewset"""
+
+    def get_names(self, response_data):
+        return [book['name'] for book in response_data['data']]
+
+    def test_list_is_not_paginated_by_default(self):
+        """Tests that the list is not paginated unless requested."""
+        response_data = self.make_api_get_request(self.books_api_url)
+        self.assertNotIn('pagination', response_data)
+        self.assert_response_data_count(response_data, 3)
+
+    def test_page_number_pagination(self):
+        """Tests that page number pagination keeps the envelope and adds pagination info."""
+        response_data = self.make_api_get_request(self.books_api_url, {'page': 2, 'page_size': 2})
+        self.assert_response_success(response_data)
+        self.assertEqual(self.get_names(response_data), ['Book 3'])
+        self.assertEqual(response_data['pagination']['count'], 3)
+        self.assertEqual(response_data['pagination']['page'], 2)
+        self.assertIsNone(response_data['pagination']['next'])
+        self.assertIsNotNone(response_data['pagination']['previous'])
+
+    def test_cursor_pagination(self):
+        """Tests that following the cursor links walks the books in order."""
+        BookFactory(name='Book 2', isbn='L-Book2-2', release_date='2019-01-01')
+        names = []
+        response_data = self.make_api_get_request(self.books_api_url, {'pagination': 'cursor', 'page_size': 1})
+        while True:
+            self.assert_response_success(response_data)
+            self.assert_response_data_count(response_data, 1)
+            names.extend(self.get_names(response_data))
+            next_url = response_data['pagination']['next']
+            if next_url is None:
+                break
+            response_data = self.make_api_get_request(next_url)
+        self.assertEqual(names, ['Book 1', 'Book 2', 'Book 2', 'Book 3'])
+
+    def test_cursor_pagination_with_filter(self):
+        """Tests that the cursor pagination works along with the filters."""
+        response_data = self.make_api_get_request(
+            self.books_api_url, {'pagination': 'cursor', 'page_size': 1, 'publisher': 'Lahore Books'}
+        )
+        self.assert_book2_data(response_data)
+        self.assertIsNone(response_data['pagination']['next'])
+
+    def test_invalid_cursor(self):
+        """Tests that an invalid cursor is reported as not found."""
+        response = self.client.get(self.books_api_url, {'cursor': 'invalid'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_deep_cursor_query_count(self):
+        """Tests that a page deep in the catalog costs the same number of queries."""
+        for __ in range(10):
+            BookFactory(name='Book 4')
+        first_page = self.make_api_get_request(self.books_api_url, {'pagination': 'cursor', 'page_size': 2})
+        next_url = first_page['pagination']['next']
+        self.assertEqual(self.count_queries(next_url), self.count_queries(self.books_api_url, {'pagination': 'cursor'}))
+
+
+class BooksExportTests(BooksTests):
+    """Tests for the streaming export of the Book viewset"""
+    books_export_url = reverse('api:v1:books-export')
+
+    def get_streamed_content(self, response):
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode('utf-8')
+
+    def test_export_json(self):
+        """Tests that the json export streams all books in the list envelope."""
+        response = self.client.get(self.books_export_url)
+        response_data = json.loads(self.get_streamed_content(response))
+        self.assert_response_success(response_data)
+        self.assertEqual(
+            response_data['data'],
+            self.make_api_get_request(self.books_api_url)['data']
+        )
+
+    def test_export_ndjson(self):
+        """Tests that the ndjson export streams a book per line."""
+        response = self.client.get(self.books_export_url, {'output': 'ndjson'})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = self.get_streamed_content(response).splitlines()
+        self.assertEqual([json.loads(line)['name'] for line in lines], ['Book 1', 'Book 2', 'Book 3'])
+
+    def test_export_with_filter(self):
+        """Tests that the export applies the filters."""
+        response = self.client.get(self.books_export_url, {'isbn': 'U-Book3'})
+        response_data = json.loads(self.get_streamed_content(response))
+        self.assert_book3_data(response_data)
+
+    @mock.patch('api.v1.views.BookViewSet.export_chunk_size', 2)
+    def test_export_in_chunks(self):
+        """Tests that the export walks the catalog in chunks with a constant number of queries per chunk."""
+        with CaptureQueriesContext(connection) as context:
+            content = self.get_streamed_content(self.client.get(self.books_export_url))
+        self.assertEqual(len(json.loads(content)['data']), 3)
+        # Two chunks, each fetching the books and prefetching their authors.
+        self.assertEqual(len(context.captured_queries), 4)
+
+
+class BooksSparseFieldsTests(BooksTests):
+    """Tests for the ?fields= and ?omit= sparse fieldsets of the Book viewset"""
+
+    def get_full_books(self):
+        return self.make_api_get_request(self.books_api_url)['data']
+
+    def assert_sparse_books(self, response_data, fields):
+        self.assert_response_success(response_data)
+        expected = [{field: book[field] for field in fields} for book in self.get_full_books()]
+        self.assertEqual(response_data['data'], expected)
+        for book in response_data['data']:
+            self.assertEqual(list(book), list(fields))
+
+    def test_list_with_fields(self):
+        """Tests that only the picked fields are rendered, in the order of the serializer."""
+        response_data = self.make_api_get_request(self.books_api_url, {'fields': 'name,id,release_date,country'})
+        self.assert_sparse_books(response_data, ('id', 'name', 'country', 'release_date'))
+
+    def test_list_with_omit(self):
+        """Tests that the omitted fields are not rendered."""
+        response_data = self.make_api_get_request(self.books_api_url, {'omit': 'isbn,publisher'})
+        self.assert_sparse_books(
+            response_data, ('id', 'name', 'authors', 'number_of_pages', 'country', 'release_date')
+        )
+
+    def test_list_with_fields_and_omit(self):
+        response_data = self.make_api_get_request(self.books_api_url, {'fields': 'id,name,authors', 'omit': 'id'})
+        self.assert_sparse_books(response_data, ('name', 'authors'))
+
+    def test_unknown_fields(self):
+        """Tests that unknown fields are rejected."""
+        response = self.client.get(self.books_api_url, {'fields': 'id,title', 'omit': 'summary'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'fields': ['Unknown fields: summary, title.']})
+
+    def test_slim_list_queries(self):
+        """Tests that a list without authors is a single books query loading only the picked relations."""
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(self.books_api_url, {'fields': 'id,name,publisher'})
+        # The change counter and the books.
+        self.assertEqual(len(context.captured_queries), 2)
+        sql = context.captured_queries[1]['sql']
+        self.assertIn('api_publisher', sql)
+        self.assertNotIn('api_country', sql)
+        self.assertNotIn('isbn', sql)
+
+    def test_list_with_authors_skips_other_joins(self):
+        """Tests that the model path loads only the picked columns and relations."""
+        with CaptureQueriesContext(connection) as context:
+            response_data = self.make_api_get_request(self.books_api_url, {'fields': 'name,authors'})
+        self.assertEqual(len(context.captured_queries), 3)
+        book_sql = context.captured_queries[1]['sql']
+        self.assertNotIn('api_publisher', book_sql)
+        self.assertNotIn('isbn', book_sql)
+        self.assert_sparse_books(response_data, ('name', 'authors'))
+
+    def test_slim_list_pagination(self):
+        """Tests that both pagination modes work with the values rows."""
+        BookFactory(name='Book 2', isbn='L-Book2-2', release_date='2019-01-01')
+        ids = []
+        response_data = self.make_api_get_request(
+            self.books_api_url, {'fields': 'id', 'pagination': 'cursor', 'page_size': 1}
+        )
+        while True:
+            ids.extend(book['id'] for book in response_data['data'])
+            next_url = response_data['pagination']['next']
+            if next_url is None:
+                break
+            response_data = self.make_api_get_request(next_url)
+        self.assertEqual(ids, [book['id'] for book in self.get_full_books()])
+
+        response_data = self.make_api_get_request(self.books_api_url, {'fields': 'name', 'page': 2, 'page_size': 3})
+        self.assertEqual(response_data['data'], [{'name': 'Book 3'}])
+        self.assertEqual(response_data['pagination']['count'], 4)
+
+    def test_slim_list_with_search(self):
+        """Tests that the values rows keep the search ranking."""
+        BookFactory(name='Hidden', isbn='hidden', authors=['Book Keeper'])
+        response_data = self.make_api_get_request(self.books_api_url, {'fields': 'isbn', 'q': 'book'})
+        self.assertEqual([book['isbn'] for book in response_data['data']][-1], 'hidden')
+
+    def test_retrieve_with_fields(self):
+        response_data = self.make_api_get_request(self.book_detail_url(self.book1.id), {'fields': 'name,isbn'})
+        self.assert_response_success(response_data)
+        self.assertEqual(response_data['data'], {'name': 'Book 1', 'isbn': 'M-Book1'})
+
+    def test_export_with_fields(self):
+        """Tests that the export renders the picked fields."""
+        response = self.client.get(reverse('api:v1:books-export'), {'fields': 'name', 'output': 'ndjson'})
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(
+            [json.loads(line) for line in lines], [{'name': 'Book 1'}, {'name': 'Book 2'}, {'name': 'Book 3'}]
+        )
+
+
+class BooksConditionalGetTests(BooksTests):
+    """Tests for the ETag and Last-Modified validators of the Book viewset"""
+
+    def test_validators_are_set(self):
+        response = self.client.get(self.books_api_url)
+        self.assertRegex(response['ETag'], r'^"[0-9a-f]{40}"$')
+        self.assertIn('Last-Modified', response)
+
+    def test_if_none_match_short_circuits(self):
+        """Tests that a matching ETag is answered with a 304 after the counter query only."""
+        etag = self.client.get(self.books_api_url)['ETag']
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.books_api_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(len(context.captured_queries), 1)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+
+    def test_if_modified_since(self):
+        last_modified = self.client.get(self.book_detail_url(self.book1.id))['Last-Modified']
+        response = self.client.get(self.book_detail_url(self.book1.id), HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+    def test_etag_varies_with_the_request(self):
+        """Tests that the ETag depends on the path and the query string."""
+        etags = {
+            self.client.get(self.books_api_url)['ETag'],
+            self.client.get(self.books_api_url, {'name': 'Book 1'})['ETag'],
+            self.client.get(self.book_detail_url(self.book1.id))['ETag'],
+            self.client.get(self.book_detail_url(self.book2.id))['ETag'],
+        }
+        self.assertEqual(len(etags), 4)
+        etag = self.client.get(self.books_api_url, {'name': 'Book 1'})['ETag']
+        self.assertEqual(self.client.get(self.books_api_url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def assert_changed(self, change):
+        etag = self.client.get(self.books_api_url)['ETag']
+        change()
+        response = self.client.get(self.books_api_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_writes_change_the_etag(self):
+        """Tests that writing the books or the names rendered with them changes the ETag."""
+        self.assert_changed(lambda: self.client.patch(
+            self.book_detail_url(self.book1.id), data={'name': 'Renamed'}, format='json'
+        ))
+        self.assert_changed(lambda: self.book2.delete())
+        self.assert_changed(lambda: self.book3.authors.clear())
+        self.assert_changed(lambda: self.book3.publisher.save())
+        self.assert_changed(lambda: self.client.post(reverse('api:v1:books-bulk'), data=[{
+            'name': 'Bulk Book',
+            'isbn': 'bulk-1',
+            'authors': ['Bulk Author'],
+            'country': self.book1.country.name,
+            'number_of_pages': 100,
+            'publisher': 'USA Books',
+            'release_date': '2019-05-19',
+        }], format='json'))
+
+
+@override_settings(BOOK_REPRESENTATION_CACHE={'ENABLED': True})
+class BooksRepresentationCacheTests(BooksTests):
+    """Tests for the cached book representations of the Book viewset"""
+
+    def get_books(self, **params):
+        response_data = self.make_api_get_request(self.books_api_url, params)
+        self.assert_response_success(response_data)
+        return response_data['data']
+
+    def get_book(self, book_id):
+        return next(book for book in self.get_books() if book['id'] == book_id)
+
+    def test_cached_list_queries(self):
+        """Tests that a cached list only queries the change counter and the ids of the books."""
+        books = self.get_books()
+        self.assertEqual(self.count_queries(self.books_api_url), 2)
+        self.assertEqual(self.get_books(), books)
+
+    def test_cached_page(self):
+        self.get_books()
+        response_data = self.make_api_get_request(self.books_api_url, {'page': 2, 'page_size': 2})
+        self.assertEqual([book['name'] for book in response_data['data']], ['Book 3'])
+        self.assertEqual(response_data['pagination']['count'], 3)
+
+    @override_settings(BOOK_REPRESENTATION_CACHE={'ENABLED': False})
+    def test_disabled_cache(self):
+        self.get_books()
+        self.assertEqual(self.count_queries(self.books_api_url), 3)
+
+    def test_book_changes_are_not_cached(self):
+        """Tests that the books are rendered again once updated, deleted or given other authors."""
+        self.get_books()
+        self.client.patch(self.book_detail_url(self.book1.id), data={'name': 'Renamed'}, format='json')
+        self.assertEqual(self.get_book(self.book1.id)['name'], 'Renamed')
+
+        self.book2.authors.add(AuthorFactory(name='Added Author'))
+        self.assertIn('Added Author', self.get_book(self.book2.id)['authors'])
+
+        self.client.delete(self.book_detail_url(self.book3.id))
+        self.assertEqual([book['id'] for book in self.get_books()], [self.book2.id, self.book1.id])
+
+    def test_renamed_names_are_not_cached(self):
+        """Tests that the books are rendered again once their author, country or publisher is renamed."""
+        self.get_books()
+        author = self.book1.authors.get()
+        author.name = 'Renamed Author'
+        author.save()
+        self.assertEqual(self.get_book(self.book1.id)['authors'], ['Renamed Author'])
+
+        country = self.book2.country
+        country.name = 'Renamed Country'
+        country.save()
+        self.assertEqual(self.get_book(self.book2.id)['country'], 'Renamed Country')
+
+        publisher = self.book3.publisher
+        publisher.name = 'Renamed Publisher'
+        publisher.save()
+        self.assertEqual(self.get_book(self.book3.id)['publisher'], 'Renamed Publisher')
+
+    def test_bulk_updates_are_not_cached(self):
+        self.get_books()
+        response = self.client.post(reverse('api:v1:books-bulk'), data=[{
+            'id': self.book1.id,
+            'name': 'Bulk Renamed',
+            'isbn': 'M-Book1',
+            'authors': ['George R. R. Martin'],
+            'country': self.book1.country.name,
+            'number_of_pages': 100,
+            'publisher': 'Morocco Books',
+            'release_date': '2018-01-01',
+        }], format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.get_book(self.book1.id)['name'], 'Bulk Renamed')
+
+
+@override_settings(BOOK_SNAPSHOT={'ENABLED': True, 'BACKGROUND_REFRESH': False})
+class BooksSnapshotTests(BooksTests):
+    """Tests for listing the books from the in-memory snapshot"""
+
+    def setUp(self):
+        super(BooksSnapshotTests, self).setUp()
+        # The change counter goes back with the rollback of the previous test.
+        get_book_snapshot_engine().clear()
+        BookFactory(name='Book 1', release_date='2019-06-01', publisher=self.book2.publisher,
+                    authors=['Second Author', 'First Author'])
+        BookFactory(name='Book 4', release_date='2018-03-01', publisher=self.book1.publisher)
+
+    def get_from_database(self, params):
+        with override_settings(BOOK_SNAPSHOT={'ENABLED': False}):
+            return self.make_api_get_request(self.books_api_url, params)
+
+    def test_same_responses_as_the_database(self):
+        """Tests that the filters, pagination and sparse fields give the responses of the database."""
+        for params in [
+            {},
+            {'name': 'Book 1'},
+            {'isbn': 'L-Book2'},
+            {'release_date': 2018},
+            {'publisher': 'Morocco Books'},
+            {'publisher': 'Morocco Books', 'release_date': 2018},
+            {'name': 'Book 1', 'publisher': 'Unknown Books'},
+            {'page': 2, 'page_size': 2},
+            {'publisher': 'Lahore Books', 'page': 1, 'page_size': 1},
+            {'fields': 'id,name', 'release_date': 2019},
+            {'omit': 'authors,isbn'},
+        ]:
+            response_data = self.make_api_get_request(self.books_api_url, params)
+            self.assert_response_success(response_data)
+            self.assertEqual(response_data, self.get_from_database(params), params)
+
+    def test_no_books_queries(self):
+        """Tests that a list from the snapshot only queries the change counter."""
+        self.make_api_get_request(self.books_api_url)
+        with CaptureQueriesContext(connection) as context:
+            response_data = self.make_api_get_request(self.books_api_url, {'publisher': 'Morocco Books'})
+            self.assertEqual(len(context.captured_queries), 1)
+        self.assertEqual([book['name'] for book in response_data['data']], ['Book 1', 'Book 4'])
+
+    def test_left_to_the_database(self):
+        """Tests that the searches, cursor pages and invalid filters are answered by the database."""
+        for params in [{'q': 'Book'}, {'pagination': 'cursor', 'page_size': 2}, {'release_date': 'abc'}]:
+            with mock.patch('api.v1.views.BookViewSet.list_from_snapshot') as list_from_snapshot:
+                response_data = self.make_api_get_request(self.books_api_url, params)
+            list_from_snapshot.assert_not_called()
+            self.assertEqual(response_data, self.get_from_database(params), params)
+
+    def test_changes_are_listed(self):
+        """Tests that the books are listed as changed, never from an outdated snapshot."""
+        self.make_api_get_request(self.books_api_url)
+        self.client.patch(self.book_detail_url(self.book1.id), data={'name': 'Renamed'}, format='json')
+        self.client.delete(self.book_detail_url(self.book3.id))
+        publisher = self.book2.publisher
+        publisher.name = 'Renamed Publisher'
+        publisher.save()
+        response_data = self.make_api_get_request(self.books_api_url)
+        self.assertEqual(response_data, self.get_from_database({}))
+        self.assertIn('Renamed', [book['name'] for book in response_data['data']])
+        self.assertNotIn('U-Book3', [book['isbn'] for book in response_data['data']])
+
+    @override_settings(BOOK_SNAPSHOT={'ENABLED': True})
+    def test_background_refresh(self):
+        """Tests that the database answers while the snapshot is built in the background."""
+        with mock.patch('api.snapshot.BookSnapshotEngine.schedule_refresh') as schedule_refresh:
+            response_data = self.make_api_get_request(self.books_api_url)
+        schedule_refresh.assert_called_once_with()
+        self.assertEqual(response_data, self.get_from_database({}))
+
+
+@skipIf(msgpack is None, 'msgpack is not installed')
+class BooksMessagePackTests(BooksTests):
+    """Tests for negotiating MessagePack responses and requests"""
+
+    def test_list(self):
+        """Tests that the books are rendered as MessagePack when asked for in the Accept header."""
+        json_data = self.client.get(self.books_api_url).json()
+        response = self.client.get(self.books_api_url, HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(response.content, raw=False), json_data)
+
+    def test_etag_by_format(self):
+        """Tests that the json and MessagePack representations have their own ETag."""
+        json_response = self.client.get(self.books_api_url)
+        msgpack_response = self.client.get(self.books_api_url, HTTP_ACCEPT='application/msgpack')
+        self.assertNotEqual(json_response['ETag'], msgpack_response['ETag'])
+
+    def test_create(self):
+        """Tests that a MessagePack request body is parsed."""
+        book_data = {
+            'name': 'MessagePack Book',
+            'isbn': 'msgpack-1',
+            'authors': ['Awais Jibran'],
+            'country': self.book1.country.name,
+            'number_of_pages': 100,
+            'publisher': self.book1.publisher.name,
+            'release_date': '2019-05-19',
+        }
+        response = self.client.post(
+            self.books_api_url, data=msgpack.packb(book_data), content_type='application/msgpack',
+            HTTP_ACCEPT='application/msgpack'
+        )
+        response_data = msgpack.unpackb(response.content, raw=False)
+        self.assertEqual(response_data['status_code'], 201)
+        self.assertEqual(response_data['data']['book']['isbn'], 'msgpack-1')
+        self.assertTrue(Book.objects.filter(isbn='msgpack-1').exists())
+
+
+class BooksBulkTests(BooksTests):
+    """Tests for the batch create and update endpoint of the Book viewset"""
+    books_bulk_url = reverse('api:v1:books-bulk')
+
+    def setUp(self):
+        super(BooksBulkTests, self).setUp()
+        self.country = CountryFactory(name='Pakistan')
+        self.publisher = PublisherFactory(name='Traverse')
+        AuthorFactory(name='Awais Jibran')
+
+    def get_book_data(self, number, **kwargs):
+        book_data = {
+            'name': 'Bulk Book {0}'.format(number),
+            'isbn': 'bulk-{0}'.format(number),
+            'authors': ['Awais Jibran', 'New Author {0}'.format(number % 2)],
+            'country': 'Pakistan',
+            'number_of_pages': 100 + number,
+            'publisher': 'Traverse',
+            'release_date': '2019-05-19',
+        }
+        book_data.update(kwargs)
+        return book_data
+
+    def post_bulk(self, data):
+        return self.client.post(self.books_bulk_url, data=data, format='json')
+
+    def test_bulk_create(self):
+        """Tests that a batch of books is created with their authors."""
+        response = self.post_bulk([self.get_book_data(number) for number in range(3)])
+        self.assertEqual(response.status_code, 201)
+        response_data = response.json()
+        self.assertEqual(response_data['status'], 'success')
+        created = response_data['data']['created']
+        self.assertEqual([book['name'] for book in created], ['Bulk Book 0', 'Bulk Book 1', 'Bulk Book 2'])
+        self.assertEqual(created[1]['authors'], ['Awais Jibran', 'New Author 1'])
+        self.assertEqual(Book.objects.get(isbn='bulk-2').authors.count(), 2)
+
+    def test_bulk_update(self):
+        """Tests that the items with an id replace the existing books."""
+        response = self.post_bulk([
+            self.get_book_data(1, id=self.book1.id, name='Renamed Book 1', isbn=self.book1.isbn),
+            self.get_book_data(4),
+        ])
+        self.assertEqual(response.status_code, 201)
+        response_data = response.json()['data']
+        self.assertEqual(response_data['updated'][0]['name'], 'Renamed Book 1')
+        self.assertEqual(response_data['updated'][0]['authors'], ['Awais Jibran', 'New Author 1'])
+        self.assertEqual(len(response_data['created']), 1)
+        self.book1.refresh_from_db()
+        self.assertEqual(self.book1.name, 'Renamed Book 1')
+        self.assertEqual(self.book1.publisher, self.publisher)
+
+    def test_bulk_per_item_errors(self):
+        """Tests that invalid items are reported per item and nothing is written."""
+        response = self.post_bulk([
+            self.get_book_data(0),
+            self.get_book_data(1, country='Atlantis'),
+            self.get_book_data(2, isbn='M-Book1'),
+            self.get_book_data(3, isbn='bulk-0'),
+            self.get_book_data(4, id=0),
+        ])
+        self.assertEqual(response.status_code, 400)
+        errors = response.json()['errors']
+        self.assertEqual(errors[0], {'isbn': ['Duplicate isbn in the batch.']})
+        self.assertEqual(errors[1], {'country': ['Country Atlantis does not exist.']})
+        self.assertEqual(errors[2], {'isbn': ['book with this isbn already exists.']})
+        self.assertEqual(errors[4], {'id': ['Book does not exist.']})
+        self.assertFalse(Book.objects.filter(isbn__startswith='bulk-').exists())
+
+    def test_bulk_size_limit(self):
+        """Tests that batches above the maximum size are rejected."""
+        with mock.patch('api.v1.views.BookViewSet.max_bulk_size', 2):
+            response = self.post_bulk([self.get_book_data(number) for number in range(3)])
+        self.assertEqual(response.status_code, 400)
+
+    def test_bulk_query_count(self):
+        """Tests that the number of queries does not grow with the batch."""
+        self.post_bulk([self.get_book_data(100)])
+        with CaptureQueriesContext(connection) as small_batch:
+            self.post_bulk([self.get_book_data(number, authors=['Small Author']) for number in range(2)])
+        with CaptureQueriesContext(connection) as large_batch:
+            self.post_bulk([self.get_book_data(number, authors=['Large Author']) for number in range(10, 30)])
+        self.assertEqual(len(small_batch.captured_queries), len(large_batch.captured_queries))
+
+
+class BooksChangesTests(BooksTests):
+    """Tests for the changes feed of the Book viewset"""
+    books_changes_url = reverse('api:v1:books-changes')
+
+    def setUp(self):
+        super(BooksChangesTests, self).setUp()
+        self.cursor = self.get_changes()['pagination']['cursor']
+
+    def get_changes(self, since=None, **params):
+        if since is not None:
+            params['since'] = since
+        response = self.client.get(self.books_changes_url, data=params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def get_actions(self, response_data):
+        return [(change['book_id'], change['action']) for change in response_data['data']]
+
+    def test_current_cursor(self):
+        """Tests that without a cursor the feed gives the current cursor only."""
+        response_data = self.get_changes()
+        self.assert_response_success(response_data)
+        self.assertEqual(response_data['data'], [])
+        self.assertEqual(response_data['pagination']['cursor'], BookChange.objects.latest('id').id)
+        self.assertEqual(self.get_changes(self.cursor)['data'], [])
+
+    def test_changes_since_cursor(self):
+        """Tests that the creates, updates and deletes are given in order with the current books."""
+        self.client.post(self.books_api_url, data={
+            'name': 'New Book',
+            'isbn': 'new-book',
+            'authors': ['Awais Jibran'],
+            'country': self.book1.country.name,
+            'number_of_pages': 10,
+            'publisher': 'Morocco Books',
+            'release_date': '2018-01-01',
+        }, format='json')
+        new_book_id = Book.objects.get(isbn='new-book').id
+        self.client.patch(self.book_detail_url(self.book1.id), data={'name': 'Renamed'}, format='json')
+        self.client.delete(self.book_detail_url(self.book2.id))
+
+        response_data = self.get_changes(self.cursor)
+        self.assert_response_success(response_data)
+        self.assertEqual(self.get_actions(response_data), [
+            (new_book_id, 'created'), (self.book1.id, 'updated'), (self.book2.id, 'deleted')
+        ])
+        created, updated, deleted = response_data['data']
+        self.assertEqual(created['book']['authors'], ['Awais Jibran'])
+        self.assertEqual(updated['book']['name'], 'Renamed')
+        self.assertIsNone(deleted['book'])
+        self.assertEqual(
+            created['changed_at'],
+            DateTimeField().to_representation(BookChange.objects.get(id=created['cursor']).changed_at)
+        )
+        cursor = response_data['pagination']['cursor']
+        self.assertEqual(cursor, deleted['cursor'])
+        self.assertFalse(response_data['pagination']['has_more'])
+        self.assertEqual(self.get_changes(cursor)['data'], [])
+
+    def test_changes_of_a_book_are_collapsed(self):
+        """Tests that a book changed many times is given once, at its last change."""
+        for name in ('First', 'Second'):
+            self.client.patch(self.book_detail_url(self.book1.id), data={'name': name}, format='json')
+        self.client.patch(self.book_detail_url(self.book3.id), data={'name': 'Third'}, format='json')
+        self.client.patch(self.book_detail_url(self.book1.id), data={'authors': ['Third Author']}, format='json')
+
+        response_data = self.get_changes(self.cursor)
+        self.assertEqual(self.get_actions(response_data), [(self.book3.id, 'updated'), (self.book1.id, 'updated')])
+        self.assertEqual(response_data['data'][1]['book']['name'], 'Second')
+        self.assertEqual(response_data['data'][1]['book']['authors'], ['Third Author'])
+
+    def test_pages_of_changes(self):
+        """Tests that the feed is followed page by page with the cursors."""
+        for book in (self.book1, self.book2, self.book3):
+            book.name = 'Renamed {0}'.format(book.id)
+            book.save()
+
+        cursor, book_ids = self.cursor, []
+        while True:
+            response_data = self.get_changes(cursor, page_size=2)
+            self.assertLessEqual(len(response_data['data']), 2)
+            book_ids.extend(book_id for book_id, __ in self.get_actions(response_data))
+            cursor = response_data['pagination']['cursor']
+            if not response_data['pagination']['has_more']:
+                break
+            self.assertIn('since={0}'.format(cursor), response_data['pagination']['next'])
+        self.assertEqual(book_ids, [self.book1.id, self.book2.id, self.book3.id])
+
+    def test_renamed_authors_and_publishers(self):
+        """Tests that the books rendering a renamed author or publisher are given as updated."""
+        author = self.book1.authors.get()
+        author.name = 'Renamed Author'
+        author.save()
+        self.book3.publisher.name = 'Renamed Publisher'
+        self.book3.publisher.save()
+
+        response_data = self.get_changes(self.cursor)
+        book_ids = {book.id for book in Book.objects.filter(authors=author)}
+        self.assertEqual(set(self.get_actions(response_data)), {
+            (book_id, 'updated') for book_id in book_ids.union([self.book3.id])
+        })
+        self.assertEqual(response_data['data'][-1]['book']['publisher'], 'Renamed Publisher')
+
+    def test_bulk_changes(self):
+        """Tests that the books written by the bulk endpoint are logged."""
+        book_data = {
+            'name': 'Bulk Book',
+            'isbn': 'bulk-1',
+            'authors': ['George R. R. Martin'],
+            'country': self.book1.country.name,
+            'number_of_pages': 100,
+            'publisher': 'Morocco Books',
+            'release_date': '2019-05-19',
+        }
+        response = self.client.post(reverse('api:v1:books-bulk'), data=[
+            dict(book_data, id=self.book1.id, isbn='M-Book1'), book_data
+        ], format='json')
+        new_book_id = response.json()['data']['created'][0]['id']
+
+        response_data = self.get_changes(self.cursor)
+        self.assertEqual(self.get_actions(response_data), [(new_book_id, 'created'), (self.book1.id, 'updated')])
+
+    def test_invalid_parameters(self):
+        for params in ({'since': 'abc'}, {'since': -1}, {'since': 0, 'page_size': 0}):
+            response = self.client.get(self.books_changes_url, data=params)
+            self.assertEqual(response.status_code, 400)
+
+    def test_truncated_cursor(self):
+        """Tests that a cursor older than the retention gets a 410 Gone."""
+        self.client.patch(self.book_detail_url(self.book1.id), data={'name': 'Renamed'}, format='json')
+        compact_book_changes(timezone.now(), truncate_before=timezone.now())
+
+        response = self.client.get(self.books_changes_url, data={'since': self.cursor})
+        self.assertEqual(response.status_code, 410)
+        cursor = self.get_changes()['pagination']['cursor']
+        self.assertGreater(cursor, self.cursor)
+        self.assertEqual(self.get_changes(cursor)['data'], [])
+
+
 class FilterBookTests(BooksTests):
     """Tests for book filter"""
 
@@ -221,3 +1052,99 @@ class FilterBookTests(BooksTests):
         response_data = self.make_api_get_request(book_search_url)
         self.assert_response_data_count(response_data, 1)
         self.assert_book1_data(response_data)
+
+
+class SearchBookTests(BooksTests):
+    """Tests for the full text search of books"""
+
+    def setUp(self):
+        super(SearchBookTests, self).setUp()
+        self.dance_book = BookFactory(name='A Dance with Dragons', isbn='dance', authors=['George R. R. Martin'])
+        self.dragons_book = BookFactory(name='Dragons of Autumn', isbn='dragons', authors=['Margaret Weis'])
+        self.martin_book = BookFactory(name='Fevre Dream', isbn='fevre', authors=['Dragon Martin'])
+
+    def search(self, query, **params):
+        params['q'] = query
+        response_data = self.make_api_get_request(self.books_api_url, data=params)
+        self.assert_response_success(response_data)
+        return [book['isbn'] for book in response_data['data']]
+
+    def test_search_by_name(self):
+        """Tests that the words of the query are matched against the book names by prefix."""
+        self.assertEqual(self.search('danc drag'), ['dance'])
+
+    def test_search_by_author(self):
+        """Tests that the books are found by the names of their authors."""
+        self.assertEqual(self.search('weis'), ['dragons'])
+        self.assertEqual(self.search('margaret w'), ['dragons'])
+
+    def test_search_ranks_name_matches_first(self):
+        """Tests that the books matching by name rank above the ones matching by author."""
+        results = self.search('dragon')
+        self.assertCountEqual(results[:2], ['dance', 'dragons'])
+        self.assertEqual(results[2], 'fevre')
+
+    def test_search_without_words(self):
+        """Tests that a query without any words matches no books."""
+        self.assertEqual(self.search('"*'), [])
+
+    def test_search_with_filters_and_pagination(self):
+        """Tests that the search combines with the filters and keeps its order over the pages."""
+        self.assertEqual(self.search('dragon', isbn='fevre'), ['fevre'])
+        results = self.search('dragon')
+        pages = [self.search('dragon', page=page, page_size=1) for page in (1, 2, 3)]
+        self.assertEqual(sum(pages, []), results)
+        self.assertEqual(results[2], 'fevre')
+
+    def test_search_refused_by_keyset_modes(self):
+        """Tests that the cursor pagination and the export, which can not keep the ranking, refuse a search."""
+        response = self.client.get(self.books_api_url, {'q': 'dragon', 'pagination': 'cursor'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('pagination', response.json())
+        response = self.client.get(reverse('api:v1:books-export'), {'q': 'dragon'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('q', response.json())
+
+    def test_index_follows_book_changes(self):
+        """Tests that the index is updated when books are renamed, created and deleted."""
+        self.dance_book.name = 'A Feast for Crows'
+        self.dance_book.save()
+        self.assertEqual(self.search('crows'), ['dance'])
+        self.assertEqual(self.search('dance'), [])
+
+        BookFactory(name='Crows Nest', isbn='nest')
+        self.assertCountEqual(self.search('crows'), ['dance', 'nest'])
+
+        self.dance_book.delete()
+        self.assertEqual(self.search('crows'), ['nest'])
+
+    def test_index_follows_author_changes(self):
+        """Tests that the index is updated when the authors of a book or their names change."""
+        author = self.dragons_book.authors.get()
+        author.name = 'Tracy Hickman'
+        author.save()
+        self.assertEqual(self.search('hickman'), ['dragons'])
+        self.assertEqual(self.search('weis'), [])
+
+        self.dragons_book.authors.clear()
+        self.assertEqual(self.search('hickman'), [])
+        author.books.add(self.martin_book)
+        self.assertEqual(self.search('hickman'), ['fevre'])
+        author.books.clear()
+        self.assertEqual(self.search('hickman'), [])
+
+    def test_index_follows_bulk_writes(self):
+        """Tests that the books written by the bulk endpoint are indexed."""
+        CountryFactory(name='Pakistan')
+        PublisherFactory(name='Traverse')
+        response = self.client.post(reverse('api:v1:books-bulk'), data=[{
+            'name': 'Bulk Dragons',
+            'isbn': 'bulk-dragons',
+            'authors': ['Bulk Author'],
+            'country': 'Pakistan',
+            'number_of_pages': 100,
+            'publisher': 'Traverse',
+            'release_date': '2019-05-19',
+        }], format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.search('bulk'), ['bulk-dragons'])
@@ -1,34 +1,159 @@
+from collections import OrderedDict
+
+from django.http import StreamingHttpResponse
 from django_filters import rest_framework as filters
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.fields import DateTimeField
 from rest_framework.response import Response
+from rest_framework.status import HTTP_200_OK, HTTP_201_CREATED, HTTP_400_BAD_REQUEST
+from rest_framework.utils.urls import replace_query_param
 from rest_framework.viewsets import ModelViewSet
 
 from api.api_utils import get_response_status_info
+from api.caches import get_book_representation_cache
+from api.changes import collapse_book_changes, get_book_changes, get_current_cursor
+from api.conditional import BOOKS_COUNTER, ConditionalGetMixin
+from api.db_utils import filter_in
+from api.exports import iter_serialized, stream_json, stream_ndjson
 from api.filters import BookFilter
 from api.models import Book
-from api.serializers import BookSerializer, MinimalBookSerializer
+from api.pagination import BookPagination, KeysetPagination, get_unique_ordering, is_ordered_by_extra
+from api.serializers import BOOK_FIELDS, BookSerializer, BookValuesSerializer, BulkBookSerializer, MinimalBookSerializer
+from api.snapshot import get_book_snapshot_engine, get_snapshot_lookups
 
 
-class BookViewSet(ModelViewSet):
+class BookViewSet(ConditionalGetMixin, ModelViewSet):
     """View set for CURD operation on book model"""
     queryset = Book.objects.all()
     lookup_field = 'id'
     filter_backends = (filters.DjangoFilterBackend,)
     filter_class = BookFilter
+    pagination_class = BookPagination
+    export_chunk_size = 1000
+    max_bulk_size = 1000
+    changes_page_size = 100
+    max_changes_page_size = 1000
+    sparse_field_actions = ('list', 'retrieve', 'export')
+    change_counter_name = BOOKS_COUNTER
+
+    def get_requested_fields(self):
+        """
+        Returns the fields picked with `?fields=id,name` and `?omit=authors`
+        in the order of the serializer, or None when all fields are rendered.
+        """
+        query_params = self.request.query_params
+        if self.action not in self.sparse_field_actions or not {'fields', 'omit'}.intersection(query_params):
+            return None
+
+        def parse(param):
+            return {field.strip() for field in query_params.get(param, '').split(',') if field.strip()}
+
+        all_fields = BOOK_FIELDS
+        fields, omit = parse('fields') if 'fields' in query_params else set(all_fields), parse('omit')
+        unknown_fields = fields.union(omit).difference(all_fields)
+        if unknown_fields:
+            raise ValidationError({'fields': ['Unknown fields: {0}.'.format(', '.join(sorted(unknown_fields)))]})
+        return tuple(field for field in all_fields if field in fields and field not in omit)
 
     def get_serializer_class(self):
         """Return the class to use for the serializer."""
         if self.action == 'create':
             return MinimalBookSerializer
+        if self.action in ('list', 'export') and BookValuesSerializer.supports(self.get_requested_fields()):
+            return BookValuesSerializer
         return BookSerializer
 
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault('fields', self.get_requested_fields())
+        return super(BookViewSet, self).get_serializer(*args, **kwargs)
+
+    def get_queryset(self):
+        """Return the books queryset with the relations the serializer needs."""
+        queryset = super(BookViewSet, self).get_queryset()
+        if self.action == 'destroy':
+            return queryset
+        return self.get_serializer_class().setup_eager_loading(queryset, self.get_requested_fields())
+
+    def get_object(self):
+        """Return the book of the request, fetching it once per request."""
+        if not hasattr(self, '_object'):
+            self._object = super(BookViewSet, self).get_object()
+        return self._object
+
+    def filter_queryset(self, queryset):
+        """Filter the queryset, as values rows for the values serializer."""
+        queryset = super(BookViewSet, self).filter_queryset(queryset)
+        if self.get_serializer_class() is BookValuesSerializer:
+            queryset = BookValuesSerializer.select_values(queryset, self.get_requested_fields())
+        return queryset
+
     def list(self, request, *args, **kwargs):
         """List the books queryset"""
-        response = super(BookViewSet, self).list(request, *args, **kwargs)
+        conditional_response = self.get_conditional_response(request)
+        if conditional_response is not None:
+            return conditional_response
+        snapshot, lookups = self.get_snapshot()
+        representation_cache = get_book_representation_cache()
+        if snapshot is not None:
+            response = self.list_from_snapshot(snapshot, lookups)
+        elif representation_cache is not None and self.get_requested_fields() is None:
+            response = self.list_cached(representation_cache)
+        else:
+            response = super(BookViewSet, self).list(request, *args, **kwargs)
         response_data = self.transform_response_for_list(response)
         return Response(response_data)
 
+    def list_cached(self, representation_cache):
+        """
+        Lists the books from the cache of their representations. The page is
+        queried for the ids and ordering fields only, the books missing from
+        the cache are then fetched and serialized.
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        ordering_fields = [field.lstrip('-') for field in get_unique_ordering(queryset)]
+        queryset = queryset.select_related(None).prefetch_related(None).only(*ordering_fields)
+        page = self.paginate_queryset(queryset)
+        data = representation_cache.get_many(
+            [book.pk for book in (queryset if page is None else page)],
+            lambda book_ids: filter_in(self.get_queryset(), 'id', book_ids),
+            lambda books: self.get_serializer(books, many=True).data,
+        )
+        if page is not None:
+            return self.get_paginated_response(data)
+        return Response(data)
+
+    def get_snapshot(self):
+        """
+        Returns the snapshot of the books and the lookups of the request if
+        the snapshot engine is enabled and can answer the request, or Nones.
+        The cursor pagination and the full text search are left to the database.
+        """
+        snapshot_engine = get_book_snapshot_engine()
+        query_params = self.request.query_params
+        if (snapshot_engine is None or self.change_version is None or query_params.get('q')
+                or isinstance(self.paginator.get_paginator(self.request), KeysetPagination)):
+            return None, None
+        lookups = get_snapshot_lookups(BookFilter(query_params, queryset=Book.objects.none(), request=self.request))
+        if lookups is None:
+            return None, None
+        return snapshot_engine.get_snapshot(self.change_version), lookups
+
+    def list_from_snapshot(self, snapshot, lookups):
+        """Lists the books from the in-memory snapshot, without querying the database."""
+        fields = self.get_requested_fields()
+        positions = snapshot.filter(**lookups)
+        page = self.paginate_queryset(positions)
+        data = snapshot.represent(positions if page is None else page, BOOK_FIELDS if fields is None else fields)
+        if page is not None:
+            return self.get_paginated_response(data)
+        return Response(data)
+
     def retrieve(self, request, *args, **kwargs):
         """Retrieves a single book using book-id"""
+        conditional_response = self.get_conditional_response(request)
+        if conditional_response is not None:
+            return conditional_response
         response = super(BookViewSet, self).retrieve(request, *args, **kwargs)
         response_data = self.transform_response_for_retrieve(response)
         return Response(response_data)
@@ -42,18 +167,152 @@ class BookViewSet(ModelViewSet):
     def update(self, request, *args, **kwargs):
         """View for updating a book instance"""
         response = super(BookViewSet, self).update(request, *args, **kwargs)
-        book = self.get_object()
+        book = self.get_object()  # The updated book, not fetched again.
         response_data = self.transform_data_for_update(response, book)
 
         return Response(data=response_data)
 
     def destroy(self, request, *args, **kwargs):
         """View for deleting a book instance from the model."""
-        book = self.get_object()
+        book = self.get_object()  # Fetched once, super().destroy gets the same book.
         response = super(BookViewSet, self).destroy(request, *args, **kwargs)
         response_data = self.transform_response_for_destroy(response, book)
         return Response(data=response_data)
 
+    @action(detail=False, methods=['get'])
+    def export(self, request, *args, **kwargs):
+        """
+        Streams the whole (filtered) books catalog, serializing the books chunk
+        by chunk. Use `?output=ndjson` for newline delimited json. The chunks
+        can not keep the order of a search, `?q=` is refused.
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        if is_ordered_by_extra(queryset):
+            raise ValidationError({'q': ['The export can not keep the order of a search.']})
+        books = iter_serialized(
+            queryset,
+            self.get_serializer_class(),
+            get_unique_ordering(queryset),
+            chunk_size=self.export_chunk_size,
+            context=self.get_serializer_context(),
+            fields=self.get_requested_fields(),
+        )
+        if request.query_params.get('output') == 'ndjson':
+            return StreamingHttpResponse(stream_ndjson(books), content_type='application/x-ndjson')
+        return StreamingHttpResponse(stream_json(books), content_type='application/json')
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request, *args, **kwargs):
+        """
+        Creates and updates a batch of books in one transaction. Items with an
+        `id` replace the existing book, the others are created. Nothing is
+        written if any item is invalid and the errors are reported per item.
+        """
+        if isinstance(request.data, list) and len(request.data) > self.max_bulk_size:
+            return self.bulk_error_response(
+                {'non_field_errors': ['At most {0} books are allowed per batch.'.format(self.max_bulk_size)]}
+            )
+        serializer = BulkBookSerializer(data=request.data, many=True, context=self.get_serializer_context())
+        if not serializer.is_valid():
+            return self.bulk_error_response(serializer.errors)
+        serializer.save()
+
+        queryset = BookSerializer.setup_eager_loading(Book.objects.all())
+        books_by_id = {book.id: book for book in filter_in(queryset, 'id', [book.id for book in serializer.instance])}
+
+        def represent(books):
+            return BookSerializer([books_by_id[book.id] for book in books], many=True).data
+
+        response_data = {
+            'data': {
+                'created': represent(serializer.created_books),
+                'updated': represent(serializer.updated_books),
+            }
+        }
+        self.transform_data(response_data, HTTP_201_CREATED)
+        return Response(response_data, status=HTTP_201_CREATED)
+
+    def bulk_error_response(self, errors):
+        response_data = {'data': [], 'errors': errors}
+        self.transform_data(response_data, HTTP_400_BAD_REQUEST)
+        return Response(response_data, status=HTTP_400_BAD_REQUEST)
+
+    @action(detail=False, methods=['get'])
+    def changes(self, request, *args, **kwargs):
+        """
+        Feed of the changes of the books for incremental sync. The changes
+        after the cursor `?since=` are returned in order, with the current
+        representation of the changed books, null for the deleted ones, and
+        the cursor to poll next. Without `since` only the current cursor is
+        returned: take it, list the books, then poll the changes since it.
+        Created and updated books are to be applied as upserts. A cursor
+        older than the retention of the change log gets a 410 Gone.
+        """
+        page_size = self.get_changes_page_size()
+        since = request.query_params.get('since')
+        if since is None:
+            return self.changes_response([], get_current_cursor(), False)
+        try:
+            since = int(since)
+            if since < 0:
+                raise ValueError()
+        except ValueError:
+            raise ValidationError({'since': ['A valid cursor is required.']})
+
+        changes, has_more = get_book_changes(since, page_size)
+        book_ids = sorted({change.book_id for change in changes})
+        queryset = BookSerializer.setup_eager_loading(Book.objects.all())
+
+        def fetch(ids):
+            return filter_in(queryset, 'id', ids)
+
+        def serialize(books):
+            return BookSerializer(books, many=True).data
+
+        representation_cache = get_book_representation_cache()
+        if representation_cache is not None:
+            representations = representation_cache.get_many(book_ids, fetch, serialize)
+        else:
+            representations = serialize(fetch(book_ids))
+        books_by_id = {book['id']: book for book in representations}
+
+        changed_at_field = DateTimeField()
+        data = [
+            OrderedDict([
+                ('cursor', change.id),
+                ('book_id', change.book_id),
+                ('action', action),
+                ('changed_at', changed_at_field.to_representation(change.changed_at)),
+                ('book', books_by_id.get(change.book_id)),
+            ])
+            for change, action in collapse_book_changes(changes, books_by_id)
+        ]
+        return self.changes_response(data, changes[-1].id if changes else since, has_more)
+
+    def get_changes_page_size(self):
+        page_size = self.request.query_params.get('page_size')
+        if page_size is None:
+            return self.changes_page_size
+        try:
+            page_size = int(page_size)
+            if page_size <= 0:
+                raise ValueError()
+        except ValueError:
+            raise ValidationError({'page_size': ['A positive integer is required.']})
+        return min(page_size, self.max_changes_page_size)
+
+    def changes_response(self, data, cursor, has_more):
+        response_data = {
+            'data': data,
+            'pagination': OrderedDict([
+                ('cursor', cursor),
+                ('has_more', has_more),
+                ('next', replace_query_param(self.request.build_absolute_uri(), 'since', cursor)),
+            ]),
+        }
+        self.transform_data(response_data, HTTP_200_OK)
+        return Response(response_data)
+
     @staticmethod
     def transform_data(data, status_code):
         """Transform data and add response status information """
@@ -63,6 +322,9 @@ class BookViewSet(ModelViewSet):
     def transform_response_for_list(self, response):
         """Transform response for book list endpoint.' """
         response_data = {'data': response.data}
+        pagination_info = self.paginator.get_pagination_info()
+        if pagination_info is not None:
+            response_data['pagination'] = pagination_info
         self.transform_data(response_data, response.status_code)
         return response_data
 
@@ -1,7 +1,10 @@
+from django.http import HttpResponse, HttpResponseForbidden
 from rest_framework.response import Response
 from rest_framework.status import HTTP_200_OK
 from rest_framework.views import APIView
 
+from api.coalescing import get_single_flight
+from api.instrumentation import get_metrics_options, get_metrics_registry
 from api.services import BooksService
 
 
@@ -17,3 +20,19 @@ class BooksList(APIView):
         query_params = request.query_params
         response_data = self.book_service.get_books(name=query_params.get('name'))
         return Response(response_data, status=HTTP_200_OK)
+
+
+def metrics(request):
+    """
+    Exports the histograms of the sampled requests and the counters of the
+    coalesced book store fetches in the Prometheus text format. Only the
+    staff users and the scrapers from `API_METRICS['ALLOWED_IPS']`, matched
+    with `REMOTE_ADDR`, may read them.
+    """
+    if not (request.user.is_staff or request.META.get('REMOTE_ADDR') in get_metrics_options()['ALLOWED_IPS']):
+        return HttpResponseForbidden()
+    output = get_metrics_registry().render()
+    single_flight = get_single_flight()
+    if single_flight is not None:
+        output += single_flight.render()
+    return HttpResponse(output, content_type='text/plain; version=0.0.4; charset=utf-8')
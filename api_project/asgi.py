@@ -0,0 +1,28 @@
+"""
+ASGI config for api_project project.
+
+It exposes the ASGI callable as a module-level variable named ``application``
+serving the endpoints which have an async implementation, e.g.
+
+    uvicorn api_project.asgi:application
+
+The remaining endpoints are served by the WSGI application.
+"""
+
+import os
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "api_project.settings")
+django.setup()
+
+from django.urls import reverse  # noqa: E402
+
+from api.async_views import AsyncBooksList, AsyncRouter  # noqa: E402
+from api.mirror import start_mirror_scheduler  # noqa: E402
+
+application = AsyncRouter(lambda: {
+    reverse('api:external_books'): AsyncBooksList(),
+})
+
+start_mirror_scheduler()
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/1.11/ref/settings/
 """
 
 import os
+from importlib.util import find_spec
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 
@@ -43,6 +44,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.instrumentation.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -109,10 +111,145 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+# Caches
+# https://docs.djangoproject.com/en/1.11/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
 ACTIVE_BOOK_STORE = 'api.book_stores.IceAndFireStore'
 
+# Set ACTIVE_BOOK_STORES to query several stores concurrently, e.g.
+# ACTIVE_BOOK_STORES = [
+#     'api.book_stores.IceAndFireStore',
+#     {'BACKEND': 'path.to.OtherStore', 'DEADLINE': 2},
+# ]
+# Stores without their own DEADLINE get BOOK_STORE_DEADLINE seconds to answer.
+BOOK_STORE_DEADLINE = 5
+
+# The Ice and Fire api is paginated; pages after the first are fetched by
+# MAX_WORKERS threads, up to MAX_PAGES pages of PAGE_SIZE books.
+ICE_AND_FIRE_STORE = {
+    'PAGE_SIZE': 50,
+    'MAX_PAGES': 20,
+    'MAX_WORKERS': 4,
+}
+
+# Connection pooling, timeouts (in seconds), retries and circuit breaking of
+# the requests made by the book stores.
+BOOK_STORE_HTTP = {
+    'CONNECT_TIMEOUT': 3.05,
+    'READ_TIMEOUT': 10,
+    'MAX_RETRIES': 2,
+    'BACKOFF_FACTOR': 0.3,
+    'POOL_MAXSIZE': 20,
+    'FAILURE_THRESHOLD': 5,
+    'RECOVERY_TIMEOUT': 30,
+}
+
+# Responses of the book store are fresh for TIMEOUT seconds and then served
+# stale for up to STALE_TIMEOUT seconds while they are refreshed.
+BOOK_STORE_CACHE = {
+    'ENABLED': True,
+    'CACHE_ALIAS': 'default',
+    'TIMEOUT': 300,
+    'STALE_TIMEOUT': 600,
+    'MAX_ENTRIES': 1000,
+}
+
+# The external catalog is mirrored into the local database by the
+# sync_external_books command, run periodically e.g. from cron. Set
+# ACTIVE_BOOK_STORE to 'api.book_stores.LocalMirrorStore' to answer the
+# external books queries from the mirror.
+#
+# Set SYNC_INTERVAL, in seconds, to also sync in the serving processes. Each
+# sync takes a lock in the LOCK_CACHE_ALIAS cache, which must be shared, e.g.
+# memcached or redis, for a single process to sync per interval. With the
+# process local LocMemCache every worker crawls the upstream, only set it for
+# a single serving process then.
+EXTERNAL_BOOKS_MIRROR = {
+    'UPSTREAM': 'api.book_stores.IceAndFireStore',
+    'SYNC_INTERVAL': None,
+    'LOCK_CACHE_ALIAS': 'default',
+}
+
+# Concurrent fetches of the same books query share a single call to the
+# book stores, the coalesced fetches are counted at /api/metrics/.
+BOOK_STORE_COALESCING = {
+    'ENABLED': True,
+}
+
+# The countries, publishers and authors looked up by name are kept in memory
+# for MAX_AGE seconds at most. The processes tell each other about the changes
+# through CACHE_ALIAS when it is shared by them, e.g. memcached or redis. On a
+# process local cache like the LocMemCache the changes made by the other
+# processes show after MAX_AGE seconds.
+REFERENCE_CACHE = {
+    'ENABLED': True,
+    'CACHE_ALIAS': 'default',
+    'MAX_AGE': 300,
+}
+
+# Serialized books are cached for TIMEOUT seconds at most, they are invalidated
+# when the books, their authors, countries or publishers change. The
+# invalidations only reach the other processes through a shared CACHE_ALIAS,
+# with ENABLED None the cache is off on a process local cache like the
+# LocMemCache, set it to True for a single process.
+#
+# The CACHES above are process local, so the cache is OFF with these settings
+# and the book lists are serialized on every request. Point CACHE_ALIAS to a
+# shared cache, e.g. memcached or redis, to cache them.
+BOOK_REPRESENTATION_CACHE = {
+    'ENABLED': None,
+    'CACHE_ALIAS': 'default',
+    'TIMEOUT': 300,
+}
+
+# Opt-in in-memory snapshot of the books answering the filtered and page
+# number paginated book lists without querying the database. It is refreshed
+# from the change signals, in a background thread if BACKGROUND_REFRESH.
+# SQLite only, the snapshot orders the names like its collation.
+BOOK_SNAPSHOT = {
+    'ENABLED': False,
+    'BACKGROUND_REFRESH': True,
+}
+
+# The changes of the books are logged for the /v1/books/changes/ feed. The
+# compact_book_changes command deletes the entries superseded for
+# COMPACT_AFTER seconds and all the entries older than RETENTION seconds.
+BOOK_CHANGES = {
+    'COMPACT_AFTER': 24 * 60 * 60,
+    'RETENTION': 30 * 24 * 60 * 60,
+}
+
+# A SAMPLE_RATE share of the requests is instrumented, their timings are sent
+# in a Server-Timing header and exported at /api/metrics/, readable by the
+# staff users and from the ALLOWED_IPS, none by default. The ips are matched
+# with REMOTE_ADDR: behind a reverse proxy on the same host every client comes
+# from 127.0.0.1, list the address of the scraper only when it reaches the
+# server directly.
+API_METRICS = {
+    'ENABLED': True,
+    'SAMPLE_RATE': 0.1,
+    'SERVER_TIMING': True,
+}
+
+# Responses are rendered as json, with orjson if installed, or as MessagePack
+# when asked for with `Accept: application/msgpack` and msgpack is installed.
 REST_FRAMEWORK = {
     "DATE_INPUT_FORMATS": ["%Y-%m-%d"],
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ] + (['api.renderers.MessagePackRenderer'] if find_spec('msgpack') else []),
+    'DEFAULT_PARSER_CLASSES': [
+        'api.renderers.ORJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ] + (['api.renderers.MessagePackParser'] if find_spec('msgpack') else []),
     'DEFAULT_FILTER_BACKENDS': (
         'django_filters.rest_framework.DjangoFilterBackend',
     ),
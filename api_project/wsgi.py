@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "api_project.settings")
 
 application = get_wsgi_application()
+
+from api.mirror import start_mirror_scheduler  # noqa: E402
+
+start_mirror_scheduler()
@@ -0,0 +1,21 @@
+"""
+Benchmarks of the api, run from the project root as modules, e.g.
+
+    python -m benchmarks.external_transform
+    python -m benchmarks.renderers
+    python -m benchmarks.api_endpoints --output=results.json
+"""
+import os
+import timeit
+
+
+def setup_django(settings_module='api_project.settings'):
+    """Configures django for running a benchmark outside of manage.py."""
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+    import django
+    django.setup()
+
+
+def time_best_of(function, number=1, repeat=5):
+    """Returns the best time in seconds of calling the function `number` times."""
+    return min(timeit.repeat(function, number=number, repeat=repeat))
@@ -0,0 +1,274 @@
+"""
+Measures the throughput, latency, query count and peak memory of the books
+api endpoints and of /external-books/ against a local stub upstream.
+
+The books are seeded into a throwaway test database, with the bulk mode of
+generate_books or with the test factories, and the requests are made in
+process with the DRF test client. The results are written to a JSON file
+and, given the results of a previous run, compared with them.
+
+EXAMPLE USAGE:
+    python -m benchmarks.api_endpoints --books=5000 --output=before.json
+    python -m benchmarks.api_endpoints --books=5000 --output=after.json --compare=before.json
+"""
+import argparse
+import io
+import json
+import platform
+import random
+import subprocess
+import time
+import tracemalloc
+from collections import OrderedDict
+from datetime import datetime
+
+from benchmarks import setup_django
+
+SETTINGS_OVERRIDES = {
+    'API_METRICS': {'ENABLED': False},
+    'BOOK_STORE_CACHE': {'ENABLED': False},
+    'BOOK_STORE_HTTP': {'MAX_RETRIES': 0},
+}
+
+
+def percentile(sorted_values, percent):
+    """Returns the nearest rank percentile of the sorted values."""
+    index = max(int(round(percent / 100.0 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def seed_books(count, seeder):
+    """Inserts `count` random books and returns their ids."""
+    from django.core.management import call_command
+
+    from api.models import Book
+    from api.tests.factories import BookFactory
+
+    if seeder == 'bulk':
+        call_command('generate_books', batch_size=count, bulk=True, chunk_size=1000, stdout=io.StringIO())
+    else:
+        for __ in range(count):
+            BookFactory(authors=random.sample(['Awais Jibran', 'Adeva', 'A.R. Akram', 'Rehman G'], 2))
+    return list(Book.objects.values_list('id', flat=True))
+
+
+class Scenario(object):
+    """A request made over and over, with a fresh (method, path, data) per call."""
+
+    def __init__(self, name, make_request):
+        self.name = name
+        self.make_request = make_request
+
+    def call(self, client, number):
+        method, path, data = self.make_request(number)
+        response = getattr(client, method)(path, data=data, format='json')
+        if response.status_code >= 400:
+            raise RuntimeError('{0} {1} failed with {2}: {3}'.format(
+                method.upper(), path, response.status_code, response.content[:500]
+            ))
+        if response.streaming:
+            b''.join(response.streaming_content)
+        return response
+
+
+def get_scenarios(book_ids, rng):
+    from rest_framework.reverse import reverse
+
+    from api.models import Book, Country, Publisher
+
+    books_url = reverse('api:v1:books-list')
+    sample_book = Book.objects.select_related('publisher').order_by('id').first()
+    country = Country.objects.order_by('id').first()
+    publisher = Publisher.objects.order_by('id').first()
+
+    def detail_url(number):
+        return '{0}{1}/'.format(books_url, rng.choice(book_ids))
+
+    def create(number):
+        return 'post', books_url, {
+            'name': 'Benchmark Book {0}'.format(number),
+            'isbn': 'benchmark-{0}'.format(number),
+            'authors': ['Awais Jibran'],
+            'country': country.name,
+            'number_of_pages': 100,
+            'publisher': publisher.name,
+            'release_date': '2019-05-19',
+        }
+
+    return [
+        Scenario('list', lambda number: ('get', books_url, None)),
+        Scenario('list_page', lambda number: ('get', books_url, {'page': 1, 'page_size': 50})),
+        Scenario('list_filtered', lambda number: (
+            'get', books_url, {'publisher': sample_book.publisher.name, 'release_date': sample_book.release_date.year}
+        )),
+        Scenario('retrieve', lambda number: ('get', detail_url(number), None)),
+        Scenario('create', create),
+        Scenario('update', lambda number: ('patch', detail_url(number), {'name': 'Updated {0}'.format(number)})),
+        Scenario('external_books', lambda number: ('get', reverse('api:external_books'), None)),
+    ]
+
+
+def run_scenario(scenario, client, requests, warmup, profile_requests):
+    """Times the requests of the scenario, then profiles a few more for queries and memory."""
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    number = 0
+    for __ in range(warmup):
+        scenario.call(client, number)
+        number += 1
+
+    latencies = []
+    started_at = time.perf_counter()
+    for __ in range(requests):
+        request_started_at = time.perf_counter()
+        scenario.call(client, number)
+        latencies.append(time.perf_counter() - request_started_at)
+        number += 1
+    elapsed = time.perf_counter() - started_at
+
+    query_counts, peak_memory = [], 0
+    for __ in range(profile_requests):
+        tracemalloc.start()
+        with CaptureQueriesContext(connection) as context:
+            scenario.call(client, number)
+            query_counts.append(len(context.captured_queries))
+        peak_memory = max(peak_memory, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        number += 1
+
+    latencies.sort()
+    return OrderedDict([
+        ('requests', requests),
+        ('throughput_rps', round(requests / elapsed, 2)),
+        ('latency_ms', OrderedDict([
+            ('mean', round(sum(latencies) / len(latencies) * 1000, 3)),
+            ('p50', round(percentile(latencies, 50) * 1000, 3)),
+            ('p99', round(percentile(latencies, 99) * 1000, 3)),
+            ('max', round(latencies[-1] * 1000, 3)),
+        ])),
+        ('queries_per_request', round(sum(query_counts) / len(query_counts), 2) if query_counts else None),
+        ('peak_memory_kib', round(peak_memory / 1024.0, 1)),
+    ])
+
+
+def get_git_commit():
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL)
+        return output.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, previous_results=None):
+    header = '{0:<16} {1:>10} {2:>10} {3:>10} {4:>8} {5:>12}'.format(
+        'scenario', 'req/s', 'p50 ms', 'p99 ms', 'queries', 'peak KiB'
+    )
+    print(header)
+    print('-' * len(header))
+    for name, result in results.items():
+        print('{0:<16} {1:>10} {2:>10} {3:>10} {4:>8} {5:>12}'.format(
+            name,
+            result['throughput_rps'],
+            result['latency_ms']['p50'],
+            result['latency_ms']['p99'],
+            result['queries_per_request'],
+            result['peak_memory_kib'],
+        ))
+        previous = (previous_results or {}).get(name)
+        if previous:
+            print('{0:<16} {1:>+9.1f}% {2:>+9.1f}% {3:>+9.1f}% {4:>+8} {5:>+11.1f}%'.format(
+                '  vs previous',
+                change(previous['throughput_rps'], result['throughput_rps']),
+                change(previous['latency_ms']['p50'], result['latency_ms']['p50']),
+                change(previous['latency_ms']['p99'], result['latency_ms']['p99']),
+                round((result['queries_per_request'] or 0) - (previous['queries_per_request'] or 0), 2),
+                change(previous['peak_memory_kib'], result['peak_memory_kib']),
+            ))
+
+
+def change(previous, current):
+    """Returns the relative change from previous to current in percent."""
+    return (current - previous) / previous * 100 if previous else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--books', type=int, default=1000, help='number of books to seed')
+    parser.add_argument('--seeder', choices=('bulk', 'factories'), default='bulk', help='how to seed the books')
+    parser.add_argument('--external-books', type=int, default=200, help='number of books of the stub upstream')
+    parser.add_argument('--requests', type=int, default=100, help='number of timed requests per scenario')
+    parser.add_argument('--warmup', type=int, default=5, help='number of untimed requests per scenario')
+    parser.add_argument('--profile-requests', type=int, default=3,
+                        help='number of requests per scenario profiled for queries and memory')
+    parser.add_argument('--scenario', action='append', help='run only the named scenarios')
+    parser.add_argument('--snapshot', action='store_true', help='list the books from the in-memory snapshot')
+    parser.add_argument('--seed', type=int, default=42, help='seed of the random data and requests')
+    parser.add_argument('--output', default='benchmark-results.json', help='file to write the results to')
+    parser.add_argument('--compare', help='results of a previous run to compare with')
+    args = parser.parse_args()
+
+    setup_django()
+    import django
+    from django.db import connection
+    from django.test.utils import override_settings, setup_test_environment
+
+    from rest_framework.test import APIClient
+
+    from api.book_stores import IceAndFireStore
+    from api.tests.utils import PaginatedUpstream, StubServer
+
+    random.seed(args.seed)
+    rng = random.Random(args.seed)
+    setup_test_environment()
+    old_database_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    store_url = IceAndFireStore.url
+    settings_overrides = dict(SETTINGS_OVERRIDES)
+    if args.snapshot:
+        settings_overrides['BOOK_SNAPSHOT'] = {'ENABLED': True, 'BACKGROUND_REFRESH': False}
+    try:
+        with override_settings(**settings_overrides), StubServer(PaginatedUpstream(args.external_books)) as server:
+            book_ids = seed_books(args.books, args.seeder)
+            IceAndFireStore.url = server.url + '/api/books'
+            client = APIClient()
+            results = OrderedDict()
+            for scenario in get_scenarios(book_ids, rng):
+                if args.scenario and scenario.name not in args.scenario:
+                    continue
+                results[scenario.name] = run_scenario(
+                    scenario, client, args.requests, args.warmup, args.profile_requests
+                )
+    finally:
+        IceAndFireStore.url = store_url
+        connection.creation.destroy_test_db(old_database_name, verbosity=0)
+
+    report = OrderedDict([
+        ('meta', OrderedDict([
+            ('created_at', datetime.utcnow().isoformat() + 'Z'),
+            ('git_commit', get_git_commit()),
+            ('python', platform.python_version()),
+            ('django', django.get_version()),
+            ('database', connection.vendor),
+            ('books', args.books),
+            ('seeder', args.seeder),
+            ('snapshot', args.snapshot),
+            ('external_books', args.external_books),
+            ('requests', args.requests),
+            ('warmup', args.warmup),
+            ('seed', args.seed),
+        ])),
+        ('results', results),
+    ])
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+
+    previous_results = None
+    if args.compare:
+        with open(args.compare) as previous:
+            previous_results = json.load(previous)['results']
+    print_results(results, previous_results)
+    print('\nResults written to {0}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
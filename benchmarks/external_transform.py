@@ -0,0 +1,54 @@
+"""
+Compares transforming the external api books with IceAndFireSerializer per
+book against the batch IceAndFireSerializer.transform_many.
+
+EXAMPLE USAGE:
+    python -m benchmarks.external_transform --books=5000
+"""
+import argparse
+import random
+
+from benchmarks import setup_django, time_best_of
+
+
+def generate_books_data(count):
+    """Generates external api books like the ones of the Ice and Fire api."""
+    return [
+        {
+            'url': 'https://www.anapioficeandfire.com/api/books/{0}'.format(number),
+            'name': 'Book {0}'.format(number),
+            'isbn': '978-{0:010d}'.format(number),
+            'authors': ['George R. R. Martin'],
+            'numberOfPages': random.randint(100, 1000),
+            'publisher': 'Bantam Books',
+            'country': 'United States',
+            'characters': [],
+            'released': '{0}-{1:02d}-01T00:00:00'.format(random.randint(1990, 2020), random.randint(1, 12)),
+        }
+        for number in range(count)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--books', type=int, default=5000, help='number of books to transform')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timed runs, the best is reported')
+    args = parser.parse_args()
+
+    setup_django()
+    from api.serializers import IceAndFireSerializer
+
+    books_data = generate_books_data(args.books)
+    per_book = time_best_of(
+        lambda: [IceAndFireSerializer(book_data).data for book_data in books_data], repeat=args.repeat
+    )
+    batch = time_best_of(lambda: IceAndFireSerializer.transform_many(books_data), repeat=args.repeat)
+
+    print('books:               {0}'.format(args.books))
+    print('per book serializer: {0:.4f}s ({1:.1f} us/book)'.format(per_book, per_book / args.books * 1e6))
+    print('batch transform:     {0:.4f}s ({1:.1f} us/book)'.format(batch, batch / args.books * 1e6))
+    print('speedup:             {0:.1f}x'.format(per_book / batch))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Compares the encode time and payload size of a page of books rendered by
+DRF's JSONRenderer, the orjson backed ORJSONRenderer and the
+MessagePackRenderer.
+
+EXAMPLE USAGE:
+    python -m benchmarks.renderers --books=1000
+"""
+import argparse
+import random
+from collections import OrderedDict
+from datetime import date
+
+from benchmarks import setup_django, time_best_of
+
+
+def generate_books(count):
+    """Generates books in the representation of BookSerializer, with dates left as dates."""
+    return [
+        OrderedDict([
+            ('id', number),
+            ('name', 'Book: {0}'.format(number)),
+            ('isbn', 'BNF-{0:032x}'.format(random.getrandbits(128))),
+            ('authors', random.sample(['Awais Jibran', 'Adeva', 'A.R. Akram', 'Rehman G'], random.randint(0, 3))),
+            ('number_of_pages', random.randint(100, 1000)),
+            ('publisher', random.choice(['DestinationPakistan', 'Traverse', 'IBNFreaks'])),
+            ('country', random.choice(['Pakistan', 'United States', 'Morocco', 'Turkey'])),
+            ('release_date', date(random.randint(1990, 2020), random.randint(1, 12), 1)),
+        ])
+        for number in range(count)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--books', type=int, default=1000, help='number of books on the page')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timed runs, the best is reported')
+    parser.add_argument('--number', type=int, default=10, help='number of renders per timed run')
+    args = parser.parse_args()
+
+    setup_django()
+    from rest_framework.renderers import JSONRenderer
+
+    from api.api_utils import get_response_status_info
+    from api.renderers import MessagePackRenderer, ORJSONRenderer, msgpack, orjson
+
+    response_data = get_response_status_info(200)
+    response_data['data'] = generate_books(args.books)
+
+    renderers = [('JSONRenderer', JSONRenderer())]
+    if orjson is not None:
+        renderers.append(('ORJSONRenderer', ORJSONRenderer()))
+    else:
+        print('orjson is not installed, skipping ORJSONRenderer')
+    if msgpack is not None:
+        renderers.append(('MessagePackRenderer', MessagePackRenderer()))
+    else:
+        print('msgpack is not installed, skipping MessagePackRenderer')
+
+    baseline_time = baseline_size = None
+    print('books: {0}'.format(args.books))
+    print('{0:<20} {1:>12} {2:>10} {3:>12} {4:>8}'.format('renderer', 'ms/render', 'speedup', 'bytes', 'size'))
+    for name, renderer in renderers:
+        elapsed = time_best_of(lambda: renderer.render(response_data), number=args.number, repeat=args.repeat)
+        elapsed /= args.number
+        size = len(renderer.render(response_data))
+        baseline_time, baseline_size = baseline_time or elapsed, baseline_size or size
+        print('{0:<20} {1:>12.3f} {2:>9.1f}x {3:>12} {4:>7.0f}%'.format(
+            name, elapsed * 1000, baseline_time / elapsed, size, size / baseline_size * 100
+        ))
+
+
+if __name__ == '__main__':
+    main()